@@ -0,0 +1,326 @@
+""" Incremental cross-image statistics over the measurement outputs
+
+Indexes the outputs of the scripts of a data directory:
+
+    measure.py              <prefix>_measure.csv, Image,Feature,Value rows, and
+                            the legacy <image>.csv, tab-separated Feature / Value lines
+    getDistanceArea.py      Type,Image Name,Label,Value rows of the folder
+    RoiColocalization.py    <csv>_proc.csv, one row per roi
+
+and keeps per file the partial statistics of every (condition, feature):
+count, mean and variance (Welford) plus a mergeable relative-error
+quantile sketch. An update reads only the new or changed files; the
+totals are merged from the partials, so removed or rewritten files never
+force the rest to be read again. An image measured into both a combined
+measure.py table and its legacy key/value file is counted from the table. The condition of an image is its name
+without the trailing image number, e.g. 'YG0_class' for 'YG0_class012.tif'.
+
+    python Aggregate.py <directory> [--summary summary.csv]
+"""
+import os
+import io
+import re
+import csv
+import json
+import math
+from CsvTools import SeekCsvDialect
+
+AggregateName = '.imagej_measure_aggregate.json'
+SummaryName = 'aggregate_summary.csv'
+AllConditions = '*'
+
+# Quantile sketch: values are counted in logarithmic buckets of relative width 2 * Accuracy
+Accuracy = 0.01
+_Gamma = (1 + Accuracy) / (1 - Accuracy)
+_LogGamma = math.log(_Gamma)
+Quantiles = [0.05, 0.25, 0.5, 0.75, 0.95]
+
+def NewStats() :
+    """ Empty running statistics of one feature """
+    stats = {}
+    stats['Count']  =   0
+    stats['Mean']   =   0.0
+    stats['M2']     =   0.0     # Sum of squared deviations from the mean
+    stats['Min']    =   None
+    stats['Max']    =   None
+    stats['Sketch'] =   {}      # 'p<k>' / 'n<k>' bucket of positive / negative values -> count, '0' for zeros
+    return stats
+
+def _Bucket(v) :
+    """ Sketch bucket of a value """
+    if v == 0 :
+        return '0'
+    k = int(math.ceil(math.log(abs(v)) / _LogGamma))
+    return ('p%d' if v > 0 else 'n%d') % k
+
+def _BucketValue(bucket) :
+    """ Representative value of a sketch bucket, within Accuracy of its members """
+    if bucket == '0' :
+        return 0.0
+    v = 2 * _Gamma ** int(bucket[1:]) / (_Gamma + 1)
+    return -v if bucket[0] == 'n' else v
+
+def _BucketOrder(bucket) :
+    """ Sort key of the buckets by value """
+    if bucket == '0' :
+        return (1, 0)
+    k = int(bucket[1:])
+    return (0, -k) if bucket[0] == 'n' else (2, k)
+
+def AddValue(stats, v) :
+    """ Add one value (Welford's update) """
+    stats['Count'] += 1
+    delta = v - stats['Mean']
+    stats['Mean'] += delta / stats['Count']
+    stats['M2'] += delta * (v - stats['Mean'])
+    stats['Min'] = v if stats['Min'] is None else min(stats['Min'], v)
+    stats['Max'] = v if stats['Max'] is None else max(stats['Max'], v)
+    bucket = _Bucket(v)
+    stats['Sketch'][bucket] = stats['Sketch'].get(bucket, 0) + 1
+
+def MergeStats(total, part) :
+    """ Merge the statistics of part into total (Chan et al.) """
+    n = total['Count'] + part['Count']
+    if part['Count'] == 0 :
+        return total
+    delta = part['Mean'] - total['Mean']
+    total['M2'] += part['M2'] + delta * delta * total['Count'] * part['Count'] / n
+    total['Mean'] += delta * part['Count'] / n
+    total['Count'] = n
+    total['Min'] = part['Min'] if total['Min'] is None else min(total['Min'], part['Min'])
+    total['Max'] = part['Max'] if total['Max'] is None else max(total['Max'], part['Max'])
+    for bucket, count in part['Sketch'].items() :
+        total['Sketch'][bucket] = total['Sketch'].get(bucket, 0) + count
+    return total
+
+def SketchQuantile(stats, q) :
+    """ Value at quantile q, within Accuracy relative error """
+    if stats['Count'] == 0 :
+        return float('nan')
+    rank = q * (stats['Count'] - 1)
+    seen = 0
+    for bucket in sorted(stats['Sketch'].keys(), key=_BucketOrder) :
+        seen += stats['Sketch'][bucket]
+        if seen > rank :
+            return min(max(_BucketValue(bucket), stats['Min']), stats['Max'])
+    return stats['Max']
+
+def StatsSummary(stats) :
+    """ Count, mean, variance, standard deviation, range and Quantiles of running statistics """
+    n = stats['Count']
+    variance = stats['M2'] / (n - 1) if n > 1 else 0.0
+    row = {}
+    row['Count']    =   n
+    row['Mean']     =   stats['Mean'] if n else float('nan')
+    row['Variance'] =   variance
+    row['Std']      =   math.sqrt(variance)
+    row['Min']      =   stats['Min']
+    row['Max']      =   stats['Max']
+    for q in Quantiles :
+        row['Q%02d' % int(round(q * 100))] = SketchQuantile(stats, q)
+    return row
+
+def ImageCondition(image) :
+    """ Condition of an image: its name without extension and trailing image number """
+    stem = os.path.splitext(os.path.basename(image))[0]
+    return re.sub(r'[_\- ]*\d+$', '', stem) or stem
+
+def OutputKind(path) :
+    """ Return 'measure', 'keyvalue', 'long' or 'proc' for a measurement output, None for other files """
+    if path.endswith('_proc.csv') :
+        return 'proc'
+    with io.open(path, 'r', newline='') as f :
+        first = f.readline()
+    if first.startswith('Type,Image Name,Label,Value') :
+        return 'long'
+    if first.startswith('Image,Feature,Value') :
+        return 'measure'
+    if len(first.split('\t')) == 2 :
+        return 'keyvalue'
+    return None
+
+def _Float(text) :
+    """ Parse a number, None when the text is not one """
+    try :
+        v = float(text)
+    except (TypeError, ValueError) :
+        return None
+    return v if v == v else None   # Skip NaN
+
+# Columns of the _proc.csv tables that are labels or row numbers, not measurements
+LabelFields = ['', ' ', 'Label', 'Mito #']
+Roles = ['Mitochondria', 'Flag', 'Dapi']
+
+def OutputValues(path, kind) :
+    """ Yield (image, feature, value) of every number of a measurement output """
+    if kind == 'keyvalue' :
+        image = os.path.splitext(os.path.basename(path))[0]
+        with io.open(path, 'r', newline='') as f :
+            for ln in f :
+                fields = ln.rstrip('\r\n').split('\t')
+                if len(fields) != 2 :
+                    continue
+                feature, text = fields
+                if text.startswith('(') :   # Coordinate pairs, as measure.measurerows splits them
+                    for axis, part in zip(('X', 'Y'), text.strip('()').split(',')) :
+                        v = _Float(part)
+                        if v is not None :
+                            yield image, feature + '.' + axis, v
+                    continue
+                v = _Float(text)
+                if v is not None :
+                    yield image, feature, v
+    elif kind == 'measure' :
+        with io.open(path, 'r', newline='') as f :
+            for row in csv.DictReader(f) :
+                v = _Float(row.get('Value'))
+                if v is not None :
+                    yield row['Image'], row['Feature'], v
+    elif kind == 'long' :
+        with io.open(path, 'r', newline='') as f :
+            for row in csv.DictReader(f) :
+                v = _Float(row.get('Value'))
+                if v is None :
+                    continue
+                # Point pair labels share their feature: 'line Consecutive', 'line Nonconsecutive'
+                label = row.get('Label') or ''
+                feature = row['Type'] + ' ' + label.split(':')[0] if ':' in label else row['Type']
+                yield row['Image Name'], feature, v
+    elif kind == 'proc' :
+        image, prefix = os.path.basename(path)[:-len('_proc.csv')], ''
+        for role in Roles :     # <image>_<role>.csv of BatchMitoAnalysis segmentation
+            if image.endswith('_' + role) :
+                image, prefix = image[:-len(role) - 1], role + ' '
+        dialect, offset = SeekCsvDialect(path)
+        with io.open(path, 'r', newline='') as f :
+            f.seek(offset)
+            for row in csv.DictReader(f, dialect=dialect) :
+                for feature, text in row.items() :
+                    if feature is None or feature in LabelFields :
+                        continue
+                    v = _Float(text)
+                    if v is not None :
+                        yield image, prefix + feature, v
+
+def _GroupKey(condition, feature) :
+    """ JSON key of a (condition, feature) group """
+    return condition + '|' + feature
+
+def FilePartial(path, kind, condition=ImageCondition, images=None) :
+    """ Statistics of one output file per (condition, feature) group; images, if given, collects its image names """
+    partial = {}
+    for image, feature, v in OutputValues(path, kind) :
+        if images is not None :
+            images.add(image)
+        key = _GroupKey(condition(image), feature)
+        stats = partial.get(key)
+        if stats is None :
+            stats = partial[key] = NewStats()
+        AddValue(stats, v)
+    return partial
+
+def LoadAggregate(path) :
+    """ Read the aggregate index, empty if missing or unreadable """
+    agg = {'Path' : path, 'Files' : {}}
+    if os.path.isfile(path) :
+        try :
+            with open(path, 'r') as f :
+                agg['Files'] = json.load(f)
+        except ValueError :
+            print "Aggregate index %s is corrupted, rebuilding it" % path
+    return agg
+
+def SaveAggregate(agg) :
+    """ Write the aggregate index atomically """
+    with open(agg['Path'] + '.tmp', 'w') as f :
+        json.dump(agg['Files'], f, sort_keys=True)
+    if os.path.exists(agg['Path']) :
+        os.remove(agg['Path'])
+    os.rename(agg['Path'] + '.tmp', agg['Path'])
+
+def UpdateAggregate(agg, directory, condition=ImageCondition) :
+    """ Ingest the new and changed outputs of a directory, forget the removed ones
+
+    Returns the counts of (added, changed, removed) files.
+    """
+    seen = set()
+    added = changed = 0
+    for path, dirs, files in os.walk(directory) :
+        for fn in sorted(files) :
+            if not fn.endswith('.csv') or fn == SummaryName :
+                continue
+            fnpath = os.path.abspath(os.path.join(path, fn))
+            st = os.stat(fnpath)
+            stamp = [st.st_size, int(st.st_mtime)]
+            entry = agg['Files'].get(fnpath)
+            seen.add(fnpath)
+            if entry is not None and entry['Stamp'] == stamp and 'Images' in entry :
+                continue
+            kind = OutputKind(fnpath)
+            images = set()
+            partial = FilePartial(fnpath, kind, condition, images) if kind is not None else {}
+            agg['Files'][fnpath] = {'Stamp' : stamp, 'Kind' : kind, 'Partial' : partial, 'Images' : sorted(images)}
+            if entry is None :
+                added += 1
+            else :
+                changed += 1
+    top = os.path.abspath(directory)
+    removed = [fnpath for fnpath in agg['Files'] if fnpath.startswith(top) and fnpath not in seen]
+    for fnpath in removed :
+        del agg['Files'][fnpath]
+    return added, changed, len(removed)
+
+def _ImageStem(image) :
+    """ Image name up to its first dot, as measure.py names the key/value file of an image """
+    return os.path.basename(image).split('.')[0]
+
+def AggregateTotals(agg) :
+    """ Merge the file partials into {(condition, feature) : stats}, with AllConditions per feature
+
+    Key/value files of images already in a measure table of their directory
+    are left out, so no image is counted twice.
+    """
+    measured = set((os.path.dirname(fnpath), _ImageStem(image)) for fnpath, entry in agg['Files'].items()
+                   if entry['Kind'] == 'measure' for image in entry.get('Images', []))
+    totals = {}
+    for fnpath, entry in agg['Files'].items() :
+        if entry['Kind'] == 'keyvalue' and (os.path.dirname(fnpath), _ImageStem(fnpath)) in measured :
+            continue
+        for key, part in entry['Partial'].items() :
+            condition, feature = key.split('|', 1)
+            for group in ((condition, feature), (AllConditions, feature)) :
+                if group not in totals :
+                    totals[group] = NewStats()
+                MergeStats(totals[group], part)
+    return totals
+
+def WriteAggregateSummary(totals, csvpath) :
+    """ Write one row per condition and feature """
+    fields = ['Condition', 'Feature', 'Count', 'Mean', 'Variance', 'Std', 'Min', 'Max'] + \
+             ['Q%02d' % int(round(q * 100)) for q in Quantiles]
+    with open(csvpath, 'w') as out :
+        writer = csv.DictWriter(out, fieldnames=fields, dialect='excel')
+        writer.writeheader()
+        for condition, feature in sorted(totals.keys()) :
+            row = StatsSummary(totals[(condition, feature)])
+            row['Condition'], row['Feature'] = condition, feature
+            writer.writerow(row)
+
+def main() :
+    import argparse
+    parser = argparse.ArgumentParser(description='Update the cross-image statistics of a data directory')
+    parser.add_argument('directory')
+    parser.add_argument('--summary', help='summary CSV, %s in the directory by default' % SummaryName)
+    args = parser.parse_args()
+
+    agg = LoadAggregate(os.path.join(args.directory, AggregateName))
+    added, changed, removed = UpdateAggregate(agg, args.directory)
+    SaveAggregate(agg)
+    summarypath = args.summary or os.path.join(args.directory, SummaryName)
+    WriteAggregateSummary(AggregateTotals(agg), summarypath)
+    print "%d files added, %d changed, %d removed; summary written to %s" % (added, changed, removed, summarypath)
+
+if __name__ == '__main__' :
+    main()
+
+###----EOF----
@@ -0,0 +1,108 @@
+""" Bounded worker pool for per-image batch processing """
+import threading
+try :
+    from java.lang import Throwable     # Java exceptions raised inside Fiji
+    _Errors = (Exception, Throwable)
+except ImportError :
+    _Errors = (Exception,)
+
+def MegaBytes(nbytes) :
+    """ Whole MB holding nbytes, rounded up so that small planes still reserve """
+    return -(-int(nbytes) // (1024 * 1024))
+
+class MemoryBudget(object) :
+    """ Weighted semaphore in MB shared by the workers of a batch """
+
+    def __init__(self, capacity) :
+        self.capacity = max(int(capacity), 1)
+        self.available = self.capacity
+        self.cond = threading.Condition()
+
+    def Acquire(self, mb) :
+        """ Block until mb (capped to the capacity) can be reserved, return the reservation """
+        mb = min(max(int(mb), 0), self.capacity)
+        self.cond.acquire()
+        try :
+            while self.available < mb :
+                self.cond.wait()
+            self.available -= mb
+        finally :
+            self.cond.release()
+        return mb
+
+    def Release(self, mb) :
+        """ Give back a reservation returned by Acquire """
+        self.cond.acquire()
+        try :
+            self.available += mb
+            self.cond.notifyAll()
+        finally :
+            self.cond.release()
+
+def DefaultMemoryBudget(fraction=0.75) :
+    """ Return a budget in MB from the JVM heap limit, or None outside the JVM """
+    try :
+        from java.lang import Runtime
+    except ImportError :
+        return None
+    return int(Runtime.getRuntime().maxMemory() * fraction / (1024 * 1024))
+
+def DefaultWorkers() :
+    """ Return the number of available processors """
+    try :
+        from java.lang import Runtime
+        return Runtime.getRuntime().availableProcessors()
+    except ImportError :
+        import multiprocessing
+        return multiprocessing.cpu_count()
+
+_Done = object()    # End of the items
+
+def RunBatch(items, func, workers=1, budget=None) :
+    """ Run func(item, budget) on a pool of workers
+
+    Returns one (item, result, error) tuple per item, in the order of items,
+    whatever order the workers finish in. A failing item records its error
+    and leaves the rest of the batch running. With workers=1 the items are
+    processed serially on the calling thread. items may be a generator
+    (e.g. Prefetch); it is consumed lazily, one item per idle worker.
+    """
+    results = []
+
+    def Run(i, item) :
+        try :
+            results[i] = (item, func(item, budget), None)
+        except _Errors as e :
+            results[i] = (item, None, e)
+
+    if workers <= 1 :
+        for i, item in enumerate(items) :
+            results.append(None)
+            Run(i, item)
+        return results
+
+    lock = threading.Lock()
+    pending = iter(items)
+    def Worker() :
+        while True :
+            lock.acquire()
+            try :
+                item = next(pending, _Done)
+                i = len(results)
+                if item is not _Done :
+                    results.append(None)
+            finally :
+                lock.release()
+            if item is _Done :
+                return
+            Run(i, item)
+
+    threads = [threading.Thread(target=Worker, name='BatchWorker-%d' % n) for n in range(max(workers, 1))]
+    for t in threads :
+        t.setDaemon(True)
+        t.start()
+    for t in threads :
+        t.join()
+    return results
+
+###----EOF----
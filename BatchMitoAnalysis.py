@@ -6,6 +6,19 @@ import math
 import glob
 import re
 import SIFT_Align as SA
+from    BatchExecutor   import      RunBatch, MemoryBudget, DefaultMemoryBudget, DefaultWorkers, MegaBytes
+from    ImageSource     import      OpenImageSession, CloseSession, GetRawMeta, MetaHandles, ReadPlane
+from    ImageSource     import      MetaPlaneSize, ReadTile, EvictPlanes
+from    ChannelRoles    import      ChannelRoles, DefaultRoleRules, LoadRoleRules
+from    Tiles           import      TileGrid
+from    Coloc           import      NewColoc, AddPlanes, FinishColoc, ColocFields
+from    Segmentation    import      SegmentChannel, WriteObjects, ThresholdMethods
+from    ImageSource     import      LoadMetaCache, SaveMetaCache, CachedMeta, StoreMeta
+from    Projection      import      ProjectPlanes, ProjectionMethods
+from    Prefetch        import      Prefetch
+from    PlaneCache      import      OpenPlaneCache, SavePlaneCache, PlaneKey, CachedTiles
+from    Trace           import      Stage, EnableTrace, DisableTrace, WriteTrace, PrintSummary
+from    Journal         import      JournalPath, LoadJournal, NeedsProcessing, Record, JournalResult
 from    ij  import IJ
 from    ij  import WindowManager as WM 
 from    ij  import ImagePlus as IP
@@ -14,79 +27,237 @@ from    ij.plugin.frame import      RoiManager      as RM
 from    ij.gui          import      ShapeRoi
 from    ij.process      import      ImageConverter  as IC
 
-def GetRawMeta(imgpath) : 
-    """ Parse image OME-XML metadata """
-    from loci.formats import ImageReader
-    from loci.formats import MetadataTools
-
-    reader = ImageReader()
-    OMEMeta = MetadataTools.createOMEXMLMetadata()
-    reader.setMetadataStore(OMEMeta)
-    reader.setId(imgpath)
-    metadict = {}
-    metadict['ImageCount']  =   int(OMEMeta.getImageCount())
-    metadict['PixelSize']   =   float(OMEMeta.getPixelsPhysicalSizeX(0).value())
-    metadict['PixelSizeUnit']   =   OMEMeta.getPixelsPhysicalSizeX(0).unit().getSymbol()
-    metadict['ChannelCount']    =   int(OMEMeta.getChannelCount(0))
-
-    return metadict
-
-def ImageBioFormatsImporter(imgpath) : 
-    """ Import raw data with Bio-formats plugin """
-    from loci.plugins import BF
-    from loci.plugins.in import ImporterOptions as IO
-
-    opt = IO()
-    opt.setOpenAllSeries(True)  # Open all series
-    opt.setColorMode(IO.COLOR_MODE_COLORIZED)   # Open as colorized
-    opt.setShowOMEXML(False)
-    opt.setStitchTiles(False)
-    opt.setId(imgpath)
-    opt.setSplitChannels(True)  # Split channel
-    images = BF.openImagePlus(opt)
-
-    return images
-
-def GetLutColor(imp) : 
-    """ Get color from image object """
-    s = imp.getLuts()[0].toString()
-    f = re.search('rgb\[255\]=(\w+)', s)
-    if f is not None : 
-        color = f.groups()[0]
-    else : 
-        color = None
-    
-    return color 
-
-def AreRoisOverlapped(roi1, roi2) : 
-    """Check if roi1 and roi2 are overlapped"""
-    if len(roi1.containedPoints) >= len(roi2.containedPoints) :
-        broi, sroi = roi1, roi2
-    else :
-        broi, sroi = roi2, roi1
-    for pt in sroi.containedPoints :
-        if broi.containsPoint(pt.x, pt.y) :
-            rslt = True
-            break
-    else :
-        rslt = False
-    return rslt
-
-def SeekCsvDialect(fn) :
-    """Seek dialect in the file and return the dialect"""
-    first100lns = [ln for i, ln in enumerate(io.open(fn, 'r', newline='')) if i < 100]
-    dlist = []
-    offset = 0
-    for ln in first100lns :
-        dialect = csv.Sniffer().sniff(ln)
-        dlist.append((offset, dialect))
-        offset += len(ln)
-    target = dlist[-1][1].delimiter
-    for offset, dialect in dlist : 
-        if dialect.delimiter == target : 
-            break 
-    return dialect, offset
+# Bump when the analysis changes its results, so every image is processed again
+AnalysisVersion = 3
 
+def ClassifyChannels(handles, roles) : 
+    """ Sort lazy plane handles into Mitochondria, Dapi and Flag by the role of their channel
+
+    roles holds the role of every channel index (ChannelRoles). Returns one
+    ((series, t), classified) per series and time point, in order, where
+    each role maps to the z-ordered handles of its channel, a single handle
+    for single-plane images; channels without a role are left out.
+    """
+    channels = {}
+    for handle in handles :
+        channels.setdefault((handle['Series'], handle['T'], handle['Channel']), []).append(handle)
+    positions = {}
+    for key in sorted(channels.keys()) :
+        zhandles = sorted(channels[key], key=lambda h : h['Z'])
+        if roles[key[2]] is not None : 
+            positions.setdefault(key[:2], {})[roles[key[2]]] = zhandles
+    return sorted(positions.items())
+
+def ChannelPlane(session, zhandles, method='max') : 
+    """ Return the plane of a channel, z-projected plane by plane for stacks """
+    if len(zhandles) == 1 : 
+        return ReadPlane(session, zhandles[0])
+    return ProjectPlanes((ReadPlane(session, h) for h in zhandles), method)
+
+def ChannelTiles(session, zhandles, method='max') : 
+    """ Return a tile reader of a channel for Tiles.TiledObjects, z-projected tile by tile for stacks """
+    def readtile(tile) : 
+        if len(zhandles) == 1 : 
+            return ReadTile(session, zhandles[0], tile)
+        return ProjectPlanes((ReadTile(session, h, tile) for h in zhandles), method)
+    return readtile
+
+def ChannelMaxValue(imgmeta) : 
+    """ Largest integer pixel value, None for float (or 32-bit) data whose range is read from the pixels """
+    bits = imgmeta.get('BitsPerPixel', 16)
+    return (1 << bits) - 1 if bits <= 16 else None
+
+def HandleTiles(session, handle) : 
+    """ Tile reader of one plane, through the session's plane cache when it has one (tiles read twice) """
+    readtile = lambda tile : ReadTile(session, handle, tile)
+    if session.get('PlaneCache') is None : 
+        return readtile
+    return CachedTiles(session['PlaneCache'], PlaneKey(session['FileKey'], handle), readtile)
+
+def ChannelColoc(session, handles1, handles2, maxvalue, tiles=None, budget=None) : 
+    """ Pixel colocalization of two channels, accumulated z-plane by z-plane and tile by tile
+
+    maxvalue None stands for float data: the largest value of both channels
+    is found first, by one more pass over the planes or tiles.
+    """
+    continuous = maxvalue is None
+    tilereader = HandleTiles if continuous else (lambda session, h : lambda tile : ReadTile(session, h, tile))
+    pairs = [(tilereader(session, h1), tilereader(session, h2), h1, h2) for h1, h2 in zip(handles1, handles2)]
+    if continuous : 
+        maxvalue = 0.0
+        for read1, read2, h1, h2 in pairs : 
+            if tiles is None : 
+                ips = (ReadPlane(session, h) for h in (h1, h2))
+            else : 
+                ips = (read(tile) for tile in tiles for read in (read1, read2))
+            for ip in ips : 
+                ip.resetMinAndMax()
+                maxvalue = max(maxvalue, ip.getMax())
+    coloc = NewColoc(maxvalue, maxvalue, continuous=continuous)
+    for read1, read2, h1, h2 in pairs : 
+        if tiles is None : 
+            AddPlanes(coloc, ReadPlane(session, h1), ReadPlane(session, h2))
+            continue
+        for tile in tiles : 
+            reserved = 0
+            if budget is not None : 
+                # Both tiles as read (4 bytes per pixel at most) and their float copies
+                reserved = budget.Acquire(MegaBytes(tile['Width'] * tile['Height'] * 16))
+            try : 
+                AddPlanes(coloc, read1(tile), read2(tile))
+            finally : 
+                if budget is not None : 
+                    budget.Release(reserved)
+    return FinishColoc(coloc)
+
+# Channels segmented automatically, each into <image>_<role>.zip and .csv
+SegmentedRoles = ['Mitochondria', 'Flag', 'Dapi']
+
+def SegmentRoles(session, imgmeta, fnpath, method, projection='max', tilesize=0, budget=None, suffix='') : 
+    """ Segment every channel role, write its rois and objects, return the object counts and the files
+
+    The files are <image><suffix>_<role>.zip and .csv.
+
+    Tiled channels are read more than once (threshold, then labelling); with
+    a plane cache the projected tiles are kept in it, otherwise every read
+    decodes again. Sum projections of stacks exceed the bit depth, so they
+    are thresholded over their data range like float data.
+    """
+    counts, outputs = {}, []
+    width, height = imgmeta['Width'], imgmeta['Height']
+    for role in SegmentedRoles : 
+        if role not in imgmeta['Images'] : 
+            continue
+        zhandles = imgmeta['Images'][role]
+        maxvalue = ChannelMaxValue(imgmeta) if projection != 'sum' or len(zhandles) == 1 else None
+        if tilesize : 
+            readtile = ChannelTiles(session, zhandles, projection)
+            if session.get('PlaneCache') is not None : 
+                # Keyed by the planes projected, not the role, which role rules can move to another channel
+                prefix = '%s-n%d-%s' % (PlaneKey(session['FileKey'], zhandles[0]), len(zhandles), projection)
+                readtile = CachedTiles(session['PlaneCache'], prefix, readtile)
+        else : 
+            plane = ChannelPlane(session, zhandles, projection)
+            readtile = lambda tile : plane
+        with Stage('SegmentChannel') : 
+            threshold, objects = SegmentChannel(readtile, width, height, maxvalue, method, tilesize, budget=budget)
+        stem = os.path.splitext(fnpath)[0] + suffix + '_' + role
+        with Stage('WriteObjects') : 
+            WriteObjects(objects, stem + '.zip', stem + '.csv')
+        EvictPlanes(session)    # The next role reads other planes
+        counts[role + 'Threshold'] = threshold
+        counts[role + 'Objects'] = len(objects)
+        outputs.extend([stem + '.zip', stem + '.csv'])
+    return counts, outputs
+
+# Columns of the per-image batch summary
+SummaryFields = ['Image', 'Path', 'Series', 'T', 'ImageCount', 'ChannelCount', 'ZPlanes', 'PixelSize', 'PixelSizeUnit', 'Channels',
+                 'Width', 'Height', 'Tiles'] + ColocFields + \
+                [role + k for role in SegmentedRoles for k in ('Threshold', 'Objects')]
+
+def ProcessImage(item, budget=None, metacache=None, projection='max', tilesize=0, coloc=True, segmentation=None,
+                 session=None, rules=DefaultRoleRules, profiles=None) : 
+    """ Parse metadata, import and classify the channels of one image, return its summary rows and output files
+
+    Every series and time point of the file is analyzed on its own and gets
+    its own summary row; the segmentation files of multi-position files are
+    named <image>_s<series>_t<t>_<role>.
+    session may be opened ahead by the caller (Prefetch); it is closed here.
+    profiles is the channel role cache of the run (ChannelRoles).
+    """
+    fn, fnpath = item
+    print "Processing image %s..." % fn
+
+    # Retrieve OME-XML Metadata, from the cache when the file is unchanged
+    imgmeta = CachedMeta(metacache, fnpath)
+    if imgmeta is None : 
+        if session is None : 
+            session = OpenImageSession(fnpath)
+        imgmeta = GetRawMeta(session)
+        StoreMeta(metacache, fnpath, imgmeta)
+
+    # Reserve the decoded planes a session keeps at once. Planes larger than a tile
+    # are processed tile by tile, and each tile reserves its own share of the budget
+    planebytes = imgmeta.get('PlaneByteCount', imgmeta['ByteCount'])
+    tiled = tilesize > 0 and planebytes > tilesize * tilesize * 4
+    reserved = 0
+    if budget is not None and not tiled : 
+        floatbytes = 4 * imgmeta['SeriesSizes'][0][0] * imgmeta['SeriesSizes'][0][1]
+        needed = planebytes
+        if coloc :  # A plane of both channels and their float copies
+            needed = max(needed, 2 * (planebytes + floatbytes))
+        if segmentation is not None :   # A decoded z-plane, its float copy, the projection and the thresholded copy
+            needed = max(needed, planebytes + 3 * floatbytes)
+        reserved = budget.Acquire(MegaBytes(needed))
+    try : 
+        # Plane handles from the metadata, decoded only when a stage reads them; the
+        # header of a file of cached metadata is parsed only if a plane is not in the
+        # plane cache. Stacks are z-projected on the fly by ChannelPlane, or per tile by ChannelTiles
+        if session is None : 
+            session = OpenImageSession(fnpath, lazy=True)
+        # Channel roles from the metadata, once per acquisition profile; channels
+        # without a role get no plane handles and are never decoded
+        with Stage('ClassifyChannels') : 
+            roles = ChannelRoles(imgmeta['ChannelInfo'], rules, profiles)
+        if not any(roles) : 
+            raise Exception("No channel of %s matches a role" % fn)
+        with Stage('PlaneHandles') : 
+            handles = MetaHandles(imgmeta, [c for c, role in enumerate(roles) if role is not None])
+        positions = ClassifyChannels(handles, roles)
+        if len(positions) > 1 : 
+            print "Image %s holds %d series and time points, each is analyzed on its own" % (fn, len(positions))
+
+        rows, outputs = [], []
+        for (series, t), images in positions : 
+            posmeta = dict(imgmeta)
+            posmeta['Series'], posmeta['T'] = series, t
+            posmeta['Images'] = images
+            posmeta['ZPlanes'] = max(len(zhandles) for zhandles in images.values())
+            posmeta['Width'], posmeta['Height'] = MetaPlaneSize(imgmeta, images.values()[0][0])
+            posmeta['Tiles'] = len(TileGrid(posmeta['Width'], posmeta['Height'], tilesize)) if tiled else 1
+
+            row = dict((k, posmeta[k]) for k in SummaryFields if k in posmeta)
+            row['Image'], row['Path'] = fn, fnpath
+            row['Channels'] = ';'.join(sorted(images.keys()))
+
+            # Pixel colocalization of the Mitochondria and Flag channels, over every z-plane
+            if coloc and 'Mitochondria' in images and 'Flag' in images : 
+                tiles = TileGrid(posmeta['Width'], posmeta['Height'], tilesize) if tiled else None
+                maxvalue = ChannelMaxValue(posmeta)
+                with Stage('Colocalization') : 
+                    row.update(ChannelColoc(session, images['Mitochondria'], images['Flag'], maxvalue, tiles, budget))
+                EvictPlanes(session)
+
+            # Automatic segmentation of the channels into roi sets, on the z-projection for stacks
+            if segmentation is not None : 
+                suffix = '_s%d_t%d' % (series, t) if len(positions) > 1 else ''
+                with Stage('Segmentation') : 
+                    counts, files = SegmentRoles(session, posmeta, fnpath, segmentation, projection,
+                                                 tilesize if tiled else 0, budget if tiled else None, suffix)
+                row.update(counts)
+                outputs.extend(files)
+            rows.append(row)
+    finally : 
+        if session is not None : 
+            CloseSession(session)
+        if budget is not None : 
+            budget.Release(reserved)
+
+    return rows, outputs
+
+def WriteSummary(outpath, results) : 
+    """ Write the rows of every image, in input order, and report the failed images """
+    failed = 0
+    with open(outpath, 'w') as out : 
+        writer = csv.DictWriter(out, fieldnames=SummaryFields, dialect='excel')
+        writer.writeheader()
+        for item, rows, error in results : 
+            if error is not None : 
+                print "Image %s failed: %s" % (item[0], error)
+                failed += 1
+            else : 
+                writer.writerows(rows or [])
+    return failed
 
 def main() : 
 
@@ -96,123 +267,114 @@ def main() :
     gui.addDirectoryField('Image directory : ', os.environ['HOME'], 25)
     gui.addChoice('Image type : ', ['tif', 'tiff', 'czi'], 'czi')
     gui.addStringField('Project title', 'image')
+    gui.addNumericField('Parallel workers : ', DefaultWorkers(), 0)
+    gui.addNumericField('Memory budget (MB) : ', DefaultMemoryBudget(), 0)
+    gui.addNumericField('Tile size (pixels, 0 = whole planes) : ', 0, 0)
+    gui.addChoice('Z projection : ', ProjectionMethods, 'max')
+    gui.addCheckbox('Pixel colocalization (Mitochondria / Flag)', True)
+    gui.addChoice('Segmentation : ', ['None'] + ThresholdMethods, 'None')
+    gui.addNumericField('Prefetched images : ', 2, 0)
+    gui.addNumericField('Decoded plane cache (MB, 0 = off) : ', 0, 0)
+    gui.addCheckbox('Write stage timing trace', False)
     gui.showDialog() 
     if gui.wasOKed():
         imgdir = gui.getNextString()
         project = gui.getNextString()
-        suffix = gui.getChoices().lastElement().getSelectedItem()
+        suffix = gui.getNextChoice()
+        workers = int(gui.getNextNumber())
+        budget = MemoryBudget(gui.getNextNumber())
+        tilesize = int(gui.getNextNumber())
+        projection = gui.getNextChoice()
+        coloc = gui.getNextBoolean()
+        segmentation = gui.getNextChoice()
+        segmentation = None if segmentation == 'None' else segmentation
+        depth = int(gui.getNextNumber())
+        planecache = gui.getNextNumber()
+        trace = gui.getNextBoolean()
+        RunAnalysis(imgdir, project, suffix, workers, budget, tilesize, projection, coloc, segmentation, depth,
+                    trace=trace, planecache=planecache)
+
+def RunAnalysis(imgdir, project='image', suffix='czi', workers=1, budget=None, tilesize=0, projection='max',
+                coloc=True, segmentation=None, depth=2, images=None, trace=False, planecache=0,
+                roles=None) : 
+    """ Process the images of a directory and write the batch summary, return its path
+
+    images, if given, restricts the batch to these files of the directory.
+    With trace, the time, CPU, heap and decoded bytes of every stage of every
+    image are written to <project>_trace.json and summed up in a table.
+    planecache is the size in MB of the decoded plane cache in <imgdir>/.planecache,
+    so runs with other parameters do not decode the same planes again.
+    roles is a JSON file of channel role rules (ChannelRoles), by default
+    <imgdir>/channel_roles.json when it exists.
+    """
+    if trace : 
+        EnableTrace()
+    if budget is not None and not isinstance(budget, MemoryBudget) : 
+        budget = MemoryBudget(budget)
+    selected = None if images is None else set(os.path.abspath(fn) for fn in images)
     fndict = {} 
     for path, directory, files in os.walk(imgdir) : 
         for fn in files : 
-            if fn.endswith(suffix) : 
+            if fn.endswith(suffix) and (selected is None or os.path.abspath(os.path.join(path, fn)) in selected) : 
                 fndict[fn] = os.path.join(path, fn)
 
-    # Start process images
-    print "%d images will be processed" % len(fndict)
-
-    for fn, fnpath in fndict.items() : 
-        
-        print "Processing image %s..." % fn
-
-        # Retrieve OME-XML Metadata
-        imgmeta = GetRawMeta(fnpath)
-
-        # Import image. If image stack, perform alignment and z-objection
-        images = ImageBioFormatsImporter(fnpath)
-        imgmeta['Images'] = {}
-        for img in images :
-            if img.getStackSize() == 1 : 
-
-                if GetLutColor(img) == 'red' : 
-                    imgmeta['Images']['Mitochondria'] = img
-                elif GetLutColor(img) == 'blue' : 
-                    imgmeta['Images']['Dapi'] = img
-                elif GetLutColor(img) == 'green' : 
-                    imgmeta['Images']['Flag'] = img
-                else : 
-                    imgmeta['Images']['Unknown'] = img
+    # Only new, changed or failed images, or those processed with other parameters
+    journal = LoadJournal(JournalPath(imgdir))
+    params = {'projection' : projection, 'coloc' : coloc, 'segmentation' : segmentation,
+              'version' : AnalysisVersion}     # Tiling does not change the results
+    if roles is None and os.path.isfile(os.path.join(imgdir, 'channel_roles.json')) : 
+        roles = os.path.join(imgdir, 'channel_roles.json')
+    rules = LoadRoleRules(roles) if roles is not None else DefaultRoleRules
+    if rules != DefaultRoleRules : 
+        params['roles'] = rules
+    items = sorted(fndict.items())
+    todo = [item for item in items if NeedsProcessing(journal, 'BatchMitoAnalysis', os.path.abspath(item[1]), [item[1]], params)]
 
-            else : 
-                idang 
-
-
-        print dir(images[0])
-        print images[0].getStackSize()
-        print images.getStackSize()
-
-        
-        # Define cell boundary
-#        IC(imgmeta['Images']['Dapi']).convertToGray8()
-#        imgmeta['Images']['Dapi'].show()
-
-## Co-localization analysis
-#rm = RoiManager.getInstance()
-#rm.runCommand('Reset')
-#rm.runCommand('Open', PathToMitoRois)
-#mito_list = [roi for roi in rm.getRoisAsArray()]
-#rm.runCommand('Reset')
-#rm.runCommand('Open', PathToFlagRois)
-#flag_list = [roi for roi in rm.getRoisAsArray()]
-#rm.runCommand('Reset')
-#mito_dict = {}
-#flag_dict = dict.fromkeys([roi.getName() for roi in flag_list], None)
-#for mitoroi in mito_list : 
-#    k = ''.join(mitoroi.getName().split())
-#    vlist = []
-#    for flagroi in flag_list : 
-#        flaglabel = flagroi.getName()
-#        if AreRoisOverlapped(mitoroi, flagroi) : 
-#            vlist.append(flaglabel)
-#            flag_list.remove(flagroi)
-#    mito_dict[k] = vlist
-#for k, vlist in mito_dict.items() : 
-#    for flaglabel in vlist : 
-#        flag_dict[flaglabel] = k
-#
-## Write out
-#mitomeasurement = []
-#dial, offset = SeekCsvDialect(PathToMitoCSV)
-#mitomeasurementfieldnames = []
-#with io.open(PathToMitoCSV, 'r', newline='') as mitocsv : 
-#    mitocsv.seek(offset)
-#    csv.register_dialect('local', dial)
-#    dictreader = csv.DictReader(mitocsv, dialect='local')
-#    mitomeasurementfieldnames = [name for name in dictreader.fieldnames]
-#    for row in dictreader : 
-#        k = ''.join(row['Mito #'].split())
-#        row.update(ColocalizedRois = len(mito_dict[k]))
-#        mitomeasurement.append(row)
-#mitomeasurementfieldnames.append('ColocalizedRois')
-#
-#flagmeasurement = []
-#dial, offset = SeekCsvDialect(PathToFlagCSV)
-#flagmeasurementfieldnames = []
-#with io.open(PathToFlagCSV, 'r', newline='') as flagcsv : 
-#    flagcsv.seek(offset)
-#    csv.register_dialect('local', dial)
-#    dictreader = csv.DictReader(flagcsv, dialect='local')
-#    flagmeasurementfieldnames = [name for name in dictreader.fieldnames]
-#    for row in dictreader : 
-#        row.update(ColocalizedMito = flag_dict[row['Label']])
-#        flagmeasurement.append(row)
-#flagmeasurementfieldnames.append('ColocalizedMito')
-#
-#newmitocsvname = os.path.splitext(PathToMitoCSV)[0] + '_proc.csv'
-#with open(newmitocsvname, 'w') as out : 
-#    writer = csv.DictWriter(out, fieldnames=mitomeasurementfieldnames, dialect='excel')
-#    writer.writeheader()
-#    for mito in mitomeasurement : 
-#        writer.writerow(mito)
-#
-#newflagcsvname = os.path.splitext(PathToFlagCSV)[0] + '_proc.csv'
-#with open(newflagcsvname, 'w') as out : 
-#    writer = csv.DictWriter(out, fieldnames=flagmeasurementfieldnames, dialect='excel')
-#    writer.writeheader()
-#    for flag in flagmeasurement : 
-#        writer.writerow(flag)
-#print 'All complete! Hope you get a nice result.'
-#print '~~~ greeting from Jingqi ~~~'
+    # Start process images
+    print "%d images will be processed, %d are up to date" % (len(todo), len(items) - len(todo))
 
+    metacache = LoadMetaCache(os.path.join(imgdir, '.metacache.json'))
+    cache = OpenPlaneCache(os.path.join(imgdir, '.planecache'), planecache) if planecache > 0 else None
+    profiles = {}   # Channel roles of every acquisition profile of this run
+    def opensession(item) : 
+        # Files of cached metadata are parsed only when a plane has to be decoded
+        lazy = CachedMeta(metacache, item[1]) is not None
+        with Stage('Prefetch', item[0]) : 
+            return OpenImageSession(item[1], cache, lazy)
+    def process(prefetched, budget) : 
+        item, session, error = prefetched
+        key = os.path.abspath(item[1])
+        try : 
+            if error is not None : 
+                raise error
+            with Stage('Image', item[0]) : 
+                rows, outputs = ProcessImage(item, budget, metacache, projection, tilesize, coloc, segmentation, session,
+                                             rules, profiles)
+        except : 
+            Record(journal, 'BatchMitoAnalysis', key, [item[1]], params, [], 'failed')
+            raise
+        Record(journal, 'BatchMitoAnalysis', key, [item[1]], params, outputs, 'done', rows)
+        return rows
+    # Sessions of the next images are opened in the background while the current ones are processed
+    prefetched = Prefetch(todo, opensession, depth, max(1, min(workers, depth)), CloseSession)
+    try : 
+        done = dict((r[0][0], (r[0][0], r[1], r[2])) for r in RunBatch(prefetched, process, workers, budget))
+    finally : 
+        prefetched.close()  # Sessions opened ahead of a failure are closed
+    SaveMetaCache(metacache)
+    if cache is not None : 
+        SavePlaneCache(cache)
+    # Up-to-date images keep the summary rows of their last run
+    results = [done.get(item, (item, JournalResult(journal, 'BatchMitoAnalysis', os.path.abspath(item[1])), None)) for item in items]
+    summarypath = os.path.join(imgdir, project + '_summary.csv')
+    with Stage('WriteSummary') : 
+        failed = WriteSummary(summarypath, results)
+    print "%d images processed, %d failed" % (len(todo) - failed, failed)
+    if trace : 
+        tracepath = os.path.join(imgdir, project + '_trace.json')
+        PrintSummary(WriteTrace(tracepath, DisableTrace()))
+        print "Stage trace written to %s" % tracepath
+    return summarypath
 
 if __name__ == '__main__' : 
     main()
@@ -0,0 +1,259 @@
+""" Benchmarks of the hot paths on seeded synthetic data
+
+    python Benchmark.py --scale 1 --output baseline.json
+    python Benchmark.py --compare baseline.json
+
+Every benchmark runs over a size sweep on data from seeded generators
+(images, polygons, traced contours, mito/flag roi populations), so two runs
+of the same version measure the same work. Results are written as JSON
+baselines; --compare reports the sizes that got slower than a baseline.
+Runs in CPython and in Fiji's Jython; the benchmarks of ImageJ code paths
+(Projection) need Fiji and are skipped elsewhere.
+"""
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import tempfile
+import platform
+from RoiOverlap import ColocalizeRois
+from Coloc import NewColoc, AddPixels, FinishColoc
+from RoiRuns import EmptyRuns, AppendRun, FinishRuns, ClearRunsCache
+from Geometry import PolygonPairs
+from RegionProps import RegionProps
+from CsvTools import StreamAnnotateCsv
+from ResultsStore import OpenResults, AppendRows, CloseResults
+from Segmentation import RunsOutline, NewHistogram, AddHistogram, AutoThreshold
+from Tiles import TileGrid, TileRuns, MergeTileRuns
+
+# Synthetic data
+
+def SyntheticImage(rng, width, height, nblobs) :
+    """ Row-major pixels of a noisy background with bright disks """
+    pixels = [abs(rng.gauss(20.0, 6.0)) for i in range(width * height)]
+    for b in range(nblobs) :
+        cx, cy, r = rng.randrange(width), rng.randrange(height), rng.randint(2, 12)
+        for y in range(max(cy - r, 0), min(cy + r + 1, height)) :
+            for x in range(max(cx - r, 0), min(cx + r + 1, width)) :
+                if (x - cx) ** 2 + (y - cy) ** 2 <= r * r :
+                    pixels[y * width + x] = rng.gauss(180.0, 20.0)
+    return pixels
+
+def RandomPolygon(rng, n, cx=0.0, cy=0.0, radius=100.0) :
+    """ Star-shaped polygon of n vertices at increasing angles """
+    angles = sorted(rng.uniform(0, 2 * math.pi) for i in range(n))
+    radii = [radius * rng.uniform(0.5, 1.0) for i in range(n)]
+    return ([cx + r * math.cos(a) for a, r in zip(angles, radii)],
+            [cy + r * math.sin(a) for a, r in zip(angles, radii)])
+
+def DiskRuns(cx, cy, r) :
+    """ Runs of a digital disk, the shape of a traced blob """
+    runs = EmptyRuns()
+    for y in range(cy - r, cy + r + 1) :
+        half = int(math.sqrt(r * r - (y - cy) ** 2))
+        AppendRun(runs, y, cx - half, cx + half + 1)
+    return FinishRuns(runs)
+
+def TracedContour(rng, cx, cy, rmin=3, rmax=15) :
+    """ Pixel-edge outline of a random disk, as the Wand traces it """
+    return RunsOutline(DiskRuns(cx, cy, rng.randint(rmin, rmax)))
+
+def RoiPopulation(rng, n, width, height, name, centers=None, spread=10) :
+    """ Traced roi dictionaries of RoiCodec; placed near centers when given """
+    rois = []
+    for i in range(n) :
+        if centers :
+            cx, cy = rng.choice(centers)
+            cx, cy = cx + rng.randint(-spread, spread), cy + rng.randint(-spread, spread)
+        else :
+            cx, cy = rng.randrange(width), rng.randrange(height)
+        xs, ys = TracedContour(rng, cx, cy)
+        rois.append({'Type' : 'traced', 'Name' : '%s%05d' % (name, i + 1), 'X' : xs, 'Y' : ys})
+    return rois
+
+def MitoFlagRois(rng, nmito, nflag, width, height) :
+    """ A mito population and a flag population half of which sits on mitochondria """
+    mito = RoiPopulation(rng, nmito, width, height, 'Mito')
+    centers = [(int(sum(r['X']) / len(r['X'])), int(sum(r['Y']) / len(r['Y']))) for r in mito]
+    flag = RoiPopulation(rng, nflag // 2, width, height, 'Flag', centers) + \
+           RoiPopulation(rng, nflag - nflag // 2, width, height, 'Flag')
+    return mito, flag
+
+# Benchmarks, each returning a function to time on data of a given size;
+# files go to a scratch directory removed after the run
+
+def SetupColocalization(rng, size, tmpdir) :
+    mito, flag = MitoFlagRois(rng, size, size, 20 * size, 20 * size)
+    def Run() :
+        for roi in mito + flag :
+            roi.pop('Runs', None)   # Time the rasterization too
+        ColocalizeRois(mito, flag)
+        ClearRunsCache()
+    return Run
+
+def SetupPixelColocalization(rng, size, tmpdir) :
+    pixels1 = SyntheticImage(rng, size, size, size // 10)
+    pixels2 = [0.5 * v + rng.gauss(0.0, 10.0) for v in pixels1]
+    def Run() :
+        coloc = NewColoc(255, 255)
+        AddPixels(coloc, pixels1, pixels2)
+        FinishColoc(coloc)
+    return Run
+
+def SetupPairwiseDistances(rng, size, tmpdir) :
+    xs, ys = RandomPolygon(rng, size)
+    return lambda : PolygonPairs(xs, ys, 0.5)
+
+def SetupRegionMeasurement(rng, size, tmpdir) :
+    width = height = 512
+    pixels = SyntheticImage(rng, width, height, 50)
+    labelruns = [(i + 1, DiskRuns(rng.randrange(width), rng.randrange(height), rng.randint(3, 15)))
+                 for i in range(size)]
+    return lambda : RegionProps(pixels, width, height, labelruns)
+
+def SetupCsvJoin(rng, size, tmpdir) :
+    inpath = os.path.join(tmpdir, 'mito.csv')
+    with open(inpath, 'w') as f :
+        f.write(' ,Mito #,Area,Mean\n')
+        for i in range(size) :
+            f.write('%d,Mito%05d,%d,%.3f\n' % (i + 1, i + 1, rng.randint(10, 500), rng.uniform(0, 255)))
+    outpath = os.path.join(tmpdir, 'mito_proc.csv')
+    return lambda : StreamAnnotateCsv(inpath, outpath, ['ColocalizedRois'], lambda row : {'ColocalizedRois' : 1})
+
+def SetupResultsWriting(rng, size, tmpdir) :
+    columns = [['Image', 'str'], ['Feature', 'str'], ['Value', 'float']]
+    rows = [{'Image' : 'image%04d.tif' % (i // 100), 'Feature' : 'Feature%02d' % (i % 100), 'Value' : rng.random()}
+            for i in range(size)]
+    def Run() :
+        path = os.path.join(tmpdir, 'bench.results')
+        shutil.rmtree(path, True)
+        store = OpenResults(path, columns)
+        AppendRows(store, rows)
+        CloseResults(store)
+    return Run
+
+def SetupSegmentation(rng, size, tmpdir) :
+    # Threshold and tiled labelling of a size x size plane, as SegmentChannel runs them on the pixels
+    pixels = [min(int(v), 255) for v in SyntheticImage(rng, size, size, size // 8)]
+    tiles = TileGrid(size, size, 128)
+    def TilePixels(tile) :
+        return [v for y in range(tile['Y'], tile['Y'] + tile['Height'])
+                for v in pixels[y * size + tile['X']:y * size + tile['X'] + tile['Width']]]
+    tilepixels = [TilePixels(tile) for tile in tiles]  # The decoded tiles, read outside the timing
+    def Run() :
+        hist = NewHistogram(255)
+        for values in tilepixels :
+            AddHistogram(hist, values)
+        threshold = AutoThreshold(hist, 'Otsu')
+        objects = MergeTileRuns([TileRuns(values, tile, threshold) for tile, values in zip(tiles, tilepixels)])
+        return {'Tiles' : len(tiles), 'Objects' : len(objects)}
+    return Run
+
+def SetupProjection(rng, size, tmpdir) :
+    # Streamed ProjectPlanes against ZProjector on the fully loaded stack of size planes
+    from jarray import array as jarray
+    from ij.process import FloatProcessor
+    from Projection import BenchmarkProjection
+    width = height = 256
+    planes = [FloatProcessor(width, height, jarray(SyntheticImage(rng, width, height, 20), 'f'))
+              for i in range(4)]
+    readplane = lambda h : planes[h % len(planes)].duplicate()     # A fresh plane, as a decode returns
+    return lambda : BenchmarkProjection(readplane, range(size), 'max')
+
+Benchmarks = [
+    ('Colocalization',      SetupColocalization,    [100, 300, 1000]),
+    ('PixelColocalization', SetupPixelColocalization, [128, 256, 512]),
+    ('PairwiseDistances',   SetupPairwiseDistances, [10, 50, 200]),
+    ('RegionMeasurement',   SetupRegionMeasurement, [10, 100, 1000]),
+    ('CsvJoin',             SetupCsvJoin,           [1000, 10000, 100000]),
+    ('ResultsWriting',      SetupResultsWriting,    [1000, 10000, 100000]),
+    ('Segmentation',        SetupSegmentation,      [256, 512, 1024]),
+    ('Projection',          SetupProjection,        [8, 32, 128]),
+]
+
+def TimeIt(func, repeat=3) :
+    """ Best and median wall time of repeat calls, and the details func returned last, if any """
+    times = []
+    details = None
+    for i in range(repeat) :
+        t0 = time.time()
+        details = func()
+        times.append(time.time() - t0)
+    times.sort()
+    return times[0], times[len(times) // 2], details if isinstance(details, dict) else None
+
+def RunBenchmarks(scale=1.0, repeat=3, seed=1, names=None) :
+    """ Run the size sweeps and return a baseline dictionary """
+    baseline = {}
+    baseline['Python']      =   sys.version.split()[0]
+    baseline['Platform']    =   platform.platform()
+    baseline['Time']        =   time.strftime('%Y-%m-%d %H:%M:%S')
+    baseline['Scale']       =   scale
+    baseline['Seed']        =   seed
+    baseline['Results']     =   []
+    tmpdir = tempfile.mkdtemp()
+    try :
+        for name, setup, sizes in Benchmarks :
+            if names and name not in names :
+                continue
+            for size in sizes :
+                size = max(int(size * scale), 1)
+                try :
+                    func = setup(random.Random('%s-%d-%d' % (name, size, seed)), size, tmpdir)
+                except ImportError as e :
+                    print "%-20s skipped: %s" % (name, e)
+                    break
+                best, median, details = TimeIt(func, repeat)
+                rslt = {'Benchmark' : name, 'Size' : size, 'Best' : best, 'Median' : median}
+                if details is not None :
+                    rslt['Details'] = details
+                baseline['Results'].append(rslt)
+                print "%-20s %8d  best %.4f s  median %.4f s" % (name, size, best, median)
+                if details is not None :
+                    print "%-20s %8s  %s" % ('', '', ', '.join('%s %s' % kv for kv in sorted(details.items())))
+    finally :
+        shutil.rmtree(tmpdir, True)
+    return baseline
+
+def CompareBaselines(old, new, tolerance=0.1) :
+    """ Return (benchmark, size, old, new) for every size slower than tolerance relative to old """
+    previous = dict(((r['Benchmark'], r['Size']), r['Best']) for r in old['Results'])
+    slower = []
+    for r in new['Results'] :
+        before = previous.get((r['Benchmark'], r['Size']))
+        if before and r['Best'] > before * (1 + tolerance) :
+            slower.append((r['Benchmark'], r['Size'], before, r['Best']))
+    return slower
+
+def main() :
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the hot paths on synthetic data')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply every size of the sweeps')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--only', nargs='*', help='benchmarks to run')
+    parser.add_argument('--output', help='write the results as a JSON baseline')
+    parser.add_argument('--compare', help='baseline to report regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+
+    baseline = RunBenchmarks(args.scale, args.repeat, args.seed, args.only)
+    if args.output :
+        with open(args.output, 'w') as f :
+            json.dump(baseline, f, indent=1, sort_keys=True)
+    if args.compare :
+        with open(args.compare, 'r') as f :
+            old = json.load(f)
+        slower = CompareBaselines(old, baseline, args.tolerance)
+        for name, size, before, after in slower :
+            print "Slower: %s size %d, %.4f s -> %.4f s (%+.0f%%)" % (name, size, before, after, 100 * (after / before - 1))
+        if slower :
+            sys.exit(1)
+
+if __name__ == '__main__' :
+    main()
+
+###----EOF----
@@ -0,0 +1,94 @@
+""" Channel roles from OME metadata, resolved once per acquisition profile
+
+A channel is described by its name, fluor, emission wavelength and color
+(ImageSource.ChannelInfos). Rules map these to the roles of the analysis:
+the names and fluors of all channels are matched first, then the emission
+wavelengths, then the colors, so a channel named 'GFP' is a Flag channel
+whatever LUT the microscope gave it. Files acquired with the same settings
+share one profile, and its roles are resolved only once per run: the run
+owns the profile cache, so concurrent runs share nothing.
+
+Rules can be replaced by a JSON file holding a list of
+{"Role" : ..., "Names" : regex, "Emission" : [min nm, max nm], "Colors" : [...]}.
+"""
+import re
+import json
+
+DefaultRoleRules = [
+    {'Role' : 'Dapi',           'Names' : r'dapi|hoechst',
+     'Emission' : [420, 490],   'Colors' : ['blue']},
+    {'Role' : 'Flag',           'Names' : r'flag|gfp|fitc|(alexa\s*fluor|af)\s*-?\s*488',
+     'Emission' : [495, 560],   'Colors' : ['green']},
+    {'Role' : 'Mitochondria',   'Names' : r'mito|tom\s*-?\s*20|tmrm|cy3|(alexa\s*fluor|af)\s*-?\s*(555|568|594)',
+     'Emission' : [560, 680],   'Colors' : ['red']},
+]
+
+def LoadRoleRules(path) :
+    """ Read role rules from a JSON file """
+    with open(path, 'r') as f :
+        rules = json.load(f)
+    for rule in rules :
+        if 'Role' not in rule :
+            raise Exception("Role rule without a Role in %s: %s" % (path, rule))
+    return rules
+
+def _NameRole(info, rules) :
+    """ Role of the first rule matching the channel name or fluor """
+    text = ' '.join(v for v in (info.get('Name'), info.get('Fluor')) if v)
+    for rule in rules :
+        if text and rule.get('Names') and re.search(rule['Names'], text, re.IGNORECASE) :
+            return rule['Role']
+    return None
+
+def _EmissionRole(info, rules) :
+    """ Role of the first rule whose emission range holds the channel wavelength """
+    wavelength = info.get('Emission')
+    for rule in rules :
+        if wavelength is not None and rule.get('Emission') and rule['Emission'][0] <= wavelength <= rule['Emission'][1] :
+            return rule['Role']
+    return None
+
+def _ColorRole(info, rules) :
+    """ Role of the first rule listing the channel color """
+    for rule in rules :
+        if info.get('Color') in rule.get('Colors', []) :
+            return rule['Role']
+    return None
+
+def ResolveRoles(infos, rules=DefaultRoleRules) :
+    """ Return the role of every channel, None for channels of no role
+
+    Every role goes to one channel; the strongest evidence (name, then
+    emission, then color) wins, then the lowest channel.
+    """
+    roles = [None] * len(infos)
+    taken = set()
+    for match in (_NameRole, _EmissionRole, _ColorRole) :
+        for c, info in enumerate(infos) :
+            if roles[c] is not None :
+                continue
+            role = match(info, rules)
+            if role is not None and role not in taken :
+                roles[c] = role
+                taken.add(role)
+    return roles
+
+def ProfileKey(infos) :
+    """ Acquisition profile of a file: the metadata of all its channels """
+    return json.dumps(infos, sort_keys=True)
+
+def ChannelRoles(infos, rules=DefaultRoleRules, profiles=None) :
+    """ Return the role of every channel, resolved once per acquisition profile and rule set
+
+    profiles is the cache of a run, {(rules, profile) : roles}; two threads
+    missing the same profile both resolve it, to the same roles.
+    """
+    if profiles is None :
+        return ResolveRoles(infos, rules)
+    key = (json.dumps(rules, sort_keys=True), ProfileKey(infos))
+    roles = profiles.get(key)
+    if roles is None :
+        roles = profiles[key] = ResolveRoles(infos, rules)
+    return list(roles)
+
+###----EOF----
@@ -0,0 +1,145 @@
+""" Streaming pixel colocalization coefficients of two channels
+
+Planes (or tiles) of the two channels are added one pair at a time. Running
+sums give Pearson's r and Manders M1/M2 exactly; a joint histogram of the
+two channels gives the Costes automatic thresholds and the thresholded
+Manders coefficients, so joint pixel arrays are never built.
+"""
+import math
+
+ColocFields = ['Pearson', 'M1', 'M2', 'CostesThreshold1', 'CostesThreshold2', 'PearsonBelowThreshold', 'tM1', 'tM2']
+
+def NewColoc(maxvalue1, maxvalue2, bins=256, continuous=False) :
+    """ Start accumulating; pixel values of channel k are binned over [0, maxvaluek]
+
+    Integer values get bins of at least one value; continuous (float)
+    values are binned over [0, maxvaluek] as they are.
+    """
+    coloc = {}
+    coloc['Bins']   =   bins
+    if continuous :
+        coloc['Width1'] =   float(maxvalue1) / bins if maxvalue1 > 0 else 1.0
+        coloc['Width2'] =   float(maxvalue2) / bins if maxvalue2 > 0 else 1.0
+    else :
+        coloc['Width1'] =   max(float(maxvalue1 + 1) / bins, 1.0)
+        coloc['Width2'] =   max(float(maxvalue2 + 1) / bins, 1.0)
+    coloc['Center'] =   0.0 if continuous else 0.5     # Offset of a bin center, integer values sit at v + 0.5
+    coloc['Hist']   =   [0] * (bins * bins)     # Row = channel 1 bin, column = channel 2 bin
+    for key in ('N', 'S1', 'S2', 'S11', 'S22', 'S12', 'S1Coloc', 'S2Coloc') :
+        coloc[key] = 0.0
+    return coloc
+
+def AddPixels(coloc, pixels1, pixels2) :
+    """ Accumulate two pixel arrays of the same plane or tile """
+    if len(pixels1) != len(pixels2) :
+        raise Exception("Channels have different sizes: %d and %d pixels" % (len(pixels1), len(pixels2)))
+    bins, w1, w2 = coloc['Bins'], coloc['Width1'], coloc['Width2']
+    last = bins - 1
+    hist = coloc['Hist']
+    s1 = s2 = s11 = s22 = s12 = c1 = c2 = 0.0
+    for a, b in zip(pixels1, pixels2) :
+        s1 += a
+        s2 += b
+        s11 += a * a
+        s22 += b * b
+        s12 += a * b
+        if b > 0 :
+            c1 += a
+        if a > 0 :
+            c2 += b
+        i, j = int(a / w1), int(b / w2)
+        hist[min(max(i, 0), last) * bins + min(max(j, 0), last)] += 1
+    coloc['N']      +=  len(pixels1)
+    coloc['S1']     +=  s1
+    coloc['S2']     +=  s2
+    coloc['S11']    +=  s11
+    coloc['S22']    +=  s22
+    coloc['S12']    +=  s12
+    coloc['S1Coloc']    +=  c1
+    coloc['S2Coloc']    +=  c2
+
+def AddPlanes(coloc, ip1, ip2) :
+    """ Accumulate two ImageProcessors of the same plane or tile """
+    AddPixels(coloc, ip1.convertToFloatProcessor().getPixels(), ip2.convertToFloatProcessor().getPixels())
+
+def _Pearson(n, s1, s2, s11, s22, s12) :
+    """ Pearson's r from sums, 0 when a channel is constant """
+    cov = s12 - s1 * s2 / n if n else 0.0
+    v1 = s11 - s1 * s1 / n if n else 0.0
+    v2 = s22 - s2 * s2 / n if n else 0.0
+    if v1 <= 0 or v2 <= 0 :
+        return 0.0
+    return cov / math.sqrt(v1 * v2)
+
+def _SuffixSums(coloc) :
+    """ Sums of n, x, y, xx, yy, xy over bins i >= r, j >= c, as (bins + 1)^2 tables """
+    bins, w1, w2 = coloc['Bins'], coloc['Width1'], coloc['Width2']
+    offset = coloc.get('Center', 0.5)
+    hist = coloc['Hist']
+    size = bins + 1
+    tables = [[0.0] * (size * size) for k in range(6)]
+    for r in range(bins - 1, -1, -1) :
+        x = (r + 0.5) * w1 - offset     # Center of the values of the bin
+        for c in range(bins - 1, -1, -1) :
+            y = (c + 0.5) * w2 - offset
+            h = hist[r * bins + c]
+            cell = (h, h * x, h * y, h * x * x, h * y * y, h * x * y)
+            k = r * size + c
+            for t, v in zip(tables, cell) :
+                t[k] = v + t[k + 1] + t[k + size] - t[k + size + 1]
+    return tables
+
+def FinishColoc(coloc) :
+    """ Return the coefficients of ColocFields
+
+    The Costes thresholds walk down the orthogonal regression line of
+    channel 2 on channel 1 until the pixels below either threshold no
+    longer correlate; they and the thresholded coefficients are resolved to
+    one histogram bin.
+    """
+    n = coloc['N']
+    rslt = dict((k, float('nan')) for k in ColocFields)
+    if n == 0 :
+        return rslt
+    s1, s2 = coloc['S1'], coloc['S2']
+    rslt['Pearson'] =   _Pearson(n, s1, s2, coloc['S11'], coloc['S22'], coloc['S12'])
+    rslt['M1']      =   coloc['S1Coloc'] / s1 if s1 else 0.0
+    rslt['M2']      =   coloc['S2Coloc'] / s2 if s2 else 0.0
+
+    # Orthogonal (Deming, equal variances) regression of channel 2 on channel 1
+    m1, m2 = s1 / n, s2 / n
+    v1 = coloc['S11'] / n - m1 * m1
+    v2 = coloc['S22'] / n - m2 * m2
+    cov = coloc['S12'] / n - m1 * m2
+    if cov == 0 :
+        return rslt
+    slope = (v2 - v1 + math.sqrt((v2 - v1) ** 2 + 4 * cov * cov)) / (2 * cov)
+    intercept = m2 - slope * m1
+
+    bins, w1, w2 = coloc['Bins'], coloc['Width1'], coloc['Width2']
+    size = bins + 1
+    tables = _SuffixSums(coloc)
+    totals = [t[0] for t in tables]
+    for r in range(bins - 1, 0, -1) :
+        t1 = r * w1
+        t2 = slope * t1 + intercept
+        c = min(max(int(math.ceil(t2 / w2)), 0), bins)
+        # Pixels below either threshold = all pixels minus those above both
+        above = [t[r * size + c] for t in tables]
+        below = [a - b for a, b in zip(totals, above)]
+        if below[0] < 2 :
+            continue
+        rbelow = _Pearson(*below)
+        if rbelow <= 0 or r == 1 :
+            rslt['CostesThreshold1']    =   t1
+            rslt['CostesThreshold2']    =   c * w2
+            rslt['PearsonBelowThreshold']   =   rbelow
+            # Thresholded Manders: intensity above both thresholds over intensity above its own
+            own1 = tables[1][r * size]
+            own2 = tables[2][c]
+            rslt['tM1'] =   above[1] / own1 if own1 else 0.0
+            rslt['tM2'] =   above[2] / own2 if own2 else 0.0
+            break
+    return rslt
+
+###----EOF----
@@ -0,0 +1,77 @@
+""" Streaming read-annotate-write of measurement CSV files """
+import io
+import csv
+
+def _LineDialects(lines) :
+    """ Per-line delimiter detection: the dialect of the last line and the index of the first line sharing it """
+    dialects = []
+    for ln in lines :
+        try :
+            dialects.append(csv.Sniffer().sniff(ln) if ln.strip() else None)
+        except csv.Error :
+            dialects.append(None)
+    found = [d for d in dialects if d is not None]
+    if not found :
+        raise csv.Error("Could not determine delimiter")
+    target = found[-1]
+    for i, dialect in enumerate(dialects) :
+        if dialect is not None and dialect.delimiter == target.delimiter :
+            return target, i
+    return target, 0
+
+def SeekCsvDialect(fn, maxlines=100, sniffedlines=10) :
+    """Seek dialect in the file and return the dialect and the header offset
+
+    Only the first maxlines lines are read, and csv.Sniffer runs once on the
+    last sniffedlines of them. The header is the first line splitting into as
+    many fields as those lines, so the cost does not grow with the preamble.
+    The dialect is then sniffed again from the header on, so preamble lines
+    of short files never reach the sniffer; when the first sniff fails, the
+    header is found by sniffing line by line instead.
+    """
+    lines = []
+    with io.open(fn, 'r', newline='') as f :
+        for ln in f :
+            lines.append(ln)
+            if len(lines) >= maxlines :
+                break
+    try :
+        tail = [ln for ln in lines[-sniffedlines:] if ln.strip()]
+        dialect = csv.Sniffer().sniff(''.join(tail))
+        width = max(len(row) for row in csv.reader(tail, dialect))
+        for header, ln in enumerate(lines) :
+            if len(next(csv.reader([ln], dialect), [])) == width :
+                break
+        else :
+            header = 0
+    except csv.Error :  # Preamble lines in the sniffed window
+        dialect, header = _LineDialects(lines)
+    data = [ln for ln in lines[header:header + sniffedlines] if ln.strip()]
+    try :
+        dialect = csv.Sniffer().sniff(''.join(data))
+    except csv.Error :
+        pass
+    return dialect, sum(len(ln) for ln in lines[:header])
+
+def StreamAnnotateCsv(inpath, outpath, newfields, annotate) :
+    """ Copy inpath to outpath row by row, adding the columns returned by annotate(row)
+
+    Rows are never held in memory beyond the one being written, so the cost
+    stays constant for results tables of any length. Returns the row count.
+    """
+    dial, offset = SeekCsvDialect(inpath)
+    count = 0
+    with io.open(inpath, 'r', newline='') as incsv :
+        incsv.seek(offset)
+        dictreader = csv.DictReader(incsv, dialect=dial)
+        fieldnames = [name for name in dictreader.fieldnames] + list(newfields)
+        with open(outpath, 'w') as out :
+            writer = csv.DictWriter(out, fieldnames=fieldnames, dialect='excel')
+            writer.writeheader()
+            for row in dictreader :
+                row.update(annotate(row))
+                writer.writerow(row)
+                count += 1
+    return count
+
+###----EOF----
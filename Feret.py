@@ -0,0 +1,105 @@
+""" Feret diameters of many contours from their coordinates
+
+Convex hull (monotone chain) followed by rotating calipers, a replacement
+for a Roi.getFeretValues() call per roi. Contours come from RoiManager rois
+(getFloatPolygon) or from roi dictionaries of RoiCodec, so saved .zip sets
+are measured without a JVM.
+"""
+import math
+
+def RoiCoordinates(roi) :
+    """ Return the vertex coordinates (xs, ys) of an ImageJ roi or a RoiCodec dictionary """
+    if isinstance(roi, dict) :
+        return list(roi['X']), list(roi['Y'])
+    polygon = roi.getFloatPolygon()
+    n = polygon.npoints
+    return list(polygon.xpoints[:n]), list(polygon.ypoints[:n])
+
+def _Cross(o, a, b) :
+    """ z of (a - o) x (b - o), positive when o, a, b turn counter-clockwise """
+    return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+def ConvexHull(xs, ys) :
+    """ Return the convex hull vertices in counter-clockwise order, without collinear points """
+    points = sorted(set(zip([float(v) for v in xs], [float(v) for v in ys])))
+    if len(points) < 3 :
+        return points
+    lower, upper = [], []
+    for p in points :
+        while len(lower) >= 2 and _Cross(lower[-2], lower[-1], p) <= 0 :
+            lower.pop()
+        lower.append(p)
+    for p in reversed(points) :
+        while len(upper) >= 2 and _Cross(upper[-2], upper[-1], p) <= 0 :
+            upper.pop()
+        upper.append(p)
+    return lower[:-1] + upper[:-1]
+
+def HullFeret(hull) :
+    """ Rotating calipers over a convex hull
+
+    Returns the squared diameter with its endpoints and the minimum caliper
+    width.
+    """
+    n = len(hull)
+    if n == 1 :
+        return 0.0, hull[0], hull[0], 0.0
+    if n == 2 :
+        (x1, y1), (x2, y2) = hull
+        return (x2 - x1) ** 2 + (y2 - y1) ** 2, hull[0], hull[1], 0.0
+    best, p1, p2 = -1.0, None, None
+    minwidth = float('inf')
+    j = 1
+    for i in range(n) :
+        a, b = hull[i], hull[(i + 1) % n]
+        # Advance the antipodal vertex while it moves away from edge a-b
+        while _Cross(a, b, hull[(j + 1) % n]) > _Cross(a, b, hull[j]) :
+            j = (j + 1) % n
+        for p in (a, b) :
+            q = hull[j]
+            d = (q[0] - p[0]) ** 2 + (q[1] - p[1]) ** 2
+            if d > best :
+                best, p1, p2 = d, p, q
+        length = math.hypot(b[0] - a[0], b[1] - a[1])
+        width = _Cross(a, b, hull[j]) / length
+        minwidth = min(minwidth, width)
+    return best, p1, p2, minwidth
+
+def Ferets(contours, pw=1.0, ph=1.0) :
+    """ Measure a batch of contours given as (xs, ys) in pixels
+
+    Returns one dictionary per contour with the values of getFeretValues:
+    Feret, FeretAngle (0-180 degrees, image y pointing down), MinFeret,
+    FeretX, FeretY (left endpoint of the diameter) and the other endpoint
+    FeretX2, FeretY2. Lengths are scaled by the pixel size pw, ph.
+    """
+    results = []
+    for xs, ys in contours :
+        hull = ConvexHull([x * pw for x in xs], [y * ph for y in ys])
+        feret = {}
+        if not hull :
+            for key in ('Feret', 'FeretAngle', 'MinFeret', 'FeretX', 'FeretY', 'FeretX2', 'FeretY2') :
+                feret[key] = 0.0
+            results.append(feret)
+            continue
+        dsq, p1, p2, minwidth = HullFeret(hull)
+        if p1[0] > p2[0] :
+            p1, p2 = p2, p1
+        angle = math.degrees(math.atan2(p1[1] - p2[1], p2[0] - p1[0]))
+        if angle < 0 :
+            angle += 180.0
+        feret['Feret']      =   math.sqrt(dsq)
+        feret['FeretAngle'] =   angle
+        feret['MinFeret']   =   minwidth
+        feret['FeretX']     =   p1[0] / pw
+        feret['FeretY']     =   p1[1] / ph
+        feret['FeretX2']    =   p2[0] / pw
+        feret['FeretY2']    =   p2[1] / ph
+        results.append(feret)
+    return results
+
+def RoiFerets(rois, pw=1.0, ph=1.0) :
+    """ Measure a batch of ImageJ rois or RoiCodec dictionaries """
+    return Ferets([RoiCoordinates(roi) for roi in rois], pw, ph)
+
+###----EOF----
@@ -0,0 +1,98 @@
+""" Batched point-set geometry shared by the measurement scripts
+
+Runs inside Fiji (Jython) on plain lists and, when NumPy is importable
+(CPython workers), on NumPy arrays.
+"""
+import math
+try :
+    import numpy as np
+except ImportError :    # Jython inside Fiji
+    np = None
+
+def CondensedIndex(i, j, n) :
+    """ Position of the pair i < j in the condensed distance matrix """
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+def CondensedPairs(n) :
+    """ Return the index lists (i, j) of all pairs i < j in condensed order """
+    if np is not None :
+        iarr, jarr = np.triu_indices(n, 1)
+        return iarr.tolist(), jarr.tolist()
+    iarr = [i for i in range(n) for j in range(i + 1, n)]
+    jarr = [j for i in range(n) for j in range(i + 1, n)]
+    return iarr, jarr
+
+def PairwiseDistances(xs, ys, scale=1.0) :
+    """ Return the condensed distance matrix of the points, scaled by scale """
+    n = len(xs)
+    if len(ys) != n :
+        raise Exception("Point coordinates are not correct!")
+    if np is not None :
+        x = np.asarray(xs, dtype=float)
+        y = np.asarray(ys, dtype=float)
+        iarr, jarr = np.triu_indices(n, 1)
+        return (np.hypot(x[iarr] - x[jarr], y[iarr] - y[jarr]) * scale).tolist()
+    x = [float(v) for v in xs]
+    y = [float(v) for v in ys]
+    hypot = math.hypot
+    return [hypot(x[i] - x[j], y[i] - y[j]) * scale for i in range(n) for j in range(i + 1, n)]
+
+def PolygonPairs(xs, ys, scale=1.0) :
+    """ Split the vertex distances of a closed polygon into edges and chords
+
+    Returns two lists of (i, j, distance). The consecutive list starts with
+    the tail-head edge followed by (i, i+1); the non-consecutive list holds
+    every other pair i < j in condensed order.
+    """
+    n = len(xs)
+    dist = PairwiseDistances(xs, ys, scale)
+    if n < 2 :
+        return [], []
+    consecutive = [(n - 1, 0, dist[CondensedIndex(0, n - 1, n)])]
+    consecutive.extend([(i, i + 1, dist[CondensedIndex(i, i + 1, n)]) for i in range(n - 1)])
+    iarr, jarr = CondensedPairs(n)
+    nonconsecutive = [(i, j, d) for i, j, d in zip(iarr, jarr, dist)
+                      if j - i != 1 and not (i == 0 and j == n - 1)]
+    return consecutive, nonconsecutive
+
+def RadialProfile(xs, ys, cx, cy, scale=1.0) :
+    """ Radii and angles of points around a center, with their angular order
+
+    Angles are in degrees in [0, 360), counter-clockwise as displayed (image
+    y pointing down). Returns a dictionary of lists: Radius (scaled), Angle,
+    Order (point indices by increasing angle) and Gap, the angle from each
+    point of Order to the next one, wrapping around so the gaps sum to 360.
+    """
+    n = len(xs)
+    if len(ys) != n :
+        raise Exception("Point coordinates are not correct!")
+    profile = {}
+    if n == 0 :
+        for key in ('Radius', 'Angle', 'Order', 'Gap') :
+            profile[key] = []
+        return profile
+    if np is not None :
+        dx = np.asarray(xs, dtype=float) - cx
+        dy = cy - np.asarray(ys, dtype=float)
+        angle = np.degrees(np.arctan2(dy, dx)) % 360.0
+        order = np.argsort(angle, kind='mergesort')
+        ordered = angle[order]
+        gap = np.append(np.diff(ordered), 360.0 - (ordered[-1] - ordered[0]))
+        profile['Radius']   =   (np.hypot(dx, dy) * scale).tolist()
+        profile['Angle']    =   angle.tolist()
+        profile['Order']    =   order.tolist()
+        profile['Gap']      =   gap.tolist()
+        return profile
+    dx = [float(x) - cx for x in xs]
+    dy = [cy - float(y) for y in ys]
+    angle = [math.degrees(math.atan2(b, a)) % 360.0 for a, b in zip(dx, dy)]
+    order = sorted(range(n), key=angle.__getitem__)
+    ordered = [angle[i] for i in order]
+    gap = [ordered[k + 1] - ordered[k] for k in range(n - 1)] + [360.0 - (ordered[-1] - ordered[0])]
+    profile['Radius']   =   [math.hypot(a, b) * scale for a, b in zip(dx, dy)]
+    profile['Angle']    =   angle
+    profile['Order']    =   order
+    profile['Gap']      =   gap
+    return profile
+
+###----EOF----
@@ -0,0 +1,314 @@
+""" Bio-Formats image sessions, lazy plane handles and the persistent OME metadata cache """
+import os
+import json
+import threading
+from Trace import Traced, AddBytes
+from PlaneCache import FileKey, PlaneKey, GetPlane, PutPlane
+
+@Traced()
+def OpenImageSession(imgpath, planecache=None, lazy=False) :
+    """ Parse the file header once; the session serves both metadata and pixels
+
+    With a PlaneCache, ReadPlane serves planes decoded by earlier runs from it.
+    A lazy session parses the header only when its reader is first needed
+    (SessionReader), so a file whose metadata and planes are cached is never
+    parsed.
+    """
+    session = {}
+    session['Path']     =   imgpath
+    session['Process']  =   None
+    session['Reader']   =   None    # Set by _ParseHeader
+    session['OMEMeta']  =   None
+    session['OpenLock'] =   threading.Lock()   # Parsing the header of a lazy session
+    session['Lock']     =   threading.Lock()   # The reader is stateful (current series)
+    session['Planes']   =   []  # Most recently decoded planes, newest last
+    session['MaxPlanes']    =   1
+    session['PlaneCache']   =   planecache
+    session['FileKey']  =   FileKey(planecache, imgpath) if planecache is not None else None
+    if not lazy :
+        _ParseHeader(session)
+    return session
+
+@Traced('ParseHeader')
+def _ParseHeader(session) :
+    """ Open the Bio-Formats reader of a session """
+    from loci.plugins.in import ImporterOptions as IO
+    from loci.plugins.in import ImportProcess
+
+    imgpath = session['Path']
+    opt = IO()
+    opt.setOpenAllSeries(True)  # Open all series
+    opt.setColorMode(IO.COLOR_MODE_COLORIZED)   # Open as colorized
+    opt.setShowOMEXML(False)
+    opt.setStitchTiles(False)
+    opt.setId(imgpath)
+    opt.setSplitChannels(True)  # Split channel
+    opt.setVirtual(True)        # Planes are decoded on demand by ReadPlane
+    opt.setQuiet(True)
+    process = ImportProcess(opt)
+    if not process.execute() :
+        raise Exception("Bio-Formats could not open %s" % imgpath)
+    session['Process']  =   process
+    session['OMEMeta']  =   process.getOMEMetadata()
+    session['Reader']   =   process.getReader()
+
+def SessionReader(session) :
+    """ Return the reader of a session, parsing the file header on first use """
+    session['OpenLock'].acquire()
+    try :
+        if session['Reader'] is None :
+            _ParseHeader(session)
+    finally :
+        session['OpenLock'].release()
+    return session['Reader']
+
+def SessionMeta(session) :
+    """ Return the OME metadata of a session, parsing the file header on first use """
+    SessionReader(session)
+    return session['OMEMeta']
+
+def CloseSession(session) :
+    """ Release the reader and the decoded planes of a session """
+    del session['Planes'][:]
+    if session['Reader'] is not None :
+        session['Reader'].close()
+
+@Traced()
+def GetRawMeta(session) :
+    """ Parse image OME-XML metadata """
+    from loci.formats import FormatTools
+
+    OMEMeta, reader = SessionMeta(session), SessionReader(session)
+    metadict = {}
+    metadict['ImageCount']  =   int(OMEMeta.getImageCount())
+    metadict['PixelSize']   =   float(OMEMeta.getPixelsPhysicalSizeX(0).value())
+    metadict['PixelSizeUnit']   =   OMEMeta.getPixelsPhysicalSizeX(0).unit().getSymbol()
+    metadict['ChannelCount']    =   int(OMEMeta.getChannelCount(0))
+    metadict['ChannelNames']    =   [OMEMeta.getChannelName(0, c) for c in range(metadict['ChannelCount'])]
+    metadict['ChannelInfo']     =   ChannelInfos(session)
+    # Decoded size of all series, used to reserve memory before import
+    bytecount = 0
+    sizes = []
+    for series in range(reader.getSeriesCount()) :
+        reader.setSeries(series)
+        bytecount += reader.getSizeX() * reader.getSizeY() * reader.getImageCount() * \
+                     FormatTools.getBytesPerPixel(reader.getPixelType())
+        sizes.append([reader.getSizeX(), reader.getSizeY()])
+    reader.setSeries(0)
+    metadict['SeriesSizes'] =   sizes   # (width, height) of every series, for MetaPlaneSize
+    metadict['ByteCount']   =   bytecount
+    metadict['PlaneByteCount']  =   reader.getSizeX() * reader.getSizeY() * \
+                                    FormatTools.getBytesPerPixel(reader.getPixelType())
+    metadict['BitsPerPixel']    =   reader.getBitsPerPixel()
+    metadict['PlaneHandles']    =   PlaneHandles(session)   # For MetaHandles, without parsing the header again
+
+    return metadict
+
+# Fallback when the file carries no channel color, as for ImageJ composites
+DefaultChannelColors = ['red', 'green', 'blue', 'gray', 'cyan', 'magenta', 'yellow']
+NamedColors = {(255, 0, 0) : 'red', (0, 255, 0) : 'green', (0, 0, 255) : 'blue',
+               (255, 255, 255) : 'gray', (0, 255, 255) : 'cyan', (255, 0, 255) : 'magenta',
+               (255, 255, 0) : 'yellow'}
+
+def ChannelColor(session, series, channel) :
+    """ Get the color name of a channel from metadata, as the LUT shows it """
+    color = None
+    try :
+        color = SessionMeta(session).getChannelColor(series, channel)
+    except Exception :
+        pass
+    if color is None :
+        return DefaultChannelColors[channel % len(DefaultChannelColors)]
+    return NamedColors.get((color.getRed(), color.getGreen(), color.getBlue()))
+
+def _MetaValue(getter, *args) :
+    """ Value of an OME metadata getter, None when the file does not carry it """
+    try :
+        return getter(*args)
+    except Exception :
+        return None
+
+def ChannelInfos(session, series=0) :
+    """ Name, fluor, emission wavelength (nm) and color of every channel of a series """
+    OMEMeta = SessionMeta(session)
+    infos = []
+    for channel in range(int(OMEMeta.getChannelCount(series))) :
+        emission = _MetaValue(OMEMeta.getChannelEmissionWavelength, series, channel)
+        if emission is not None :
+            from ome.units import UNITS
+            emission = float(emission.value(UNITS.NANOMETER).doubleValue())
+        name = _MetaValue(OMEMeta.getChannelName, series, channel)
+        fluor = _MetaValue(OMEMeta.getChannelFluor, series, channel)
+        info = {}
+        info['Name']        =   str(name) if name is not None else None
+        info['Fluor']       =   str(fluor) if fluor is not None else None
+        info['Emission']    =   emission
+        info['Color']       =   ChannelColor(session, series, channel)
+        infos.append(info)
+    return infos
+
+def PlaneHandles(session, channels=None) :
+    """ List one handle per (series, channel, z, t) plane; nothing is decoded yet
+
+    channels, if given, restricts the handles to these channel indices.
+    """
+    reader = SessionReader(session)
+    handles = []
+    session['Lock'].acquire()
+    try :
+        for series in range(reader.getSeriesCount()) :
+            reader.setSeries(series)
+            colors = [ChannelColor(session, series, channel) for channel in range(reader.getSizeC())]
+            for t in range(reader.getSizeT()) :
+                for channel in range(reader.getSizeC()) :
+                    if channels is not None and channel not in channels :
+                        continue
+                    for z in range(reader.getSizeZ()) :
+                        handle = {}
+                        handle['Series']    =   series
+                        handle['Channel']   =   channel
+                        handle['Z']         =   z
+                        handle['T']         =   t
+                        handle['Index']     =   reader.getIndex(z, channel, t)
+                        handle['Color']     =   colors[channel]
+                        handles.append(handle)
+        reader.setSeries(0)
+    finally :
+        session['Lock'].release()
+    return handles
+
+@Traced()
+def ReadPlane(session, handle) :
+    """ Decode the plane of a handle with a plane-level read
+
+    Only the last MaxPlanes planes stay referenced by the session, older ones
+    are evicted, so peak memory scales with a plane rather than the file.
+    Planes in the session's PlaneCache are not decoded again.
+    """
+    key = (handle['Series'], handle['Index'])
+    cache = session.get('PlaneCache')
+    session['Lock'].acquire()
+    try :
+        for k, ip in session['Planes'] :
+            if k == key :
+                return ip
+        ip = None
+        if cache is not None :
+            ip = GetPlane(cache, PlaneKey(session['FileKey'], handle))
+        if ip is None :
+            reader = SessionReader(session)
+            reader.setSeries(handle['Series'])
+            ip = reader.openProcessors(handle['Index'])[0]
+            AddBytes(ip.getPixelCount() * ip.getBitDepth() // 8)
+            if cache is not None :
+                PutPlane(cache, PlaneKey(session['FileKey'], handle), ip)
+        session['Planes'].append((key, ip))
+        del session['Planes'][:-session['MaxPlanes']]
+    finally :
+        session['Lock'].release()
+    return ip
+
+def PlaneSize(session, handle) :
+    """ Return the (width, height) of the plane of a handle """
+    session['Lock'].acquire()
+    try :
+        reader = SessionReader(session)
+        reader.setSeries(handle['Series'])
+        return reader.getSizeX(), reader.getSizeY()
+    finally :
+        session['Lock'].release()
+
+def MetaHandles(imgmeta, channels=None) :
+    """ List the plane handles of cached metadata (GetRawMeta), as PlaneHandles does """
+    return [dict(h) for h in imgmeta['PlaneHandles'] if channels is None or h['Channel'] in channels]
+
+def MetaPlaneSize(imgmeta, handle) :
+    """ Return the (width, height) of the plane of a handle from cached metadata """
+    width, height = imgmeta['SeriesSizes'][handle['Series']]
+    return width, height
+
+@Traced()
+def ReadTile(session, handle, tile) :
+    """ Decode the read region of a tile (Tiles.TileGrid) with a sub-region read
+
+    Tiles are not kept by the session; only the region is decoded, so a
+    plane larger than the heap can be processed tile by tile.
+    """
+    session['Lock'].acquire()
+    try :
+        reader = SessionReader(session)
+        reader.setSeries(handle['Series'])
+        ip = reader.openProcessors(handle['Index'], tile['X'], tile['Y'], tile['Width'], tile['Height'])[0]
+    finally :
+        session['Lock'].release()
+    AddBytes(ip.getPixelCount() * ip.getBitDepth() // 8)
+    return ip
+
+def EvictPlanes(session) :
+    """ Drop the decoded planes kept by a session """
+    session['Lock'].acquire()
+    try :
+        del session['Planes'][:]
+    finally :
+        session['Lock'].release()
+
+# Metadata cache, keyed by path, size and mtime so edited files are parsed again
+_CacheLock = threading.Lock()
+
+def MetaCacheKey(imgpath) :
+    """ Return the cache key of an image file """
+    st = os.stat(imgpath)
+    return '%s|%d|%d' % (os.path.abspath(imgpath), st.st_size, int(st.st_mtime))
+
+def LoadMetaCache(cachepath) :
+    """ Read the metadata cache, empty if missing or unreadable """
+    cache = {'Path' : cachepath, 'Entries' : {}, 'Dirty' : False}
+    if os.path.isfile(cachepath) :
+        try :
+            with open(cachepath, 'r') as f :
+                cache['Entries'] = json.load(f)
+        except ValueError :
+            print "Metadata cache %s is corrupted, rebuilding it" % cachepath
+    return cache
+
+def SaveMetaCache(cache) :
+    """ Write the metadata cache back if it changed """
+    _CacheLock.acquire()
+    try :
+        if cache['Dirty'] :
+            tmppath = cache['Path'] + '.tmp'
+            with open(tmppath, 'w') as f :
+                json.dump(cache['Entries'], f, indent=1, sort_keys=True)
+            if os.path.exists(cache['Path']) :
+                os.remove(cache['Path'])
+            os.rename(tmppath, cache['Path'])
+            cache['Dirty'] = False
+    finally :
+        _CacheLock.release()
+
+def CachedMeta(cache, imgpath) :
+    """ Return the cached metadata of an image, or None if it must be parsed
+
+    Entries of an older version, without the plane handles, are parsed again.
+    """
+    if cache is None :
+        return None
+    _CacheLock.acquire()
+    try :
+        meta = cache['Entries'].get(MetaCacheKey(imgpath))
+    finally :
+        _CacheLock.release()
+    return dict(meta) if meta is not None and 'PlaneHandles' in meta else None
+
+def StoreMeta(cache, imgpath, metadict) :
+    """ Remember the parsed metadata of an image """
+    if cache is None :
+        return
+    _CacheLock.acquire()
+    try :
+        cache['Entries'][MetaCacheKey(imgpath)] = dict(metadict)
+        cache['Dirty'] = True
+    finally :
+        _CacheLock.release()
+
+###----EOF----
@@ -0,0 +1,123 @@
+""" Processing journal shared by the batch scripts for resumable runs
+
+Every processed input appends one JSON line recording its content hash,
+parameters, outputs and status. The last line of an input wins, so a run
+killed half way leaves a valid journal and the next run only picks up
+new, changed, failed or unfinished inputs.
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+
+JournalName = '.imagej_measure_journal.jsonl'
+_JournalLock = threading.Lock()
+
+def JournalPath(directory) :
+    """ Return the journal file of a data directory """
+    return os.path.join(directory, JournalName)
+
+def FileHash(path, blocksize=1 << 20) :
+    """ Return the SHA-1 of a file, read in blocks """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f :
+        block = f.read(blocksize)
+        while block :
+            h.update(block)
+            block = f.read(blocksize)
+    return h.hexdigest()
+
+def LoadJournal(path) :
+    """ Read the journal, keeping the last entry of every (script, input) """
+    journal = {'Path' : path, 'Entries' : {}, 'Hashes' : {}}   # Hashes computed by this run
+    if os.path.isfile(path) :
+        ln = '\n'
+        with open(path, 'r') as f :
+            for ln in f :
+                try :
+                    entry = json.loads(ln)
+                except ValueError :   # Truncated last line of an interrupted run
+                    continue
+                journal['Entries'][(entry['Script'], entry['Input'])] = entry
+        if not ln.endswith('\n') :   # Keep new entries off the truncated line
+            with open(path, 'a') as f :
+                f.write('\n')
+    return journal
+
+def _Stamp(files) :
+    """ Size and mtime of the files, a cheap change check before hashing """
+    stamp = []
+    for fn in files :
+        st = os.stat(fn)
+        stamp.append([st.st_size, int(st.st_mtime)])
+    return stamp
+
+def ContentHash(journal, script, key, files) :
+    """ Hash the files of an input, reusing the journal hash if size and mtime are unchanged """
+    entry = journal['Entries'].get((script, key))
+    stamp = _Stamp(files)
+    if entry is not None and entry.get('Stamp') == stamp :
+        return entry['Hash'], stamp
+    # Hashed by NeedsProcessing earlier in this run, so Record does not read the files again
+    hashed = journal['Hashes'].get((script, key))
+    if hashed is not None and hashed[1] == stamp :
+        return hashed
+    if len(files) == 1 :
+        digest = FileHash(files[0])
+    else :
+        digest = '+'.join(FileHash(fn) for fn in files)
+    journal['Hashes'][(script, key)] = (digest, stamp)
+    return digest, stamp
+
+def NeedsProcessing(journal, script, key, files, params) :
+    """ Check if an input is new, changed, failed, re-parameterized or lost its outputs """
+    entry = journal['Entries'].get((script, key))
+    if entry is None or entry['Status'] != 'done' :
+        return True
+    if entry['Params'] != params :
+        return True
+    if ContentHash(journal, script, key, files)[0] != entry['Hash'] :
+        return True
+    return not all(os.path.exists(fn) for fn in entry['Outputs'])
+
+def Record(journal, script, key, files, params, outputs, status, result=None) :
+    """ Append the outcome of an input to the journal
+
+    A failure is recorded even when its inputs are gone or unreadable, so the
+    original error is not replaced by one raised here.
+    """
+    try :
+        digest, stamp = ContentHash(journal, script, key, files)
+    except (OSError, IOError) :
+        if status == 'done' :
+            raise
+        digest, stamp = None, None
+    entry = {}
+    entry['Script']     =   script
+    entry['Input']      =   key
+    entry['Hash']       =   digest
+    entry['Stamp']      =   stamp
+    entry['Params']     =   params
+    entry['Outputs']    =   list(outputs)
+    entry['Status']     =   status
+    entry['Result']     =   result
+    entry['Time']       =   time.strftime('%Y-%m-%d %H:%M:%S')
+    line = json.dumps(entry, sort_keys=True) + '\n'
+    _JournalLock.acquire()
+    try :
+        with open(journal['Path'], 'a') as f :
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        journal['Entries'][(script, key)] = json.loads(line)
+    finally :
+        _JournalLock.release()
+    return entry
+
+def JournalResult(journal, script, key) :
+    """ Return the result stored with the last entry of an input """
+    entry = journal['Entries'].get((script, key))
+    return entry.get('Result') if entry is not None else None
+
+###----EOF----
@@ -0,0 +1,200 @@
+""" On-disk cache of decoded planes as memory-mapped raw arrays
+
+Every decoded plane is stored as one raw file of native-order pixels,
+keyed by the path, size and mtime of its image file (the stamp Aggregate
+trusts too, so no file is read to key it), the series, channel, z and t.
+A small JSON index keeps the size, pixel type and last use of every plane;
+when the cache outgrows its capacity the least recently used planes are
+evicted.
+Re-running an analysis on the same files maps the planes back instead of
+decoding them with Bio-Formats again. ImageJ processors own Java arrays, so
+a hit costs one bulk copy out of the mapped file, and no decompression.
+"""
+import os
+import json
+import hashlib
+import threading
+
+IndexName = 'index.json'
+
+# Bytes per pixel of the cached pixel types
+PixelTypes = {'byte' : 1, 'short' : 2, 'float' : 4, 'rgb' : 4}
+
+def OpenPlaneCache(cachedir, capacitymb) :
+    """ Open or create a cache of at most capacitymb MB of planes """
+    if not os.path.isdir(cachedir) :
+        os.makedirs(cachedir)
+    cache = {}
+    cache['Dir']        =   cachedir
+    cache['Capacity']   =   int(capacitymb * 1024 * 1024)
+    cache['Lock']       =   threading.Lock()
+    cache['Entries']    =   {}  # Plane key -> File, Bytes, Width, Height, Type, Used
+    cache['Clock']      =   0
+    cache['Dirty']      =   False
+    indexpath = os.path.join(cachedir, IndexName)
+    if os.path.isfile(indexpath) :
+        try :
+            with open(indexpath, 'r') as f :
+                index = json.load(f)
+            cache['Entries'] = index['Entries']
+        except (ValueError, KeyError) :
+            print "Plane cache index %s is corrupted, rebuilding it" % indexpath
+    # Planes of a run killed before SavePlaneCache are not indexed: drop them,
+    # and forget indexed planes whose file is gone
+    files = set(fn for fn in os.listdir(cachedir) if fn.endswith('.raw'))
+    for key, entry in list(cache['Entries'].items()) :
+        if entry['File'] not in files :
+            del cache['Entries'][key]
+    indexed = set(entry['File'] for entry in cache['Entries'].values())
+    for fn in files - indexed :
+        try :
+            os.remove(os.path.join(cachedir, fn))
+        except OSError :    # Still mapped by another process (Windows), dropped next time
+            pass
+    cache['Clock'] = max([entry['Used'] for entry in cache['Entries'].values()] + [0])
+    _Evict(cache, 0)
+    return cache
+
+def SavePlaneCache(cache) :
+    """ Write the index back if it changed """
+    cache['Lock'].acquire()
+    try :
+        if cache['Dirty'] :
+            indexpath = os.path.join(cache['Dir'], IndexName)
+            with open(indexpath + '.tmp', 'w') as f :
+                json.dump({'Entries' : cache['Entries']}, f, indent=1, sort_keys=True)
+            if os.path.exists(indexpath) :
+                os.remove(indexpath)
+            os.rename(indexpath + '.tmp', indexpath)
+            cache['Dirty'] = False
+    finally :
+        cache['Lock'].release()
+
+def FileKey(cache, imgpath) :
+    """ Return the key of an image file: the SHA-1 of its path, size and mtime, safe in file names """
+    st = os.stat(imgpath)
+    stamp = '%s|%d|%d' % (os.path.abspath(imgpath), st.st_size, int(st.st_mtime))
+    if isinstance(stamp, unicode) :
+        stamp = stamp.encode('utf-8')
+    return hashlib.sha1(stamp).hexdigest()
+
+def PlaneKey(filekey, handle) :
+    """ Return the cache key of the plane of an ImageSource handle """
+    return '%s-s%d-c%d-z%d-t%d' % (filekey, handle['Series'], handle['Channel'], handle['Z'], handle['T'])
+
+def CachedTiles(cache, prefix, readtile) :
+    """ Wrap a tile reader (Tiles.TileGrid tiles) so that repeated reads of a tile come from the cache """
+    def cachedtile(tile) :
+        key = '%s-x%d-y%d-w%d-h%d' % (prefix, tile['X'], tile['Y'], tile['Width'], tile['Height'])
+        ip = GetPlane(cache, key)
+        if ip is None :
+            ip = readtile(tile)
+            PutPlane(cache, key, ip)
+        return ip
+    return cachedtile
+
+def _Touch(cache, entry) :
+    """ Mark an entry as most recently used """
+    cache['Clock'] += 1
+    entry['Used'] = cache['Clock']
+    cache['Dirty'] = True
+
+def _Evict(cache, nbytes) :
+    """ Remove least recently used planes until nbytes more fit in the capacity """
+    entries = cache['Entries']
+    total = sum(entry['Bytes'] for entry in entries.values())
+    for key in sorted(entries.keys(), key=lambda k : entries[k]['Used']) :
+        if total + nbytes <= cache['Capacity'] :
+            break
+        entry = entries.pop(key)
+        total -= entry['Bytes']
+        cache['Dirty'] = True
+        try :
+            os.remove(os.path.join(cache['Dir'], entry['File']))
+        except OSError :
+            pass
+
+def _PixelType(ip) :
+    """ Return the PixelTypes name of an ImageProcessor """
+    from ij.process import ByteProcessor, ShortProcessor, FloatProcessor, ColorProcessor
+    for cls, name in ((ByteProcessor, 'byte'), (ShortProcessor, 'short'), (FloatProcessor, 'float'),
+                      (ColorProcessor, 'rgb')) :
+        if isinstance(ip, cls) :
+            return name
+    raise Exception("Unsupported processor %s" % ip.getClass().getName())
+
+def _View(buf, pixeltype) :
+    """ Typed java.nio view of a mapped byte buffer """
+    if pixeltype == 'short' :
+        return buf.asShortBuffer()
+    if pixeltype == 'float' :
+        return buf.asFloatBuffer()
+    if pixeltype == 'rgb' :
+        return buf.asIntBuffer()
+    return buf
+
+def _Map(path, nbytes, write) :
+    """ Map a raw file in native byte order, return the buffer and the file to close """
+    from java.io import RandomAccessFile
+    from java.nio import ByteOrder
+    from java.nio.channels import FileChannel
+    raf = RandomAccessFile(path, 'rw' if write else 'r')
+    mode = FileChannel.MapMode.READ_WRITE if write else FileChannel.MapMode.READ_ONLY
+    return raf.getChannel().map(mode, 0, nbytes).order(ByteOrder.nativeOrder()), raf
+
+def _StorePixels(path, ip, pixeltype, nbytes) :
+    """ Write the pixels of a processor to a raw file through a mapping """
+    buf, raf = _Map(path, nbytes, True)
+    try :
+        _View(buf, pixeltype).put(ip.getPixels())
+    finally :
+        raf.close()
+
+def _LoadPixels(path, entry) :
+    """ Return a new processor with the pixels of a raw file, copied out of its mapping """
+    from ij.process import ByteProcessor, ShortProcessor, FloatProcessor, ColorProcessor
+    classes = {'byte' : ByteProcessor, 'short' : ShortProcessor, 'float' : FloatProcessor, 'rgb' : ColorProcessor}
+    ip = classes[entry['Type']](entry['Width'], entry['Height'])
+    buf, raf = _Map(path, entry['Bytes'], False)
+    try :
+        _View(buf, entry['Type']).get(ip.getPixels())
+    finally :
+        raf.close()
+    return ip
+
+def GetPlane(cache, key) :
+    """ Return the cached plane of a key as a new ImageProcessor, None on a miss """
+    cache['Lock'].acquire()
+    try :
+        entry = cache['Entries'].get(key)
+        if entry is None :
+            return None
+        _Touch(cache, entry)
+        # Read under the lock, so that a concurrent eviction cannot remove the file
+        return _LoadPixels(os.path.join(cache['Dir'], entry['File']), entry)
+    finally :
+        cache['Lock'].release()
+
+def PutPlane(cache, key, ip) :
+    """ Store a decoded plane, evicting older planes; planes larger than the cache are skipped """
+    pixeltype = _PixelType(ip)
+    nbytes = ip.getWidth() * ip.getHeight() * PixelTypes[pixeltype]
+    cache['Lock'].acquire()
+    try :
+        if key in cache['Entries'] or nbytes > cache['Capacity'] :
+            return False
+        _Evict(cache, nbytes)
+        entry = {}
+        entry['File']   =   key + '.raw'
+        entry['Bytes']  =   nbytes
+        entry['Width']  =   ip.getWidth()
+        entry['Height'] =   ip.getHeight()
+        entry['Type']   =   pixeltype
+        _StorePixels(os.path.join(cache['Dir'], entry['File']), ip, pixeltype, nbytes)
+        cache['Entries'][key] = entry
+        _Touch(cache, entry)
+    finally :
+        cache['Lock'].release()
+    return True
+
+###----EOF----
@@ -0,0 +1,91 @@
+""" Bounded prefetch of the next inputs while the current one is analyzed """
+import threading
+try :
+    from java.lang import Throwable     # Java exceptions raised inside Fiji
+    _Errors = (Exception, Throwable)
+except ImportError :
+    _Errors = (Exception,)
+
+def Prefetch(items, load, depth=2, workers=1, close=None) :
+    """ Yield (item, load(item), error) in the order of items, loading ahead in background threads
+
+    At most depth items are loaded or waiting to be consumed at any time;
+    the loader threads block (backpressure) until the consumer takes one.
+    A failing load yields its error instead of stopping the pipeline. With
+    depth=0 every item is loaded on the calling thread when it is reached.
+    When the consumer stops early or raises, the loads still running are
+    waited for and close(loaded) is called on every result never handed
+    out; close the generator (or let it end) so that this happens promptly.
+    """
+    items = list(items)
+    if depth <= 0 :
+        for item in items :
+            try :
+                yield item, load(item), None
+            except _Errors as e :
+                yield item, None, e
+        return
+
+    window = threading.Semaphore(depth)     # Free prefetch slots
+    cond = threading.Condition()
+    state = {'Next' : 0, 'Stop' : False}
+    loaded = {}
+
+    def Loader() :
+        while True :
+            window.acquire()
+            cond.acquire()
+            try :
+                i = state['Next']
+                if state['Stop'] or i >= len(items) :
+                    return
+                state['Next'] += 1
+            finally :
+                cond.release()
+            try :
+                rslt = (items[i], load(items[i]), None)
+            except _Errors as e :
+                rslt = (items[i], None, e)
+            cond.acquire()
+            try :
+                loaded[i] = rslt
+                cond.notifyAll()
+            finally :
+                cond.release()
+
+    threads = [threading.Thread(target=Loader, name='Prefetch-%d' % n) for n in range(max(workers, 1))]
+    for t in threads :
+        t.setDaemon(True)
+        t.start()
+    try :
+        for i in range(len(items)) :
+            cond.acquire()
+            try :
+                while i not in loaded :
+                    cond.wait()
+                rslt = loaded.pop(i)
+            finally :
+                cond.release()
+            window.release()
+            yield rslt
+    finally :
+        # Consumer done or abandoned the loop: let the loaders exit
+        cond.acquire()
+        try :
+            state['Stop'] = True
+        finally :
+            cond.release()
+        for t in threads :
+            window.release()
+        if close is not None :
+            for t in threads :
+                t.join()
+            for i in sorted(loaded.keys()) :
+                item, rslt, error = loaded.pop(i)
+                if rslt is not None :
+                    try :
+                        close(rslt)
+                    except _Errors as e :
+                        print "Prefetch: closing %s failed: %s" % (item, e)
+
+###----EOF----
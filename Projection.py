@@ -0,0 +1,132 @@
+""" Streaming z-projection of stacks read plane by plane """
+import time
+from    ij.process      import      FloatProcessor, Blitter
+
+ProjectionMethods = ['max', 'mean', 'sum', 'median']
+
+def _Median3(a, b, c) :
+    """ Pixel-wise median of three float planes, max(min(a, b), min(max(a, b), c)) """
+    lo = a.duplicate()
+    lo.copyBits(b, 0, 0, Blitter.MIN)
+    hi = a.duplicate()
+    hi.copyBits(b, 0, 0, Blitter.MAX)
+    hi.copyBits(c, 0, 0, Blitter.MIN)
+    hi.copyBits(lo, 0, 0, Blitter.MAX)
+    return hi
+
+def _Mean2(a, b) :
+    """ Pixel-wise mean of two float planes """
+    m = a.duplicate()
+    m.copyBits(b, 0, 0, Blitter.ADD)
+    m.multiply(0.5)
+    return m
+
+def NewProjection(method) :
+    """ Start a projection; planes are added one at a time with AddPlane """
+    if method not in ProjectionMethods :
+        raise Exception("Unknown projection %s, expected one of %s" % (method, ', '.join(ProjectionMethods)))
+    projection = {}
+    projection['Method']    =   method
+    projection['Count']     =   0
+    projection['Result']    =   None
+    projection['Levels']    =   []  # Remedian buffers for 'median', at most 2 planes each
+    return projection
+
+def _PushMedian(levels, level, fp) :
+    """ Remedian with base 3: every 3 planes of a level become 1 plane of the next """
+    while True :
+        if len(levels) == level :
+            levels.append([])
+        levels[level].append(fp)
+        if len(levels[level]) < 3 :
+            return
+        fp = _Median3(*levels[level])
+        levels[level] = []
+        level += 1
+
+def AddPlane(projection, ip) :
+    """ Reduce one plane into the running projection """
+    fp = ip.convertToFloatProcessor()
+    if fp is ip :   # Never accumulate into the caller's plane
+        fp = fp.duplicate()
+    method = projection['Method']
+    if method == 'median' :
+        _PushMedian(projection['Levels'], 0, fp)
+    elif projection['Result'] is None :
+        projection['Result'] = fp
+    elif method == 'max' :
+        projection['Result'].copyBits(fp, 0, 0, Blitter.MAX)
+    else :  # sum, mean
+        projection['Result'].copyBits(fp, 0, 0, Blitter.ADD)
+    projection['Count'] += 1
+
+def FinishProjection(projection) :
+    """ Return the projected plane as a FloatProcessor """
+    if projection['Count'] == 0 :
+        raise Exception("No plane to project")
+    if projection['Method'] == 'median' :
+        # Carry the partial buffers up to the top level
+        levels = projection['Levels']
+        carry = None
+        for buf in levels :
+            if carry is not None :
+                buf = buf + [carry]
+            if len(buf) == 3 :
+                carry = _Median3(*buf)
+            elif len(buf) == 2 :
+                carry = _Mean2(*buf)
+            elif len(buf) == 1 :
+                carry = buf[0]
+        return carry
+    result = projection['Result']
+    if projection['Method'] == 'mean' :
+        result.multiply(1.0 / projection['Count'])
+    return result
+
+def ProjectPlanes(planes, method) :
+    """ Project an iterable of ImageProcessors without keeping them resident """
+    projection = NewProjection(method)
+    for ip in planes :
+        AddPlane(projection, ip)
+    return FinishProjection(projection)
+
+def BenchmarkProjection(readplane, handles, method) :
+    """ Time the streaming projection against ZProjector on the fully loaded stack
+
+    readplane(handle) must decode one plane. Returns wall time in seconds and
+    the heap growth in bytes of both paths.
+    """
+    from java.lang import Runtime, System
+    from ij import ImagePlus, ImageStack
+    from ij.plugin import ZProjector
+
+    runtime = Runtime.getRuntime()
+    def Heap() :
+        System.gc()
+        return runtime.totalMemory() - runtime.freeMemory()
+
+    rslt = {}
+    base = Heap()
+    t0 = time.time()
+    streamed = ProjectPlanes((readplane(h) for h in handles), method)
+    rslt['StreamSeconds']   =   time.time() - t0
+    rslt['StreamHeapBytes'] =   Heap() - base
+    del streamed
+
+    base = Heap()
+    t0 = time.time()
+    stack = None
+    for h in handles :
+        ip = readplane(h)
+        if stack is None :
+            stack = ImageStack(ip.getWidth(), ip.getHeight())
+        stack.addSlice(ip)
+    zmethod = {'max' : 'max', 'mean' : 'avg', 'sum' : 'sum', 'median' : 'median'}[method]
+    loaded = ZProjector.run(ImagePlus('stack', stack), zmethod)
+    rslt['LoadedSeconds']   =   time.time() - t0
+    rslt['LoadedHeapBytes'] =   Heap() - base
+    rslt['Planes']  =   len(handles)
+    del stack, loaded
+    return rslt
+
+###----EOF----
@@ -0,0 +1,113 @@
+""" Region properties of many rois measured in one pass over their pixels
+
+The rois of an image are rasterized once into run-length labels (RoiRuns)
+and every labelled pixel is visited once, in row order, accumulating the
+statistics of all labels together. Overlapping rois are measured
+independently, as ImageJ does with one roi at a time. Values are
+uncalibrated (pixels), like ImageProcessor.getStatistics().
+"""
+from RoiRuns import RoiToRuns
+
+def LabelRuns(rois) :
+    """ Rasterize rois into (label, run set) pairs; labels start at 1 in roi order """
+    return [(i + 1, RoiToRuns(roi)) for i, roi in enumerate(rois)]
+
+def NewRegion(label) :
+    """ Empty accumulator of one label """
+    region = {}
+    region['Label']     =   label
+    region['Area']      =   0
+    region['SumX']      =   0.0
+    region['SumY']      =   0.0
+    region['Sum']       =   0.0
+    region['SumVX']     =   0.0
+    region['SumVY']     =   0.0
+    region['Min']       =   float('inf')
+    region['Max']       =   float('-inf')
+    region['Box']       =   None    # (x0, y0, x1, y1), x1 and y1 exclusive
+    return region
+
+def _RowRuns(labelruns, width, height) :
+    """ Merge the runs of all labels into one list sorted by row, clipped to the image """
+    merged = []
+    for label, runs in labelruns :
+        for row, start, end in zip(runs['Rows'], runs['Starts'], runs['Ends']) :
+            if 0 <= row < height :
+                start, end = max(start, 0), min(end, width)
+                if start < end :
+                    merged.append((row, start, end, label))
+    merged.sort()
+    return merged
+
+def AddRun(region, values, row, start) :
+    """ Accumulate the pixel values of one run starting at (start, row) """
+    n = len(values)
+    end = start + n
+    total = sum(values)
+    region['Area']  +=  n
+    region['SumX']  +=  n * (start + end) / 2.0     # Pixel centers x + 0.5
+    region['SumY']  +=  n * (row + 0.5)
+    region['Sum']   +=  total
+    region['SumVX'] +=  sum(v * x for x, v in enumerate(values, start)) + 0.5 * total
+    region['SumVY'] +=  total * (row + 0.5)
+    region['Min']   =   min(region['Min'], min(values))
+    region['Max']   =   max(region['Max'], max(values))
+    box = region['Box']
+    if box is None :
+        region['Box'] = (start, row, end, row + 1)
+    else :
+        region['Box'] = (min(box[0], start), min(box[1], row), max(box[2], end), max(box[3], row + 1))
+
+def MergeRegion(region, part) :
+    """ Add the sums of a partial region, e.g. measured in another tile """
+    for key in ('Area', 'SumX', 'SumY', 'Sum', 'SumVX', 'SumVY') :
+        region[key] += part[key]
+    region['Min'] = min(region['Min'], part['Min'])
+    region['Max'] = max(region['Max'], part['Max'])
+    if region['Box'] is None :
+        region['Box'] = part['Box']
+    elif part['Box'] is not None :
+        a, b = region['Box'], part['Box']
+        region['Box'] = (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def RegionProps(pixels, width, height, labelruns) :
+    """ Measure every label over a row-major pixel array in a single pass
+
+    Returns one dictionary per label, in label order, with Area, Centroid,
+    CenterOfMass (intensity weighted), Mean, Min, Max and Box. Labels with
+    no pixel inside the image have Area 0 and None for the other values.
+    """
+    regions = dict((label, NewRegion(label)) for label, runs in labelruns)
+    for row, start, end, label in _RowRuns(labelruns, width, height) :
+        offset = row * width
+        AddRun(regions[label], pixels[offset + start:offset + end], row, start)
+    return [FinishRegion(regions[label]) for label, runs in labelruns]
+
+def FinishRegion(region) :
+    """ Turn the sums of a label into its properties """
+    props = {}
+    props['Label']  =   region['Label']
+    props['Area']   =   region['Area']
+    n = region['Area']
+    if n == 0 :
+        for key in ('Centroid', 'CenterOfMass', 'Mean', 'Min', 'Max', 'Box') :
+            props[key] = None
+        return props
+    total = region['Sum']
+    props['Centroid']       =   (region['SumX'] / n, region['SumY'] / n)
+    if total != 0 :
+        props['CenterOfMass']   =   (region['SumVX'] / total, region['SumVY'] / total)
+    else :  # Undefined on a zero-intensity region, NaN as in ImageJ
+        props['CenterOfMass']   =   (float('nan'), float('nan'))
+    props['Mean']   =   total / n
+    props['Min']    =   region['Min']
+    props['Max']    =   region['Max']
+    props['Box']    =   region['Box']
+    return props
+
+def MeasureRois(ip, rois) :
+    """ Measure all rois of an ImageProcessor at once """
+    fp = ip.convertToFloatProcessor()
+    return RegionProps(fp.getPixels(), fp.getWidth(), fp.getHeight(), LabelRuns(rois))
+
+###----EOF----
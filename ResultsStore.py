@@ -0,0 +1,245 @@
+""" Buffered columnar results store shared by the measurement scripts
+
+A store is a directory holding one little-endian binary file per column
+and a schema.json with the column types, the committed row count and the
+dictionaries of the string columns. Rows are buffered in memory and
+appended to the column files in large blocks; the schema is rewritten
+last, so a crash mid-flush leaves the store at its previous block.
+Rewrites (DropRows) write a new generation of column files and switch
+to it by replacing the schema, so a crash leaves either the old or the
+new store, never a mix.
+
+Column types: 'float' (float64), 'int' (int64) and 'str' (int32 codes
+into a per-column dictionary, cheap for repeated image names and labels).
+"""
+import os
+import csv
+import json
+import struct
+import threading
+try :
+    import numpy as np
+except ImportError :    # Jython inside Fiji
+    np = None
+
+BlockRows = 65536
+_Formats = {'float' : 'd', 'int' : 'q', 'str' : 'i'}
+
+def _ColumnPath(path, name, index, generation=0) :
+    """ Return the file of a column; names are indexed to stay filesystem safe """
+    if generation == 0 :
+        return os.path.join(path, 'col%03d.bin' % index)
+    return os.path.join(path, 'col%03d.g%d.bin' % (index, generation))
+
+def _WriteSchema(store) :
+    """ Replace schema.json atomically """
+    schema = {}
+    schema['Columns']       =   store['Columns']
+    schema['Rows']          =   store['Rows']
+    schema['Dictionaries']  =   store['Dictionaries']
+    schema['Generation']    =   store['Generation']     # Of the column files
+    schemapath = os.path.join(store['Path'], 'schema.json')
+    with open(schemapath + '.tmp', 'w') as f :
+        json.dump(schema, f)
+    if os.path.exists(schemapath) :
+        os.remove(schemapath)
+    os.rename(schemapath + '.tmp', schemapath)
+
+def _ReadSchema(path) :
+    """ Read schema.json of a store """
+    with open(os.path.join(path, 'schema.json'), 'r') as f :
+        return json.load(f)
+
+def OpenResults(path, columns) :
+    """ Open a store for appending, creating it if needed
+
+    columns is a list of [name, type]; an existing store must have the same.
+    Column files longer than the committed row count (interrupted flush) are
+    truncated back; shorter ones are corrupted and raise. Column files of
+    other generations (interrupted rewrite) are removed.
+    """
+    columns = [[name, ctype] for name, ctype in columns]
+    store = {'Path' : path, 'Columns' : columns, 'Rows' : 0, 'Dictionaries' : {}, 'Generation' : 0,
+             'Buffer' : [], 'Lock' : threading.Lock()}
+    if os.path.isfile(os.path.join(path, 'schema.json')) :
+        schema = _ReadSchema(path)
+        if schema['Columns'] != columns :
+            raise Exception("Results store %s has columns %s, not %s" % (path, schema['Columns'], columns))
+        store['Rows'] = schema['Rows']
+        store['Dictionaries'] = schema['Dictionaries']
+        store['Generation'] = schema.get('Generation', 0)
+        current = set()
+        for i, (name, ctype) in enumerate(columns) :
+            colpath = _ColumnPath(path, name, i, store['Generation'])
+            current.add(os.path.basename(colpath))
+            size = store['Rows'] * struct.calcsize('<' + _Formats[ctype])
+            if not os.path.isfile(colpath) or os.path.getsize(colpath) < size :
+                raise Exception("Results store %s is corrupted: %s holds fewer than %d rows"
+                                % (path, colpath, store['Rows']))
+            with open(colpath, 'ab') as f :
+                f.truncate(size)
+        for fn in os.listdir(path) :
+            if fn.startswith('col') and fn.endswith('.bin') and fn not in current :
+                os.remove(os.path.join(path, fn))
+    else :
+        if not os.path.isdir(path) :
+            os.makedirs(path)
+        for i, (name, ctype) in enumerate(columns) :
+            if ctype not in _Formats :
+                raise Exception("Unknown column type %s" % ctype)
+            open(_ColumnPath(path, name, i), 'wb').close()
+        _WriteSchema(store)
+    store['Codes'] = dict((name, dict((v, k) for k, v in enumerate(values)))
+                          for name, values in store['Dictionaries'].items())
+    return store
+
+def AppendRows(store, rows) :
+    """ Buffer rows (dictionaries keyed by column name); flushes every BlockRows rows
+
+    Returns True when the rows were flushed, so callers can commit what
+    depends on them (e.g. journal entries) only once they are on disk.
+    """
+    store['Lock'].acquire()
+    try :
+        store['Buffer'].extend(rows)
+        full = len(store['Buffer']) >= BlockRows
+    finally :
+        store['Lock'].release()
+    if full :
+        FlushResults(store)
+    return full
+
+def _Encode(store, name, value) :
+    """ Return the dictionary code of a string value """
+    codes = store['Codes'].setdefault(name, {})
+    code = codes.get(value)
+    if code is None :
+        values = store['Dictionaries'].setdefault(name, [])
+        code = codes[value] = len(values)
+        values.append(value)
+    return code
+
+def FlushResults(store) :
+    """ Append the buffered rows to the column files in one block per column """
+    store['Lock'].acquire()
+    try :
+        rows, store['Buffer'] = store['Buffer'], []
+        if not rows :
+            return
+        for i, (name, ctype) in enumerate(store['Columns']) :
+            if ctype == 'str' :
+                values = [_Encode(store, name, u'' if r.get(name) is None else u'%s' % r[name]) for r in rows]
+            elif ctype == 'int' :
+                values = [int(r[name]) for r in rows]
+            else :
+                values = [float('nan') if r.get(name) is None else float(r[name]) for r in rows]
+            with open(_ColumnPath(store['Path'], name, i, store['Generation']), 'ab') as f :
+                f.write(struct.pack('<%d%s' % (len(values), _Formats[ctype]), *values))
+        store['Rows'] += len(rows)
+        _WriteSchema(store)
+    finally :
+        store['Lock'].release()
+
+def CloseResults(store) :
+    """ Flush the remaining rows """
+    FlushResults(store)
+
+def ReadResults(path, names=None) :
+    """ Read the committed rows as a dictionary of columns
+
+    Numeric columns are NumPy arrays when NumPy is importable, lists
+    otherwise; string columns are lists.
+    """
+    schema = _ReadSchema(path)
+    n = schema['Rows']
+    table = {}
+    for i, (name, ctype) in enumerate(schema['Columns']) :
+        if names is not None and name not in names :
+            continue
+        fmt = _Formats[ctype]
+        with open(_ColumnPath(path, name, i, schema.get('Generation', 0)), 'rb') as f :
+            data = f.read(n * struct.calcsize('<' + fmt))
+        if ctype == 'str' :
+            dictionary = schema['Dictionaries'].get(name, [])
+            table[name] = [dictionary[c] for c in struct.unpack('<%d%s' % (n, fmt), data)]
+        elif np is not None :
+            table[name] = np.frombuffer(data, dtype='<f8' if ctype == 'float' else '<i8').copy()
+        else :
+            table[name] = list(struct.unpack('<%d%s' % (n, fmt), data))
+    return table
+
+def IterRows(path) :
+    """ Yield the committed rows as dictionaries in insertion order, reading one block at a time """
+    schema = _ReadSchema(path)
+    columns = schema['Columns']
+    generation = schema.get('Generation', 0)
+    files = [open(_ColumnPath(path, name, i, generation), 'rb') for i, (name, ctype) in enumerate(columns)]
+    try :
+        done = 0
+        while done < schema['Rows'] :
+            n = min(BlockRows, schema['Rows'] - done)
+            block = []
+            for f, (name, ctype) in zip(files, columns) :
+                fmt = _Formats[ctype]
+                values = struct.unpack('<%d%s' % (n, fmt), f.read(n * struct.calcsize('<' + fmt)))
+                if ctype == 'str' :
+                    dictionary = schema['Dictionaries'].get(name, [])
+                    values = [dictionary[c] for c in values]
+                block.append(values)
+            for k in range(n) :
+                yield dict((name, block[i][k]) for i, (name, ctype) in enumerate(columns))
+            done += n
+    finally :
+        for f in files :
+            f.close()
+
+def DropRows(path, name, values) :
+    """ Rewrite a closed store without the rows whose column name is in values
+
+    The kept rows go to a new generation of column files; replacing the
+    schema commits them, then the old files are removed.
+    """
+    values = set(values)
+    schema = _ReadSchema(path)
+    table = ReadResults(path)
+    keep = [i for i, v in enumerate(table[name]) if v not in values]
+    if len(keep) == schema['Rows'] :
+        return 0
+    old, generation = schema.get('Generation', 0), schema.get('Generation', 0) + 1
+    for i, (cname, ctype) in enumerate(schema['Columns']) :
+        column = table[cname]
+        if ctype == 'str' :
+            codes = dict((v, k) for k, v in enumerate(schema['Dictionaries'].get(cname, [])))
+            kept = [codes[column[k]] for k in keep]
+        else :
+            kept = [column[k] for k in keep]
+        with open(_ColumnPath(path, cname, i, generation), 'wb') as f :
+            f.write(struct.pack('<%d%s' % (len(kept), _Formats[ctype]), *kept))
+    dropped = schema['Rows'] - len(keep)
+    store = {'Path' : path, 'Columns' : schema['Columns'], 'Rows' : len(keep),
+             'Dictionaries' : schema['Dictionaries'], 'Generation' : generation}
+    _WriteSchema(store)
+    for i, (cname, ctype) in enumerate(schema['Columns']) :
+        try :
+            os.remove(_ColumnPath(path, cname, i, old))
+        except OSError :    # Removed when the store is opened next
+            pass
+    return dropped
+
+def Utf8(value) :
+    """ Encode a unicode value as UTF-8 for the byte-string CSV writers of Python 2, other values unchanged """
+    if not isinstance(value, str) and hasattr(value, 'encode') :    # unicode; str is already text on Python 3
+        return value.encode('utf-8')
+    return value
+
+def ExportCsv(path, csvpath, header=None, delimiter=',') :
+    """ Export a store to CSV in column order, strings in UTF-8; header maps column names to titles """
+    schema = _ReadSchema(path)
+    names = [name for name, ctype in schema['Columns']]
+    with open(csvpath, 'w') as out :
+        writer = csv.writer(out, delimiter=delimiter, lineterminator='\n')
+        writer.writerow([Utf8((header or {}).get(name, name)) for name in names])
+        for row in IterRows(path) :
+            writer.writerow([Utf8(row[name]) for name in names])
+
+###----EOF----
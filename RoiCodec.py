@@ -0,0 +1,199 @@
+""" Standalone ImageJ .roi/.zip decoder and encoder
+
+Reads and writes the binary roi format of ij.io.RoiDecoder/RoiEncoder
+without a JVM, so saved RoiManager sets can be measured in CPython worker
+processes. Coordinates are returned as NumPy arrays when NumPy is
+importable, as array('d') otherwise (Jython inside Fiji).
+"""
+import io
+import math
+import struct
+import zipfile
+from array import array
+try :
+    import numpy as np
+except ImportError :    # Jython inside Fiji
+    np = None
+
+# Header layout of ij.io.RoiDecoder, big-endian
+VERSION_OFFSET  =   4
+TYPE            =   6
+TOP             =   8
+LEFT            =   10
+BOTTOM          =   12
+RIGHT           =   14
+N_COORDINATES   =   16
+X1, Y1, X2, Y2  =   18, 22, 26, 30
+XD, YD, WIDTHD, HEIGHTD = 18, 22, 26, 30
+SIZE            =   18
+SHAPE_ROI_SIZE  =   36
+OPTIONS         =   50
+POSITION        =   56
+HEADER2_OFFSET  =   60
+COORDINATES     =   64
+HEADER_SIZE     =   64
+HEADER2_SIZE    =   64
+# Header2 layout
+C_POSITION, Z_POSITION, T_POSITION = 4, 8, 12
+NAME_OFFSET     =   16
+NAME_LENGTH     =   20
+
+SUB_PIXEL_RESOLUTION    =   128
+VERSION         =   228
+
+RoiTypes = {0 : 'polygon', 1 : 'rect', 2 : 'oval', 3 : 'line', 4 : 'freeline', 5 : 'polyline',
+            7 : 'freehand', 8 : 'traced', 9 : 'angle', 10 : 'point'}
+TypeCodes = dict((v, k) for k, v in RoiTypes.items())
+PolygonTypes = ('polygon', 'freeline', 'polyline', 'freehand', 'traced', 'angle', 'point')
+
+def _Coords(values) :
+    """ Return coordinates in the array type of this interpreter """
+    if np is not None :
+        return np.asarray(values, dtype=np.float64)
+    return array('d', values)
+
+def OvalOutline(left, top, width, height) :
+    """ Approximate an oval by a polygon with about one vertex per pixel of perimeter """
+    a, b = width / 2.0, height / 2.0
+    n = max(8, int(math.pi * (a + b)))
+    xs = [left + a + a * math.cos(2 * math.pi * i / n) for i in range(n)]
+    ys = [top + b + b * math.sin(2 * math.pi * i / n) for i in range(n)]
+    return xs, ys
+
+def DecodeRoi(data, name=None) :
+    """ Decode the bytes of one .roi file into a dictionary """
+    if data[:4] != b'Iout' :
+        raise Exception("Not an ImageJ roi: %s" % name)
+    def Short(off) : return struct.unpack_from('>h', data, off)[0]
+    def UShort(off) : return struct.unpack_from('>H', data, off)[0]
+    def Int(off) : return struct.unpack_from('>i', data, off)[0]
+    def Float(off) : return struct.unpack_from('>f', data, off)[0]
+
+    version = Short(VERSION_OFFSET)
+    typecode = struct.unpack_from('>B', data, TYPE)[0]
+    if typecode not in RoiTypes :
+        raise Exception("Unsupported roi type %d: %s" % (typecode, name))
+    if Int(SHAPE_ROI_SIZE) > 0 :
+        raise Exception("Composite (shape) rois are not supported: %s" % name)
+    top, left, bottom, right = Short(TOP), Short(LEFT), Short(BOTTOM), Short(RIGHT)
+    n = UShort(N_COORDINATES)
+    if n == 0 and RoiTypes[typecode] in PolygonTypes :
+        n = Int(SIZE)
+    options = Short(OPTIONS)
+    subpixel = (options & SUB_PIXEL_RESOLUTION) != 0 and version >= 222
+
+    roi = {}
+    roi['Type']     =   RoiTypes[typecode]
+    roi['Name']     =   name
+    roi['Left'], roi['Top']         =   left, top
+    roi['Width'], roi['Height']     =   right - left, bottom - top
+    roi['Position'] =   Int(POSITION) if version >= 218 else 0
+    roi['Options']  =   options
+
+    hdr2 = Int(HEADER2_OFFSET) if version >= 218 else 0
+    if hdr2 > 0 and hdr2 + HEADER2_SIZE <= len(data) :
+        roi['CPosition'], roi['ZPosition'], roi['TPosition'] = \
+            Int(hdr2 + C_POSITION), Int(hdr2 + Z_POSITION), Int(hdr2 + T_POSITION)
+        offset, length = Int(hdr2 + NAME_OFFSET), Int(hdr2 + NAME_LENGTH)
+        if offset > 0 and length > 0 and offset + 2 * length <= len(data) :
+            roi['Name'] = data[offset:offset + 2 * length].decode('utf-16-be')
+
+    if roi['Type'] in ('rect', 'oval') :
+        x0, y0, w, h = float(left), float(top), float(roi['Width']), float(roi['Height'])
+        if subpixel and version >= 223 :
+            x0, y0, w, h = Float(XD), Float(YD), Float(WIDTHD), Float(HEIGHTD)
+        if roi['Type'] == 'rect' :
+            xs, ys = [x0, x0 + w, x0 + w, x0], [y0, y0, y0 + h, y0 + h]
+        else :
+            xs, ys = OvalOutline(x0, y0, w, h)
+    elif roi['Type'] == 'line' :
+        xs, ys = [Float(X1), Float(X2)], [Float(Y1), Float(Y2)]
+    else :
+        if subpixel :
+            base = COORDINATES + 4 * n
+            xs = struct.unpack_from('>%df' % n, data, base)
+            ys = struct.unpack_from('>%df' % n, data, base + 4 * n)
+        else :
+            xs = [left + v for v in struct.unpack_from('>%dh' % n, data, COORDINATES)]
+            ys = [top + v for v in struct.unpack_from('>%dh' % n, data, COORDINATES + 2 * n)]
+    roi['X'], roi['Y'] = _Coords(xs), _Coords(ys)
+    return roi
+
+def EncodeRoi(roi) :
+    """ Encode a roi dictionary (Type, X, Y and optionally Name, Position) as .roi bytes """
+    rtype = roi['Type']
+    if rtype not in TypeCodes :
+        raise Exception("Unsupported roi type %s" % rtype)
+    xs, ys = [float(v) for v in roi['X']], [float(v) for v in roi['Y']]
+    n = len(xs)
+    name = roi.get('Name') or ''
+    if rtype in ('rect', 'oval') and 'Width' in roi :
+        x0, y0, w, h = roi['Left'], roi['Top'], roi['Width'], roi['Height']
+    else :
+        x0, y0 = min(xs), min(ys)
+        w, h = max(xs) - x0, max(ys) - y0
+    left, top = int(math.floor(x0)), int(math.floor(y0))
+    right, bottom = int(math.ceil(x0 + w)), int(math.ceil(y0 + h))
+    subpixel = any(v != int(v) for v in list(xs) + list(ys) + [x0, y0, w, h])
+
+    if rtype in PolygonTypes :
+        ncoords = n * 4 + (n * 8 if subpixel else 0)
+    else :
+        ncoords = 0
+    hdr2 = HEADER_SIZE + ncoords
+    data = bytearray(hdr2 + HEADER2_SIZE + 2 * len(name))
+    struct.pack_into('>4shB', data, 0, b'Iout', VERSION, TypeCodes[rtype])
+    struct.pack_into('>hhhh', data, TOP, top, left, bottom, right)
+    if rtype in PolygonTypes :
+        if n > 65535 :
+            struct.pack_into('>i', data, SIZE, n)
+        else :
+            struct.pack_into('>H', data, N_COORDINATES, n)
+        struct.pack_into('>%dh' % n, data, COORDINATES, *[int(v) - left for v in xs])
+        struct.pack_into('>%dh' % n, data, COORDINATES + 2 * n, *[int(v) - top for v in ys])
+        if subpixel :
+            struct.pack_into('>%df' % n, data, COORDINATES + 4 * n, *xs)
+            struct.pack_into('>%df' % n, data, COORDINATES + 8 * n, *ys)
+    elif rtype == 'line' :
+        struct.pack_into('>ffff', data, X1, xs[0], ys[0], xs[1], ys[1])
+    elif subpixel :     # rect, oval
+        struct.pack_into('>ffff', data, XD, x0, y0, w, h)
+    struct.pack_into('>h', data, OPTIONS, SUB_PIXEL_RESOLUTION if subpixel else 0)
+    struct.pack_into('>ii', data, POSITION, roi.get('Position', 0), hdr2)
+    struct.pack_into('>iii', data, hdr2 + C_POSITION,
+                     roi.get('CPosition', 0), roi.get('ZPosition', 0), roi.get('TPosition', 0))
+    struct.pack_into('>ii', data, hdr2 + NAME_OFFSET, hdr2 + HEADER2_SIZE, len(name))
+    data[hdr2 + HEADER2_SIZE:] = name.encode('utf-16-be')
+    return bytes(data)
+
+def ReadRois(path) :
+    """ Read a .roi file or a RoiManager .zip into a list of roi dictionaries """
+    if path.lower().endswith('.zip') :
+        rois = []
+        with zipfile.ZipFile(path) as zf :
+            for entry in zf.namelist() :
+                if entry.lower().endswith('.roi') :
+                    rois.append(DecodeRoi(zf.read(entry), entry[:-4]))
+        return rois
+    with io.open(path, 'rb') as f :
+        name = path.replace('\\', '/').split('/')[-1][:-4]
+        return [DecodeRoi(f.read(), name)]
+
+def WriteRois(path, rois) :
+    """ Write roi dictionaries to a .roi file (one roi) or a RoiManager .zip """
+    if path.lower().endswith('.zip') :
+        seen = set()
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf :
+            for i, roi in enumerate(rois) :
+                label = roi.get('Name') or '%04d' % (i + 1)
+                while label in seen :   # Entry names must be unique, as in RoiManager
+                    label += '-1'
+                seen.add(label)
+                zf.writestr(label + '.roi', EncodeRoi(roi))
+        return
+    if len(rois) != 1 :
+        raise Exception("A .roi file holds exactly one roi")
+    with io.open(path, 'wb') as f :
+        f.write(EncodeRoi(rois[0]))
+
+###----EOF----
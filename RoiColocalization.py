@@ -3,35 +3,9 @@ from ij import IJ
 from ij.gui import ShapeRoi
 from fiji.util.gui import GenericDialogPlus
 from ij.plugin.frame import RoiManager
-
-def AreRoisOverlapped(roi1, roi2) : 
-    """Check if roi1 and roi2 are overlapped"""
-    if len(roi1.containedPoints) >= len(roi2.containedPoints) :
-        broi, sroi = roi1, roi2
-    else :
-        broi, sroi = roi2, roi1
-    for pt in sroi.containedPoints :
-        if broi.containsPoint(pt.x, pt.y) :
-            rslt = True
-            break
-    else :
-        rslt = False
-    return rslt
-
-def SeekCsvDialect(fn) :
-    """Seek dialect in the file and return the dialect"""
-    first100lns = [ln for i, ln in enumerate(io.open(fn, 'r', newline='')) if i < 100]
-    dlist = []
-    offset = 0
-    for ln in first100lns :
-        dialect = csv.Sniffer().sniff(ln)
-        dlist.append((offset, dialect))
-        offset += len(ln)
-    target = dlist[-1][1].delimiter
-    for offset, dialect in dlist : 
-        if dialect.delimiter == target : 
-            break 
-    return dialect, offset
+from RoiOverlap import ColocalizeRois
+from CsvTools import StreamAnnotateCsv
+from RoiCodec import ReadRois
 
 # I/O
 workpath = IJ.getImage().getOriginalFileInfo().directory
@@ -54,71 +28,33 @@ if gui.wasOKed():
     PathToFlagRois = gui.getNextString()
     PathToFlagCSV = gui.getNextString()
 
-# Co-localization analysis
-rm = RoiManager.getInstance()
-rm.runCommand('Reset')
-rm.runCommand('Open', PathToMitoRois)
-mito_list = [roi for roi in rm.getRoisAsArray()]
-rm.runCommand('Reset')
-rm.runCommand('Open', PathToFlagRois)
-flag_list = [roi for roi in rm.getRoisAsArray()]
-rm.runCommand('Reset')
-mito_dict = {}
-flag_dict = dict.fromkeys([roi.getName() for roi in flag_list], None)
-for mitoroi in mito_list : 
-    k = ''.join(mitoroi.getName().split())
-    vlist = []
-    for flagroi in flag_list : 
-        flaglabel = flagroi.getName()
-        if AreRoisOverlapped(mitoroi, flagroi) : 
-            vlist.append(flaglabel)
-            flag_list.remove(flagroi)
-    mito_dict[k] = vlist
-for k, vlist in mito_dict.items() : 
-    for flaglabel in vlist : 
-        flag_dict[flaglabel] = k
+# Co-localization analysis, reading the roi sets directly without RoiManager
+mito_list = ReadRois(PathToMitoRois)
+flag_list = ReadRois(PathToFlagRois)
+mito_dict, flag_dict, overlap_dict = ColocalizeRois(mito_list, flag_list)
 
 # Write out
-mitomeasurement = []
-dial, offset = SeekCsvDialect(PathToMitoCSV)
-mitomeasurementfieldnames = []
-with io.open(PathToMitoCSV, 'r', newline='') as mitocsv : 
-    mitocsv.seek(offset)
-    csv.register_dialect('local', dial)
-    dictreader = csv.DictReader(mitocsv, dialect='local')
-    mitomeasurementfieldnames = [name for name in dictreader.fieldnames]
-    for row in dictreader : 
-        k = ''.join(row['Mito #'].split())
-        row.update(ColocalizedRois = len(mito_dict[k]))
-        mitomeasurement.append(row)
-mitomeasurementfieldnames.append('ColocalizedRois')
-
-flagmeasurement = []
-dial, offset = SeekCsvDialect(PathToFlagCSV)
-flagmeasurementfieldnames = []
-with io.open(PathToFlagCSV, 'r', newline='') as flagcsv : 
-    flagcsv.seek(offset)
-    csv.register_dialect('local', dial)
-    dictreader = csv.DictReader(flagcsv, dialect='local')
-    flagmeasurementfieldnames = [name for name in dictreader.fieldnames]
-    for row in dictreader : 
-        row.update(ColocalizedMito = flag_dict[row['Label']])
-        flagmeasurement.append(row)
-flagmeasurementfieldnames.append('ColocalizedMito')
+def AnnotateMito(row) : 
+    k = ''.join(row['Mito #'].split())
+    flaglabels = mito_dict[k]
+    return {'ColocalizedRois' : len(flaglabels),
+            'ColocalizedPixels' : sum(overlap_dict[f]['OverlapPixels'] for f in flaglabels),
+            'ColocalizedFraction' : sum(overlap_dict[f]['Fraction1'] for f in flaglabels)}
+
+def AnnotateFlag(row) : 
+    m = overlap_dict.get(row['Label'], {})
+    return {'ColocalizedMito' : flag_dict[row['Label']],
+            'OverlapPixels' : m.get('OverlapPixels', 0),
+            'IoU' : m.get('IoU', 0.0),
+            'CoveredFraction' : m.get('Fraction2', 0.0)}
 
 newmitocsvname = os.path.splitext(PathToMitoCSV)[0] + '_proc.csv'
-with open(newmitocsvname, 'w') as out : 
-    writer = csv.DictWriter(out, fieldnames=mitomeasurementfieldnames, dialect='excel')
-    writer.writeheader()
-    for mito in mitomeasurement : 
-        writer.writerow(mito)
+StreamAnnotateCsv(PathToMitoCSV, newmitocsvname,
+                  ['ColocalizedRois', 'ColocalizedPixels', 'ColocalizedFraction'], AnnotateMito)
 
 newflagcsvname = os.path.splitext(PathToFlagCSV)[0] + '_proc.csv'
-with open(newflagcsvname, 'w') as out : 
-    writer = csv.DictWriter(out, fieldnames=flagmeasurementfieldnames, dialect='excel')
-    writer.writeheader()
-    for flag in flagmeasurement : 
-        writer.writerow(flag)
+StreamAnnotateCsv(PathToFlagCSV, newflagcsvname,
+                  ['ColocalizedMito', 'OverlapPixels', 'IoU', 'CoveredFraction'], AnnotateFlag)
 print 'All complete! Hope you get a nice result.'
 print '~~~ greeting from Jingqi ~~~'
 ##----EOF----
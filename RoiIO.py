@@ -0,0 +1,41 @@
+""" Load saved ImageJ roi sets without a RoiManager window """
+import os
+
+def LoadRoiZip(path) :
+    """ Decode the rois of a RoiManager .zip (or a single .roi) file, headless safe """
+    import jarray
+    from java.io import FileInputStream, ByteArrayOutputStream
+    from java.util.zip import ZipInputStream
+    from ij.io import RoiDecoder
+
+    if path.lower().endswith('.roi') :
+        return [RoiDecoder(path).getRoi()]
+    rois = []
+    zin = ZipInputStream(FileInputStream(path))
+    buf = jarray.zeros(8192, 'b')
+    try :
+        entry = zin.getNextEntry()
+        while entry is not None :
+            name = entry.getName()
+            if name.lower().endswith('.roi') :
+                out = ByteArrayOutputStream()
+                n = zin.read(buf)
+                while n >= 0 :
+                    out.write(buf, 0, n)
+                    n = zin.read(buf)
+                roi = RoiDecoder(out.toByteArray(), name).getRoi()
+                if roi is not None :
+                    if roi.getName() is None :
+                        roi.setName(os.path.splitext(os.path.basename(name))[0])
+                    rois.append(roi)
+            entry = zin.getNextEntry()
+    finally :
+        zin.close()
+    return rois
+
+def IsHeadless() :
+    """ Check if ImageJ runs without a display """
+    from java.awt import GraphicsEnvironment
+    return GraphicsEnvironment.isHeadless()
+
+###----EOF----
@@ -0,0 +1,98 @@
+""" Roi overlap tests and bounding-box spatial index for co-localization """
+from RoiRuns import RoiToRuns, IntersectRuns, OverlapMetrics, ClearRunsCache
+
+
+def AreRoisOverlapped(roi1, roi2) :
+    """Check if roi1 and roi2 are overlapped"""
+    return IntersectRuns(RoiToRuns(roi1), RoiToRuns(roi2), firstonly=True) > 0
+
+def RoiOverlapMetrics(roi1, roi2) :
+    """ Return overlap pixels, IoU and the fraction of roi1 and roi2 covered """
+    return OverlapMetrics(RoiToRuns(roi1), RoiToRuns(roi2))
+
+def RoiBounds(roi) :
+    """ Return the bounding box of a roi as (x0, y0, x1, y1), x1 and y1 exclusive """
+    if isinstance(roi, dict) :  # Decoded by RoiCodec
+        return RoiToRuns(roi)['Box']
+    r = roi.getBounds()
+    return (r.x, r.y, r.x + r.width, r.y + r.height)
+
+def RoiName(roi) :
+    """ Return the label of an ImageJ roi or of a RoiCodec roi dictionary """
+    if isinstance(roi, dict) :
+        return roi['Name']
+    return roi.getName()
+
+def BoxesIntersect(box1, box2) :
+    """ Check if two (x0, y0, x1, y1) boxes share at least one pixel """
+    return box1[0] < box2[2] and box2[0] < box1[2] and \
+           box1[1] < box2[3] and box2[1] < box1[3]
+
+def _GridCells(box, cellsize) :
+    """ Yield the grid cells covered by a box """
+    for cx in range(box[0] // cellsize, (box[2] - 1) // cellsize + 1) :
+        for cy in range(box[1] // cellsize, (box[3] - 1) // cellsize + 1) :
+            yield (cx, cy)
+
+def BuildRoiIndex(rois, cellsize=None, bounds=RoiBounds) :
+    """ Bin the roi bounding boxes into a uniform grid, built once per image """
+    boxes = [bounds(roi) for roi in rois]
+    if cellsize is None :
+        # Median box side, so that a typical roi spans one or two cells
+        sides = sorted(max(b[2] - b[0], b[3] - b[1]) for b in boxes)
+        cellsize = sides[len(sides) // 2] if sides else 1
+    cellsize = max(int(cellsize), 1)
+    cells = {}
+    for i, box in enumerate(boxes) :
+        for cell in _GridCells(box, cellsize) :
+            cells.setdefault(cell, []).append(i)
+    index = {}
+    index['Rois']       =   list(rois)
+    index['Boxes']      =   boxes
+    index['CellSize']   =   cellsize
+    index['Cells']      =   cells
+    return index
+
+def QueryRoiIndex(index, box) :
+    """ Return the sorted positions of indexed rois whose boxes intersect box """
+    found = set()
+    cells, boxes = index['Cells'], index['Boxes']
+    for cell in _GridCells(box, index['CellSize']) :
+        for i in cells.get(cell, ()) :
+            if i not in found and BoxesIntersect(box, boxes[i]) :
+                found.add(i)
+    return sorted(found)
+
+def ColocalizeRois(mito_list, flag_list, overlap=RoiOverlapMetrics, bounds=RoiBounds) :
+    """ Pair every flag roi with the first mito roi overlapping it
+
+    Only the flag rois whose bounding boxes intersect a mito roi reach the
+    exact overlap test. Returns mito_dict (mito key -> flag labels),
+    flag_dict (flag label -> mito key or None) and metrics (flag label ->
+    overlap metrics with its mito roi, Fraction1 being the mito side).
+    """
+    index = BuildRoiIndex(flag_list, bounds=bounds)
+    claimed = [False] * len(flag_list)
+    mito_dict = {}
+    flag_dict = dict.fromkeys([RoiName(roi) for roi in flag_list], None)
+    metrics = {}
+    for mitoroi in mito_list :
+        k = ''.join(RoiName(mitoroi).split())
+        vlist = []
+        for i in QueryRoiIndex(index, bounds(mitoroi)) :
+            if claimed[i] :
+                continue
+            flagroi = flag_list[i]
+            m = overlap(mitoroi, flagroi)
+            if m['OverlapPixels'] > 0 :
+                vlist.append(RoiName(flagroi))
+                metrics[RoiName(flagroi)] = m
+                claimed[i] = True
+        mito_dict[k] = vlist
+    for k, vlist in mito_dict.items() :
+        for flaglabel in vlist :
+            flag_dict[flaglabel] = k
+    ClearRunsCache(list(mito_list) + list(flag_list))
+    return mito_dict, flag_dict, metrics
+
+###----EOF----
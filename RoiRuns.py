@@ -0,0 +1,220 @@
+""" Compact row-wise run-length representation of roi masks """
+import math
+from array import array
+
+# Runs of a roi built once and reused across overlap tests
+_RunsCache = {}
+
+def EmptyRuns() :
+    """ Return a run set without any pixel """
+    runs = {}
+    runs['Rows']    =   array('i')
+    runs['Starts']  =   array('i')
+    runs['Ends']    =   array('i')     # Exclusive
+    runs['Area']    =   0
+    runs['Box']     =   (0, 0, 0, 0)    # (x0, y0, x1, y1), x1 and y1 exclusive
+    return runs
+
+def AppendRun(runs, row, start, end) :
+    """ Append one run; runs must be appended in (row, start) order """
+    runs['Rows'].append(row)
+    runs['Starts'].append(start)
+    runs['Ends'].append(end)
+    runs['Area'] += end - start
+
+def FinishRuns(runs) :
+    """ Compute the bounding box once all runs are appended """
+    if runs['Area'] :
+        runs['Box'] = (min(runs['Starts']), runs['Rows'][0], max(runs['Ends']), runs['Rows'][-1] + 1)
+    return runs
+
+def MaskToRuns(mask, x0, y0, width, height) :
+    """ Encode a row-major mask (nonzero = inside) located at (x0, y0) """
+    runs = EmptyRuns()
+    for y in range(height) :
+        offset = y * width
+        x = 0
+        while x < width :
+            if mask[offset + x] :
+                start = x
+                while x < width and mask[offset + x] :
+                    x += 1
+                AppendRun(runs, y0 + y, x0 + start, x0 + x)
+            else :
+                x += 1
+    return FinishRuns(runs)
+
+def BoxToRuns(x0, y0, x1, y1) :
+    """ Encode a filled rectangle """
+    runs = EmptyRuns()
+    for y in range(y0, y1) :
+        AppendRun(runs, y, x0, x1)
+    return FinishRuns(runs)
+
+def PolygonToRuns(xs, ys) :
+    """ Encode a closed polygon; a pixel is inside when its center is (even-odd rule) """
+    n = len(xs)
+    runs = EmptyRuns()
+    if n < 3 :
+        return runs
+    xs, ys = [float(v) for v in xs], [float(v) for v in ys]
+    edges = [(xs[i], ys[i], xs[i - 1], ys[i - 1]) for i in range(n) if ys[i] != ys[i - 1]]
+    y0, y1 = int(math.floor(min(ys))), int(math.ceil(max(ys)))
+    for y in range(y0, y1) :
+        yc = y + 0.5
+        crossings = sorted(xa + (yc - ya) * (xb - xa) / (yb - ya)
+                           for xa, ya, xb, yb in edges if (ya <= yc) != (yb <= yc))
+        for k in range(0, len(crossings) - 1, 2) :
+            start = int(math.ceil(crossings[k] - 0.5))
+            end = int(math.ceil(crossings[k + 1] - 0.5))
+            if start < end :
+                AppendRun(runs, y, start, end)
+    return FinishRuns(runs)
+
+def DecodedRoiToRuns(roi) :
+    """ Encode a roi dictionary of RoiCodec, cached in the dictionary """
+    runs = roi.get('Runs')
+    if runs is None :
+        if roi['Type'] == 'rect' :
+            x0, y0 = int(math.floor(roi['X'][0])), int(math.floor(roi['Y'][0]))
+            x1, y1 = int(math.ceil(roi['X'][2])), int(math.ceil(roi['Y'][2]))
+            runs = BoxToRuns(x0, y0, x1, y1)
+        elif roi['Type'] == 'point' :
+            runs = EmptyRuns()
+            for y, x in sorted(set((int(y), int(x)) for x, y in zip(roi['X'], roi['Y']))) :
+                AppendRun(runs, y, x, x + 1)
+            FinishRuns(runs)
+        else :
+            runs = PolygonToRuns(roi['X'], roi['Y'])
+        roi['Runs'] = runs
+    return runs
+
+def RoiToRuns(roi) :
+    """ Encode an ImageJ roi, cached per roi and location """
+    if isinstance(roi, dict) :
+        return DecodedRoiToRuns(roi)
+    r = roi.getBounds()
+    key = (roi, r.x, r.y, r.width, r.height)
+    runs = _RunsCache.get(key)
+    if runs is None :
+        mask = roi.getMask()
+        if mask is None :   # Rectangle
+            runs = BoxToRuns(r.x, r.y, r.x + r.width, r.y + r.height)
+        else :
+            runs = MaskToRuns(mask.getPixels(), r.x, r.y, mask.getWidth(), mask.getHeight())
+        _RunsCache[key] = runs
+    return runs
+
+def ClearRunsCache(rois=None) :
+    """ Drop the cached runs of rois, or all of them, e.g. after RoiManager 'Reset'
+
+    Concurrent jobs share the cache, so a job drops only the rois it encoded.
+    """
+    if rois is None :
+        _RunsCache.clear()
+        return
+    rois = set(roi for roi in rois if not isinstance(roi, dict))   # Decoded rois keep their own runs
+    for key in list(_RunsCache.keys()) :
+        if key[0] in rois :
+            _RunsCache.pop(key, None)
+
+def _RowSpan(rows, i) :
+    """ Return the end of the block of runs sharing the row at position i """
+    j = i
+    while j < len(rows) and rows[j] == rows[i] :
+        j += 1
+    return j
+
+def IntersectRuns(runs1, runs2, firstonly=False) :
+    """ Count the pixels shared by two run sets with a merge of sorted runs """
+    b1, b2 = runs1['Box'], runs2['Box']
+    if not (b1[0] < b2[2] and b2[0] < b1[2] and b1[1] < b2[3] and b2[1] < b1[3]) :
+        return 0
+    rows1, starts1, ends1 = runs1['Rows'], runs1['Starts'], runs1['Ends']
+    rows2, starts2, ends2 = runs2['Rows'], runs2['Starts'], runs2['Ends']
+    n1, n2 = len(rows1), len(rows2)
+    i = j = 0
+    shared = 0
+    while i < n1 and j < n2 :
+        if rows1[i] < rows2[j] :
+            i += 1
+        elif rows2[j] < rows1[i] :
+            j += 1
+        else :
+            # Merge the two interval lists of this row
+            iend, jend = _RowSpan(rows1, i), _RowSpan(rows2, j)
+            while i < iend and j < jend :
+                lo = max(starts1[i], starts2[j])
+                hi = min(ends1[i], ends2[j])
+                if lo < hi :
+                    shared += hi - lo
+                    if firstonly :
+                        return shared
+                if ends1[i] <= ends2[j] :
+                    i += 1
+                else :
+                    j += 1
+            i, j = iend, jend
+    return shared
+
+def _Find(parent, i) :
+    """ Root of i in a union-find forest, with path halving """
+    while parent[i] != i :
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+def _Union(parent, i, j) :
+    """ Join two trees; the smaller root wins so labels do not depend on the merge order """
+    ri, rj = _Find(parent, i), _Find(parent, j)
+    if ri < rj :
+        parent[rj] = ri
+    elif rj < ri :
+        parent[ri] = rj
+
+def ConnectedRuns(rows, starts, ends, connectivity=8) :
+    """ Label the connected components of runs sorted by (row, start) with union-find
+
+    Runs touching on the same row (end == next start, e.g. split at a tile
+    seam) are connected. Returns one component number per run, numbered
+    0, 1, ... in order of the first run of each component.
+    """
+    n = len(rows)
+    parent = list(range(n))
+    reach = 1 if connectivity == 8 else 0   # Diagonal neighbours
+    prev, cur = 0, 0    # First run of the previous and of the current row
+    for i in range(n) :
+        if i > 0 and rows[i] != rows[i - 1] :
+            prev = cur if rows[cur] == rows[i] - 1 else i
+            cur = i
+        elif i > 0 and ends[i - 1] >= starts[i] :
+            _Union(parent, i - 1, i)
+        # Runs of the row above touching this run, diagonals included for 8-connectivity.
+        # Both rows are sorted, so runs ending left of this one are never looked at again
+        while prev < cur and ends[prev] + reach <= starts[i] :
+            prev += 1
+        k = prev
+        while k < cur and starts[k] < ends[i] + reach :
+            _Union(parent, k, i)
+            k += 1
+    labels, numbers = [], {}
+    for i in range(n) :
+        root = _Find(parent, i)
+        if root not in numbers :
+            numbers[root] = len(numbers)
+        labels.append(numbers[root])
+    return labels
+
+def OverlapMetrics(runs1, runs2) :
+    """ Return overlap pixel count, IoU and the fraction of each run set covered """
+    shared = IntersectRuns(runs1, runs2)
+    a1, a2 = runs1['Area'], runs2['Area']
+    union = a1 + a2 - shared
+    metrics = {}
+    metrics['OverlapPixels']    =   shared
+    metrics['IoU']              =   float(shared) / union if union else 0.0
+    metrics['Fraction1']        =   float(shared) / a1 if a1 else 0.0
+    metrics['Fraction2']        =   float(shared) / a2 if a2 else 0.0
+    return metrics
+
+###----EOF----
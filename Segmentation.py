@@ -0,0 +1,183 @@
+""" Automatic threshold segmentation into roi sets
+
+A channel is thresholded automatically (Otsu or Li on its integer
+histogram), its foreground runs are labelled with union-find
+(Tiles.TiledObjects, plane by plane or tile by tile) and every object is
+written as a traced roi of a RoiManager .zip plus one CSV row, the inputs
+RoiColocalization expects.
+"""
+import csv
+import math
+from RoiCodec import WriteRois
+from Tiles import TileGrid, TiledObjects
+
+ThresholdMethods = ['Otsu', 'Li']
+FloatBins = 4096    # Histogram bins over the data range of float (and 32-bit) channels
+
+def NewHistogram(maxvalue) :
+    """ Integer histogram of the values 0..maxvalue """
+    return [0] * (int(maxvalue) + 1)
+
+def AddHistogram(hist, pixels, minvalue=0.0, binwidth=1.0) :
+    """ Count pixel values in bins of binwidth from minvalue, clamped to the histogram range """
+    last = len(hist) - 1
+    if minvalue == 0 and binwidth == 1 :
+        for v in pixels :
+            hist[min(max(int(v), 0), last)] += 1
+        return
+    for v in pixels :
+        hist[min(max(int((v - minvalue) / binwidth), 0), last)] += 1
+
+def OtsuThreshold(hist) :
+    """ Level maximizing the between-class variance; the foreground is above it """
+    total = sum(hist)
+    sumall = sum(i * h for i, h in enumerate(hist))
+    best, level = -1.0, 0
+    n0 = s0 = 0.0
+    for t in range(len(hist) - 1) :
+        n0 += hist[t]
+        s0 += t * hist[t]
+        n1 = total - n0
+        if n0 == 0 or n1 == 0 :
+            continue
+        m0, m1 = s0 / n0, (sumall - s0) / n1
+        between = n0 * n1 * (m0 - m1) ** 2
+        if between > best :
+            best, level = between, t
+    return level
+
+def LiThreshold(hist) :
+    """ Iterative minimum cross entropy level of Li, as in ImageJ; the foreground is above it """
+    total = sum(hist)
+    if total == 0 :
+        return 0
+    # Cumulative counts and sums, so every iteration is O(1)
+    counts, sums = [0], [0.0]
+    for i, h in enumerate(hist) :
+        counts.append(counts[-1] + h)
+        sums.append(sums[-1] + i * h)
+    last = len(hist) - 1
+    newlevel = sums[-1] / total
+    level = 0
+    for iteration in range(1000) :
+        oldlevel = newlevel
+        level = min(max(int(oldlevel + 0.5), 0), last)
+        nback, sback = counts[level + 1], sums[level + 1]
+        nobj, sobj = total - nback, sums[-1] - sback
+        meanback = sback / nback if nback else 0.0
+        meanobj = sobj / nobj if nobj else 0.0
+        if meanback <= 0 or meanobj <= 0 or meanback == meanobj :
+            break
+        temp = (meanback - meanobj) / (math.log(meanback) - math.log(meanobj))
+        newlevel = int(temp - 0.5) if temp < -2.220446049250313e-16 else int(temp + 0.5)
+        if abs(newlevel - oldlevel) <= 0.5 :
+            break
+    return level
+
+def AutoThreshold(hist, method) :
+    """ Return the lowest foreground value of a histogram with Otsu or Li """
+    if method == 'Otsu' :
+        return OtsuThreshold(hist) + 1
+    if method == 'Li' :
+        return LiThreshold(hist) + 1
+    raise Exception("Unknown threshold %s, expected one of %s" % (method, ', '.join(ThresholdMethods)))
+
+def RunsOutline(runs) :
+    """ Trace the outer outline of an 8-connected run set along pixel edges
+
+    Returns the vertices (xs, ys) at pixel corners, clockwise on screen, as
+    the Wand tool traces them; holes are not part of the outline.
+    """
+    x0, y0, x1, y1 = runs['Box']
+    width = x1 - x0
+    mask = bytearray(width * (y1 - y0))
+    for row, start, end in zip(runs['Rows'], runs['Starts'], runs['Ends']) :
+        offset = (row - y0) * width - x0
+        mask[offset + start:offset + end] = b'\x01' * (end - start)
+    def Inside(x, y) :
+        return x0 <= x < x1 and y0 <= y < y1 and mask[(y - y0) * width + x - x0] == 1
+    # Directions right, down, left, up; the object stays on the right-hand side
+    steps = [(1, 0), (0, 1), (-1, 0), (0, -1)]
+    # Pixels ahead-left and ahead-right of the vertex (x, y) for each direction
+    ahead = [((0, -1), (0, 0)), ((0, 0), (-1, 0)), ((-1, 0), (-1, -1)), ((-1, -1), (0, -1))]
+    startx, starty = runs['Starts'][0], runs['Rows'][0]
+    x, y, d = startx, starty, 0
+    xs, ys = [], []
+    while True :
+        (lx, ly), (rx, ry) = ahead[d]
+        if Inside(x + lx, y + ly) :
+            nd = (d + 3) % 4    # Turn left, diagonal neighbours are connected
+        elif Inside(x + rx, y + ry) :
+            nd = d
+        else :
+            nd = (d + 1) % 4    # Turn right
+        if nd != d or not xs :
+            xs.append(x)
+            ys.append(y)
+        d = nd
+        x, y = x + steps[d][0], y + steps[d][1]
+        if x == startx and y == starty :
+            break
+    return xs, ys
+
+def ObjectRois(objects, namefmt='%04d') :
+    """ Return traced roi dictionaries of RoiCodec, named by the object label """
+    rois = []
+    for obj in objects :
+        xs, ys = RunsOutline(obj['Runs'])
+        rois.append({'Type' : 'traced', 'Name' : namefmt % obj['Props']['Label'], 'X' : xs, 'Y' : ys})
+    return rois
+
+ObjectFields = ['Label', 'Mito #', 'Area', 'Mean', 'Min', 'Max', 'X', 'Y', 'XM', 'YM', 'BX', 'BY', 'Width', 'Height']
+
+def WriteObjects(objects, roipath, csvpath, namefmt='%04d') :
+    """ Write the objects as a roi .zip and a measurement CSV keyed by roi name """
+    WriteRois(roipath, ObjectRois(objects, namefmt))
+    with open(csvpath, 'w') as out :
+        writer = csv.DictWriter(out, fieldnames=ObjectFields, dialect='excel')
+        writer.writeheader()
+        for obj in objects :
+            props = obj['Props']
+            x0, y0, x1, y1 = props['Box']
+            row = {}
+            row['Label'] = row['Mito #'] = namefmt % props['Label']
+            row['Area'], row['Mean'], row['Min'], row['Max'] = props['Area'], props['Mean'], props['Min'], props['Max']
+            row['X'], row['Y'] = props['Centroid']
+            row['XM'], row['YM'] = props['CenterOfMass']
+            row['BX'], row['BY'], row['Width'], row['Height'] = x0, y0, x1 - x0, y1 - y0
+            writer.writerow(row)
+
+def SegmentChannel(readtile, width, height, maxvalue, method='Otsu', tilesize=0,
+                   workers=1, budget=None, connectivity=8) :
+    """ Threshold a channel automatically and return its threshold and objects
+
+    readtile(tile) returns the pixels of a tile of Tiles.TileGrid; without
+    tiling it is called once with the whole plane. The histogram is
+    accumulated over the same tiles first, so the threshold is global; every
+    tile is read twice, so readtile should serve repeated reads from a cache
+    (PlaneCache.CachedTiles) rather than decode again. maxvalue None stands
+    for float data: the histogram then has FloatBins bins over the data
+    range, found by one more pass over the tiles.
+    """
+    tilesize = tilesize or max(width, height)
+    tiles = TileGrid(width, height, tilesize)
+    minvalue, binwidth = 0.0, 1.0
+    if maxvalue is None :
+        lo = hi = None
+        for tile in tiles :
+            fp = readtile(tile).convertToFloatProcessor()
+            fp.resetMinAndMax()
+            lo = fp.getMin() if lo is None else min(lo, fp.getMin())
+            hi = fp.getMax() if hi is None else max(hi, fp.getMax())
+        minvalue = lo
+        binwidth = (hi - lo) / FloatBins if hi > lo else 1.0
+        hist = NewHistogram(FloatBins - 1)
+    else :
+        hist = NewHistogram(maxvalue)
+    for tile in tiles :
+        AddHistogram(hist, readtile(tile).convertToFloatProcessor().getPixels(), minvalue, binwidth)
+    threshold = minvalue + AutoThreshold(hist, method) * binwidth
+    objects = TiledObjects(readtile, width, height, threshold, tilesize, 0, workers, budget, None, connectivity)
+    return threshold, objects
+
+###----EOF----
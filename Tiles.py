@@ -0,0 +1,113 @@
+""" Tiled processing of planes larger than the heap
+
+A plane is cut into a grid of tiles read through sub-region reads. Each
+tile owns a core rectangle; the tile is read with an overlap margin around
+its core so neighbourhood filters see the same pixels as on the whole
+plane, but only core pixels are measured. Foreground objects are kept as
+runs with partial region sums, and the runs of all tiles are joined across
+the seams with union-find (RoiRuns.ConnectedRuns). The result does not
+depend on the tile size or on the order tiles finish in.
+"""
+from RoiRuns import EmptyRuns, AppendRun, FinishRuns, ConnectedRuns
+from RegionProps import NewRegion, AddRun, MergeRegion, FinishRegion
+from BatchExecutor import RunBatch, MegaBytes
+
+def TileGrid(width, height, tilesize, overlap=0) :
+    """ Cut a width x height plane into tiles of at most tilesize, read with overlap pixels of margin """
+    tiles = []
+    for y0 in range(0, height, tilesize) :
+        for x0 in range(0, width, tilesize) :
+            x1, y1 = min(x0 + tilesize, width), min(y0 + tilesize, height)
+            tile = {}
+            tile['Core']    =   (x0, y0, x1, y1)    # Pixels this tile measures, x1 and y1 exclusive
+            tile['X']       =   max(x0 - overlap, 0)
+            tile['Y']       =   max(y0 - overlap, 0)
+            tile['Width']   =   min(x1 + overlap, width) - tile['X']
+            tile['Height']  =   min(y1 + overlap, height) - tile['Y']
+            tiles.append(tile)
+    return tiles
+
+def TileRuns(pixels, tile, threshold) :
+    """ Foreground runs (value >= threshold) of the tile core, in plane coordinates
+
+    pixels is the row-major array of the whole read region of the tile.
+    Returns a list of (row, start, end, region) with the partial sums of
+    each run.
+    """
+    x0, y0, x1, y1 = tile['Core']
+    width = tile['Width']
+    runs = []
+    for row in range(y0, y1) :
+        offset = (row - tile['Y']) * width - tile['X']
+        values = pixels[offset + x0:offset + x1]
+        x = 0
+        n = len(values)
+        while x < n :
+            if values[x] >= threshold :
+                start = x
+                while x < n and values[x] >= threshold :
+                    x += 1
+                region = NewRegion(None)
+                AddRun(region, values[start:x], row, x0 + start)
+                runs.append((row, x0 + start, x0 + x, region))
+            else :
+                x += 1
+    return runs
+
+def MergeTileRuns(tileruns, connectivity=8) :
+    """ Join the runs of all tiles into objects
+
+    Returns one dictionary per object, ordered by its first pixel in raster
+    order, with Runs (a run set, seam splits rejoined) and Props (the
+    properties of RegionProps, Label numbered from 1).
+    """
+    allruns = sorted((run for runs in tileruns for run in runs), key=lambda r : (r[0], r[1]))
+    labels = ConnectedRuns([r[0] for r in allruns], [r[1] for r in allruns], [r[2] for r in allruns], connectivity)
+    objects = []
+    for (row, start, end, region), label in zip(allruns, labels) :
+        if label == len(objects) :
+            objects.append({'Runs' : EmptyRuns(), 'Region' : NewRegion(label + 1)})
+        obj = objects[label]
+        runs = obj['Runs']
+        if runs['Rows'] and runs['Rows'][-1] == row and runs['Ends'][-1] == start :
+            runs['Ends'][-1] = end  # Rejoin a run split at a vertical seam
+            runs['Area'] += end - start
+        else :
+            AppendRun(runs, row, start, end)
+        MergeRegion(obj['Region'], region)
+    for obj in objects :
+        FinishRuns(obj['Runs'])
+        obj['Props'] = FinishRegion(obj.pop('Region'))
+    return objects
+
+def TiledObjects(readtile, width, height, threshold, tilesize=2048, overlap=0,
+                 workers=1, budget=None, prefilter=None, connectivity=8) :
+    """ Segment a plane tile by tile and measure its objects
+
+    readtile(tile) must return the ImageProcessor of the tile read region.
+    prefilter(ip), if given, runs on every tile before thresholding; overlap
+    must cover its radius. Tiles run in parallel through RunBatch, each
+    reserving from the memory budget the tile as read (4 bytes per pixel at
+    most, float when z-projected), the float copy of a z-plane a projection
+    adds and the float copy that is thresholded.
+    """
+    def process(tile, budget) :
+        reserved = 0
+        if budget is not None :
+            reserved = budget.Acquire(MegaBytes(tile['Width'] * tile['Height'] * 12))
+        try :
+            ip = readtile(tile)
+            if prefilter is not None :
+                ip = prefilter(ip)
+            return TileRuns(ip.convertToFloatProcessor().getPixels(), tile, threshold)
+        finally :
+            if budget is not None :
+                budget.Release(reserved)
+    tileruns = []
+    for tile, runs, error in RunBatch(TileGrid(width, height, tilesize, overlap), process, workers, budget) :
+        if error is not None :
+            raise Exception("Tile %s failed: %s" % (tile['Core'], error))
+        tileruns.append(runs)
+    return MergeTileRuns(tileruns, connectivity)
+
+###----EOF----
@@ -0,0 +1,178 @@
+""" Per-stage timing and memory trace of batch runs
+
+Wrap a stage in 'with Stage(name, image) :' or decorate a function with
+@Traced(). While tracing is enabled every stage records its wall time, CPU
+time of its thread, heap in use and the bytes decoded inside it (AddBytes);
+nested stages inherit the image of the enclosing one. While it is disabled
+Stage returns a shared no-op and Traced calls straight through, so the
+instrumentation can stay in place.
+"""
+import json
+import time
+import threading
+
+try :
+    from java.lang import Runtime
+    from java.lang.management import ManagementFactory
+    _ThreadBean = ManagementFactory.getThreadMXBean()
+
+    def _CpuTime() :
+        """ CPU seconds of the current thread """
+        return _ThreadBean.getCurrentThreadCpuTime() / 1e9
+
+    def _HeapMB() :
+        """ JVM heap in use, in MB """
+        rt = Runtime.getRuntime()
+        return (rt.totalMemory() - rt.freeMemory()) / (1024.0 * 1024.0)
+except ImportError :
+    _CpuTime = getattr(time, 'thread_time', None) or getattr(time, 'process_time', None) or time.clock
+
+    def _HeapMB() :
+        """ No heap figure outside the JVM """
+        return None
+
+_State = {'Events' : None, 'Start' : 0.0}   # Events is None while tracing is disabled
+_Lock = threading.Lock()
+_Local = threading.local()  # Innermost open stage of each thread
+
+def EnableTrace() :
+    """ Start recording stages, dropping any previous events """
+    _State['Start'] = time.time()
+    _State['Events'] = []
+
+def DisableTrace() :
+    """ Stop recording and return the recorded events """
+    events = _State['Events'] or []
+    _State['Events'] = None
+    return events
+
+class _Stage(object) :
+    """ One running stage of a thread """
+
+    def __init__(self, name, image) :
+        self.name = name
+        self.image = image
+
+    def __enter__(self) :
+        self.parent = getattr(_Local, 'stage', None)
+        if self.image is None and self.parent is not None :
+            self.image = self.parent.image
+        self.bytes = 0
+        self.heap = _HeapMB()
+        self.cpu = _CpuTime()
+        self.wall = time.time()
+        _Local.stage = self
+        return self
+
+    def __exit__(self, exctype, value, tb) :
+        wall, cpu, heap = time.time() - self.wall, _CpuTime() - self.cpu, _HeapMB()
+        _Local.stage = self.parent
+        if self.parent is not None :
+            self.parent.bytes += self.bytes
+        event = {}
+        event['Stage']      =   self.name
+        event['Image']      =   self.image
+        event['Parent']     =   self.parent.name if self.parent is not None else None
+        event['Thread']     =   threading.currentThread().getName()
+        event['Start']      =   self.wall - _State['Start']
+        event['Wall']       =   wall
+        event['Cpu']        =   cpu
+        event['HeapMB']     =   heap
+        event['HeapDeltaMB']    =   heap - self.heap if heap is not None and self.heap is not None else None
+        event['Bytes']      =   self.bytes
+        event['Failed']     =   exctype is not None
+        _Lock.acquire()
+        try :
+            events = _State['Events']
+            if events is not None :
+                events.append(event)
+        finally :
+            _Lock.release()
+        return False
+
+class _NoStage(object) :
+    """ Stage used while tracing is disabled """
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self, exctype, value, tb) :
+        return False
+
+_Off = _NoStage()
+
+def Stage(name, image=None) :
+    """ Context manager recording one stage, of image or of the enclosing stage's image """
+    if _State['Events'] is None :
+        return _Off
+    return _Stage(name, image)
+
+def Traced(name=None) :
+    """ Decorator recording every call of a function as a stage, named after the function by default """
+    def Decorate(func) :
+        stage = name or func.__name__
+        def Wrapper(*args, **kwargs) :
+            if _State['Events'] is None :
+                return func(*args, **kwargs)
+            with _Stage(stage, None) :
+                return func(*args, **kwargs)
+        Wrapper.__name__ = func.__name__
+        Wrapper.__doc__ = func.__doc__
+        return Wrapper
+    return Decorate
+
+def AddBytes(nbytes) :
+    """ Count bytes read by the innermost stage of the thread (and so by its parents) """
+    if _State['Events'] is None :
+        return
+    stage = getattr(_Local, 'stage', None)
+    if stage is not None :
+        stage.bytes += nbytes
+
+SummaryFields = ['Stage', 'Count', 'Images', 'Failed', 'Wall', 'MeanWall', 'MaxWall', 'Cpu', 'MaxHeapMB', 'Bytes']
+
+def TraceSummary(events) :
+    """ Totals per stage, in order of first appearance; times include nested stages """
+    rows, order = {}, []
+    for e in events :
+        row = rows.get(e['Stage'])
+        if row is None :
+            row = dict((k, 0) for k in SummaryFields)
+            row['Stage'], row['Images'], row['MaxHeapMB'] = e['Stage'], set(), None
+            rows[e['Stage']] = row
+            order.append(e['Stage'])
+        row['Count']    +=  1
+        row['Failed']   +=  int(e['Failed'])
+        row['Wall']     +=  e['Wall']
+        row['MaxWall']  =   max(row['MaxWall'], e['Wall'])
+        row['Cpu']      +=  e['Cpu']
+        row['Bytes']    +=  e['Bytes']
+        if e['HeapMB'] is not None :
+            row['MaxHeapMB'] = max(row['MaxHeapMB'], e['HeapMB'])
+        if e['Image'] is not None :
+            row['Images'].add(e['Image'])
+    summary = []
+    for name in order :
+        row = rows[name]
+        row['Images'] = len(row['Images'])
+        row['MeanWall'] = row['Wall'] / row['Count']
+        summary.append(row)
+    return summary
+
+def PrintSummary(summary) :
+    """ Print the stage totals as a table """
+    print "%-20s %7s %7s %10s %10s %10s %10s %10s" % ('Stage', 'Count', 'Images', 'Wall (s)', 'Mean (s)',
+                                                      'CPU (s)', 'Heap (MB)', 'Read (MB)')
+    for row in summary :
+        heap = '%10.1f' % row['MaxHeapMB'] if row['MaxHeapMB'] is not None else '%10s' % '-'
+        print "%-20s %7d %7d %10.3f %10.3f %10.3f %s %10.1f" % (row['Stage'], row['Count'], row['Images'],
+              row['Wall'], row['MeanWall'], row['Cpu'], heap, row['Bytes'] / (1024.0 * 1024.0))
+
+def WriteTrace(path, events) :
+    """ Write the events and their per-stage summary as JSON, return the summary """
+    summary = TraceSummary(events)
+    with open(path, 'w') as f :
+        json.dump({'Events' : events, 'Summary' : summary}, f, indent=1, sort_keys=True)
+    return summary
+
+###----EOF----
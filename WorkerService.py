@@ -0,0 +1,240 @@
+""" Long-running worker that keeps Fiji warm and runs jobs from a spool directory
+
+Start it once, headless:
+
+    ImageJ-linux64 --headless --console WorkerService.py
+
+and submit jobs with SubmitJob (or by dropping a JSON file into
+<spool>/jobs). A job names a script (measure, getDistanceArea or
+BatchMitoAnalysis), its parameters and optionally the image paths to
+restrict it to; the worker writes <spool>/done/<job>.json with the status
+and the result paths.
+
+Every job loads its own copy of the script module, so concurrent jobs do
+not share globals, and runs headless: rois come from the saved .zip files
+(RoiIO, RoiCodec) instead of the RoiManager singleton, so one job's
+'Reset' cannot clobber another's rois. Jobs on the same data directory
+share its journal and results store and run one after the other; a
+traced job switches the process-wide stage trace and runs alone.
+"""
+import os
+import imp
+import json
+import time
+import uuid
+import threading
+import Journal
+try :
+    from java.lang import Throwable     # Java exceptions raised inside Fiji
+    _Errors = (Exception, Throwable)
+except ImportError :
+    _Errors = (Exception,)
+
+ScriptDir = os.path.dirname(os.path.abspath(Journal.__file__))
+Scripts = ['measure', 'getDistanceArea', 'BatchMitoAnalysis']
+DefaultSpool = os.environ.get('IMAGEJ_MEASURE_SPOOL', os.path.join(os.path.expanduser('~'), '.imagej_measure_spool'))
+
+def SpoolDirs(spool) :
+    """ Create and return the job, running and done directories of a spool """
+    dirs = {}
+    for name in ('jobs', 'running', 'done') :
+        dirs[name] = os.path.join(spool, name)
+        if not os.path.isdir(dirs[name]) :
+            os.makedirs(dirs[name])
+    return dirs
+
+def _WriteJson(path, data) :
+    """ Write a JSON file atomically, so readers never see it half written """
+    with open(path + '.tmp', 'w') as f :
+        json.dump(data, f, indent=1, sort_keys=True)
+    if os.path.exists(path) :
+        os.remove(path)
+    os.rename(path + '.tmp', path)
+
+def SubmitJob(script, params, images=None, spool=DefaultSpool) :
+    """ Queue a job and return its id """
+    if script not in Scripts :
+        raise Exception("Unknown script %s, expected one of %s" % (script, ', '.join(Scripts)))
+    job = {}
+    job['Id']       =   time.strftime('%Y%m%d-%H%M%S-') + uuid.uuid4().hex[:8]
+    job['Script']   =   script
+    job['Params']   =   params
+    job['Images']   =   images
+    _WriteJson(os.path.join(SpoolDirs(spool)['jobs'], job['Id'] + '.json'), job)
+    return job['Id']
+
+def WaitJob(jobid, spool=DefaultSpool, timeout=None, interval=0.5) :
+    """ Wait for a job and return its result, None on timeout """
+    path = os.path.join(SpoolDirs(spool)['done'], jobid + '.json')
+    t0 = time.time()
+    while not os.path.isfile(path) :
+        if timeout is not None and time.time() - t0 > timeout :
+            return None
+        time.sleep(interval)
+    with open(path, 'r') as f :
+        return json.load(f)
+
+_Gate = threading.Condition()
+_Jobs = {'Running' : 0, 'Exclusive' : False, 'Waiting' : 0}   # Waiting: exclusive jobs queued
+_DirLocks = {}  # Absolute data directory -> lock held by the job running on it
+
+def _BeginJob(exclusive) :
+    """ Wait until a job may start; an exclusive job waits for the running ones and blocks new ones """
+    _Gate.acquire()
+    try :
+        if exclusive :
+            _Jobs['Waiting'] += 1
+        while _Jobs['Exclusive'] or (_Jobs['Running'] if exclusive else _Jobs['Waiting']) :
+            _Gate.wait()
+        if exclusive :
+            _Jobs['Waiting'] -= 1
+            _Jobs['Exclusive'] = True
+        _Jobs['Running'] += 1
+    finally :
+        _Gate.release()
+
+def _EndJob(exclusive) :
+    """ Let the waiting jobs start """
+    _Gate.acquire()
+    try :
+        _Jobs['Running'] -= 1
+        if exclusive :
+            _Jobs['Exclusive'] = False
+        _Gate.notifyAll()
+    finally :
+        _Gate.release()
+
+def _DirLock(directory) :
+    """ Return the lock of a data directory """
+    _Gate.acquire()
+    try :
+        lock = _DirLocks.get(directory)
+        if lock is None :
+            lock = _DirLocks[directory] = threading.Lock()
+        return lock
+    finally :
+        _Gate.release()
+
+def LoadScript(script) :
+    """ Load a private copy of a script module for one job """
+    name = '%s_job_%s' % (script, uuid.uuid4().hex[:8])
+    return imp.load_source(name, os.path.join(ScriptDir, script + '.py'))
+
+def RunJob(job) :
+    """ Run one job in its own module namespace and return the result paths
+
+    Waits for the jobs running on the same data directory, and for every
+    job when it is traced.
+    """
+    module = LoadScript(job['Script'])
+    params = dict(job.get('Params') or {})
+    if job['Script'] == 'BatchMitoAnalysis' :
+        directory = params['imgdir']
+    else :
+        directory = params.get('imagepath', module.imagepath)
+    exclusive = bool(params.get('trace'))
+    _BeginJob(exclusive)
+    try :
+        lock = _DirLock(os.path.abspath(directory))
+        lock.acquire()
+        try :
+            return _RunModule(module, job, params)
+        finally :
+            lock.release()
+    finally :
+        _EndJob(exclusive)
+
+def _RunModule(module, job, params) :
+    """ Configure and run the script module of a job """
+    images = job.get('Images')
+    if job['Script'] == 'BatchMitoAnalysis' :
+        imgdir = params.pop('imgdir')
+        return [module.RunAnalysis(imgdir, images=images, **params)]
+    # measure and getDistanceArea are configured by their module globals
+    for key, value in params.items() :
+        if not hasattr(module, key) :
+            raise Exception("%s has no parameter %s" % (job['Script'], key))
+        setattr(module, key, value)
+    module.headless = True
+    if images is not None :
+        loader = lambda path, prefix, suffix : iter(images)
+        module.imageloader = module.ImageLoader = loader
+    return module.main()
+
+def Warmup() :
+    """ Load the classes jobs use once, so the first job does not pay for it """
+    try :
+        from loci.formats import ImageReader
+        from ij.io import RoiDecoder
+        ImageReader().close()
+    except ImportError :
+        pass
+    for script in Scripts :
+        try :
+            LoadScript(script)
+        except _Errors as e :
+            print "Could not preload %s: %s" % (script, e)
+
+def _Claim(dirs) :
+    """ Move the oldest queued job to running; the rename is the lock between workers """
+    for fn in sorted(os.listdir(dirs['jobs'])) :
+        if not fn.endswith('.json') :
+            continue
+        running = os.path.join(dirs['running'], fn)
+        try :
+            os.rename(os.path.join(dirs['jobs'], fn), running)
+        except OSError :    # Claimed by another worker
+            continue
+        return running
+    return None
+
+def _Serve(dirs, stop, interval) :
+    """ Worker thread: claim and run jobs until stop is set """
+    while not stop.isSet() :
+        running = _Claim(dirs)
+        if running is None :
+            time.sleep(interval)
+            continue
+        rslt = {'Status' : 'failed', 'Outputs' : [], 'Error' : None}
+        t0 = time.time()
+        try :
+            with open(running, 'r') as f :
+                job = json.load(f)
+            rslt['Id'] = job.get('Id')
+            rslt['Outputs'] = RunJob(job) or []
+            rslt['Status'] = 'done'
+        except _Errors as e :
+            rslt['Error'] = str(e)
+        rslt['Seconds'] = time.time() - t0
+        _WriteJson(os.path.join(dirs['done'], os.path.basename(running)), rslt)
+        os.remove(running)
+
+def Serve(spool=DefaultSpool, workers=1, interval=1.0) :
+    """ Run jobs from the spool until interrupted
+
+    Jobs left running by a crashed worker are queued again, so a spool
+    is served by one worker process (with any number of job threads).
+    """
+    dirs = SpoolDirs(spool)
+    for fn in os.listdir(dirs['running']) :
+        os.rename(os.path.join(dirs['running'], fn), os.path.join(dirs['jobs'], fn))
+    Warmup()
+    print "Worker ready, spool %s" % spool
+    stop = threading.Event()
+    threads = [threading.Thread(target=_Serve, args=(dirs, stop, interval), name='JobWorker-%d' % n)
+               for n in range(max(int(workers), 1))]
+    for t in threads :
+        t.setDaemon(True)
+        t.start()
+    try :
+        while True :
+            time.sleep(interval)
+    except KeyboardInterrupt :
+        stop.set()
+    for t in threads :
+        t.join()
+
+if __name__ == '__main__' :
+    Serve(workers=int(os.environ.get('IMAGEJ_MEASURE_WORKERS', '1')))
+
+###----EOF----
@@ -6,6 +6,11 @@ from ij import IJ, WindowManager, ImagePlus
 from ij.gui import PointRoi, GenericDialog
 from ij.plugin.frame import RoiManager
 from ij.measure import Measurements, ResultsTable
+from Geometry import PolygonPairs
+from RoiIO import LoadRoiZip, IsHeadless
+from Journal import JournalPath, LoadJournal, NeedsProcessing, Record
+from Prefetch import Prefetch
+from ResultsStore import OpenResults, AppendRows, FlushResults, CloseResults, IterRows, DropRows, Utf8
     
 # glob var
 imagepath = "E:\data\YG0_class"
@@ -13,59 +18,16 @@ imageprefix = "class"
 imagesuffix = ".tiff"
 pixelsize = float(698.74/(2048*0.64444))
 result = "YG0_class_measurement.csv"
+headless = IsHeadless()   # Measure from the saved .zip Rois, no drawing
+prefetch = 2    # Images opened ahead in the background
+version = 2     # Bump when the measurements change, so every image is measured again
+resultcolumns = [['type', 'str'], ['Image Name', 'str'], ['Label', 'str'], ['Value', 'float']]
 
 def ImageLoader(imagepath,prefix,suffix):
     """Create an iterator to load image."""
     imagewildcard = prefix + '*' + suffix
     return glob.iglob(os.path.join(imagepath, imagewildcard))
 
-def PolygonToPoints(polygonroi):
-    """Collect the coordinates of a Polygon in a dictionary."""
-    Xpoints = polygonroi.getPolygon().xpoints
-    Ypoints = polygonroi.getPolygon().ypoints
-    if len(Xpoints) != len(Ypoints): 
-        raise Exception("Polygon is not correct!")
-    PointDict = {}
-    for i in range(len(Xpoints)):
-        pointname = 'Point%02d' % (i+1)
-        coordinate = (Xpoints[i], Ypoints[i])
-        PointDict[pointname] = coordinate
-    return PointDict
-
-def GetConsecutivePair(alist):
-    """Compute the consecutive distance"""
-    ConsecutivePair = []
-    # Add the tail-head pair first
-    ConsecutivePair.append((alist[-1],alist[0]))
-    # Loop throught the list
-    for i in range(len(alist)-1):
-        if (alist[i],alist[i+1]) not in ConsecutivePair: 
-            ConsecutivePair.append((alist[i],alist[i+1]))
-
-    return ConsecutivePair
-
-def GetNonConsecutivePair(alist):
-    """Compute the nonconsecutive distance"""
-    consecutivelist = GetConsecutivePair(alist)
-    # Duplicate the alist
-    copylist = alist
-    # Loop through the list
-    NonConsecutiveDist = [] 
-    for x in alist: 
-        for y in copylist: 
-            if x == y: 
-                continue
-            elif (x,y) in consecutivelist: 
-                continue
-            elif (y,x) in consecutivelist:
-                continue
-            elif (y,x) in NonConsecutiveDist:
-                continue
-            else:
-                NonConsecutiveDist.append((x,y))
-
-    return NonConsecutiveDist
-
 def PolygonArea(imp, polygon): 
     """Measure the area of the polygon on the image."""
     ip = imp.getProcessor()
@@ -89,18 +51,126 @@ def CsvOutput(resultfile, adict):
     else:
         print "Error: data empty!"
 
+def CsvOutputRows(resultfile, rows):
+    """Write a batch of results to a local file in one call."""
+    data = ["{},{},{},{}\n".format(adict['type'],adict['Image Name'],adict['Label'],adict['Value']) for adict in rows]
+    resultfile.write(''.join(data))
+
+def MeasurePolygon(imp, polygon):
+    """Measure the ball count, area and vertex distances of a polygon as result rows."""
+    imagename = imp.getTitle()
+    if polygon.getType() != 2: 
+        raise Exception("Not a Polygon!")
+    rows = []
+    # The number of MBP ball
+    number = polygon.getNCoordinates()
+    rows.append({'type': 'ball', 'Image Name': imagename, 'Label': 'Ball Count', 'Value': number})
+    # Measure the area of the polygon
+    area = PolygonArea(imp, polygon)
+    rows.append({'type': 'area', 'Image Name': imagename, 'Label': 'Polygon', 'Value': area})
+    # Measure all vertex distances at once, split into edges and chords
+    polygonpoints = polygon.getPolygon()
+    consecutivepair, nonconsecutivepair = PolygonPairs(polygonpoints.xpoints[:number], polygonpoints.ypoints[:number], pixelsize)
+    for i, j, distance in consecutivepair: 
+        label = 'Consecutive: Point%02d-Point%02d' % (i+1, j+1)
+        rows.append({'type': 'line', 'Image Name': imagename, 'Label': label, 'Value': distance})
+    for i, j, distance in nonconsecutivepair: 
+        label = 'Nonconsecutive: Point%02d-Point%02d' % (i+1, j+1)
+        rows.append({'type': 'line', 'Image Name': imagename, 'Label': label, 'Value': distance})
+    return rows
+
+def InputFiles(image, roizip):
+    """Return the files the measurement of an image depends on."""
+    if os.path.isfile(roizip):
+        return [image, roizip]
+    return [image]
+
+def OpenImage(image):
+    """Open an image, raising when ImageJ cannot read it."""
+    imp = IJ.openImage(image)
+    if imp is None:
+        raise Exception("ImageJ cannot open %s" % image)
+    return imp
+
+def ImportCsvRows(resultpath, store):
+    """Load the rows of a result file written before the results store existed."""
+    rows = []
+    with open(resultpath, 'r') as src:
+        for i, line in enumerate(src):
+            fields = line.rstrip('\n').split(',', 3)
+            if i == 0 or len(fields) < 4:
+                continue
+            rows.append({'type': fields[0], 'Image Name': fields[1], 'Label': fields[2], 'Value': float(fields[3])})
+    AppendRows(store, rows)
+    FlushResults(store)
+
+def ExportResultCsv(storepath, resultpath):
+    """Export the results store to the result file in the original CSV layout, strings in UTF-8."""
+    resultfile = open(resultpath, 'w')
+    CsvOutput(resultfile, {'type':'Type','Image Name':'Image Name','Label':'Label','Value':'Value'})
+    rows = []
+    for row in IterRows(storepath):
+        if row['type'] == 'ball':
+            row['Value'] = int(row['Value'])
+        rows.append(dict((k, Utf8(v)) for k, v in row.items()))
+        if len(rows) >= 65536:
+            CsvOutputRows(resultfile, rows)
+            rows = []
+    CsvOutputRows(resultfile, rows)
+    resultfile.close()
+
 def main():
     # 1. I/O
-    images = ImageLoader(imagepath, imageprefix, imagesuffix)
-    resultfile = open(os.path.join(imagepath, result), 'w')
-    columnFlag = {'type':'Type','Image Name':'Image Name','Label':'Label','Value':'Value'}
-    CsvOutput(resultfile, columnFlag)
+    journal = LoadJournal(JournalPath(imagepath))
+    params = {'pixelsize': pixelsize, 'result': result, 'version': version}
+    resultpath = os.path.join(imagepath, result)
+    images = []
+    for image in ImageLoader(imagepath, imageprefix, imagesuffix):
+        roizip = os.path.join(imagepath, os.path.basename(image).split(".")[0] + ".zip")
+        if headless and not os.path.isfile(roizip):
+            # Nothing to re-measure: never load the image
+            print "Skip %s: no saved Roi %s" % (os.path.basename(image), os.path.basename(roizip))
+            continue
+        # Only new, changed or failed images, or those measured with other parameters
+        if NeedsProcessing(journal, 'getDistanceArea', os.path.abspath(image), InputFiles(image, roizip), params):
+            images.append(image)
+    # Rows go to a columnar store flushed in blocks; the CSV is exported at the end
+    storepath = os.path.splitext(resultpath)[0] + '.results'
+    if not os.path.isdir(storepath) and os.path.isfile(resultpath):
+        ImportCsvRows(resultpath, OpenResults(storepath, resultcolumns))
+    if os.path.isdir(storepath):
+        DropRows(storepath, 'Image Name', set(os.path.basename(image) for image in images))
+    store = OpenResults(storepath, resultcolumns)
+    pending = []    # Journal entries waiting for their rows to be flushed
     # Process image
-    for image in images: 
-        # Open image in ImageJ
-        imp = IJ.openImage(image)
-        imp.show()
+    # The next images are opened in the background while the current one is measured
+    for image, imp, error in Prefetch(images, OpenImage, prefetch, close=lambda imp: imp.close()): 
+        key = os.path.abspath(image)
+        if error is not None: 
+            roizip = os.path.join(imagepath, os.path.basename(image).split(".")[0] + ".zip")
+            print "Image %s could not be opened: %s" % (image, error)
+            Record(journal, 'getDistanceArea', key, InputFiles(image, roizip), params, [], 'failed')
+            continue
         imagename = imp.getTitle()
+        zipname = os.path.basename(image).split(".")[0] + ".zip"  # As checked before loading
+        roizip = os.path.join(imagepath, zipname)
+        if headless:
+            # Re-measure from the polygon saved next to the image
+            try:
+                IJ.run(imp, "Set Scale...", "distance=1 known=%f unit=nm" % pixelsize)
+                polygon = LoadRoiZip(roizip)[0]
+                rows = MeasurePolygon(imp, polygon)
+                pending.append((key, InputFiles(image, roizip), roizip))
+                if AppendRows(store, rows):
+                    for k, files, z in pending:
+                        Record(journal, 'getDistanceArea', k, files, params, [storepath, z], 'done')
+                    pending = []
+            except Exception, e:
+                print "Image %s failed: %s" % (imagename, e)
+                Record(journal, 'getDistanceArea', key, InputFiles(image, roizip), params, [], 'failed')
+            imp.close()
+            continue
+        imp.show()
         # Set scale
         IJ.run("Set Scale...", "distance=1 known=%f unit=nm" % pixelsize)
         # Create a polygon Roi by using mouse and set a checker for the Roi created.
@@ -111,50 +181,23 @@ def main():
         # Check if a polygon
         polygon= roins.getRoisAsArray()[0] # [0] because I just have one polygon object
         if polygon.getType() != 2: 
+            Record(journal, 'getDistanceArea', key, InputFiles(image, roizip), params, [], 'failed')
             raise Exception("Not a Polygon!")
         # Save the roi.zip
-        zipname = imagename.split(".")[0] + ".zip"
-        roizip = os.path.join(imagepath, zipname)
         roins.runCommand("save selected", roizip)
-        # The number of MBP ball
-        number = polygon.getNCoordinates()
-        ballNumber = {'type': 'ball', 'Image Name': imagename, 'Label': 'Ball Count', 'Value': number}
-        CsvOutput(resultfile,ballNumber)
-        # Measure the area of the polygon
-        area = PolygonArea(imp, polygon)
-        polygonArea = {'type': 'area', 'Image Name': imagename, 'Label': 'Polygon'}
-        polygonArea['Value'] = area
-        CsvOutput(resultfile, polygonArea)
-        # Create point dictionary
-        pointdict = PolygonToPoints(polygon)
-        pointlist = [key for key in pointdict.keys()]
-        pointlist.sort()
-        # Measure the consecutive distance
-        consecutivepair = GetConsecutivePair(pointlist)
-        for pointA,pointB in consecutivepair: 
-            consecutiveDist = {'type': 'line', 'Image Name': imagename}
-            label = 'Consecutive: ' + pointA + '-' + pointB
-            consecutiveDist['Label'] = label
-            dx = abs(int(pointdict[pointA][0]) - int(pointdict[pointB][0]))
-            dy = abs(int(pointdict[pointA][1]) - int(pointdict[pointB][1]))
-            distance = math.sqrt(dx*dx + dy*dy) * pixelsize
-            consecutiveDist['Value'] = distance
-            CsvOutput(resultfile, consecutiveDist)
-        # Measure the nonconsecutive distance
-        nonconsecutivepair = GetNonConsecutivePair(pointlist)
-        for pointA,pointB in nonconsecutivepair: 
-            nonconsecutiveDist = {'type': 'line', 'Image Name': imagename}
-            label = 'Nonconsecutive: ' + pointA + '-' + pointB
-            nonconsecutiveDist['Label'] = label
-            dx = abs(int(pointdict[pointA][0]) - int(pointdict[pointB][0]))
-            dy = abs(int(pointdict[pointA][1]) - int(pointdict[pointB][1]))
-            distance = math.sqrt(dx*dx + dy*dy) * pixelsize
-            nonconsecutiveDist['Value'] = distance
-            CsvOutput(resultfile, nonconsecutiveDist)
+        # Measure and write out
+        AppendRows(store, MeasurePolygon(imp, polygon))
+        FlushResults(store)     # One image per manual drawing, nothing to batch
+        Record(journal, 'getDistanceArea', key, InputFiles(image, roizip), params, [storepath, roizip], 'done')
         # Close the image and the polygon roi
         roins.runCommand('reset')
         imp.close()
-    resultfile.close()
+    CloseResults(store)
+    for k, files, z in pending:
+        Record(journal, 'getDistanceArea', k, files, params, [storepath, z], 'done')
+    ExportResultCsv(storepath, resultpath)
+    return [storepath, resultpath]
 
-main()
+if __name__ in ('__main__', '__builtin__'):    # '__builtin__' when run from Fiji's Plugins menu
+    main()
 #----EOF----
@@ -6,12 +6,27 @@ from ij import IJ, WindowManager, ImagePlus
 from ij.gui import PointRoi, GenericDialog
 from ij.plugin.frame import RoiManager
 from ij.measure import Measurements, ResultsTable
+from RoiIO import LoadRoiZip, IsHeadless
+from Journal import JournalPath, LoadJournal, NeedsProcessing, Record
+from RegionProps import MeasureRois
+from Feret import RoiFerets
+from Geometry import RadialProfile
+from RoiRuns import ClearRunsCache
+from Prefetch import Prefetch
+from ResultsStore import OpenResults, AppendRows, FlushResults, CloseResults, IterRows, DropRows, ExportCsv
     
 # glob var
 imagepath = "E:\data\YG0_class"
 imageprefix = "YG0_class"
 imagesuffix = ".tif"
 pixelsize = float(698.74/2048)
+headless = IsHeadless()   # Measure from the saved .zip Rois, no drawing
+measurestore = imageprefix + "_measure.results"     # One row per image and feature for the whole batch
+measurecolumns = [["Image", "str"], ["Feature", "str"], ["Value", "float"]]
+measurecsv = imageprefix + "_measure.csv"     # The whole store exported as one Image,Feature,Value table
+keyvaluefiles = False   # Also export the legacy per-image key/value files
+prefetch = 2    # Images opened ahead in the background
+version = 2     # Bump when the measured features change, so every image is measured again
 
 def imageloader(imagepath,prefix,suffix):
     """Create an iterator to load image."""
@@ -28,69 +43,181 @@ def roipoints(roi):
         coordinates[name] = coordinate
     return coordinates
 
-def roiferets(roi):
-    """Return the Feret values in a dictionary."""
+def roiferets(feret):
+    """Return the Feret values of a contour in a dictionary."""
     feretdict = {}
-#    if roi.getTypeAsString() != "Traced": 
-#        raise Exception("Roi type error! A traced contour is required here.")
-    ferets = roi.getFeretValues()
-    feretdict["Feret"] = ferets[0]      # Feret's diameter
-    feretdict["FeretAngle"] = ferets[1] # Feret's angle
-    feretdict["MinFeret"] = ferets[2]   # Feret's min value
-    feretdict["FeretX"] = ferets[3]     # 
-    feretdict["FeretY"] = ferets[4]     #
+    feretdict["Feret"] = feret["Feret"]             # Feret's diameter
+    feretdict["FeretAngle"] = feret["FeretAngle"]   # Feret's angle
+    feretdict["MinFeret"] = feret["MinFeret"]       # Feret's min value
+    feretdict["FeretX"] = feret["FeretX"]           # 
+    feretdict["FeretY"] = feret["FeretY"]           #
     return feretdict
 
-def roiareas(imp, roi): 
-    """Return the area values in a dictionary."""
+def roiareas(region): 
+    """Return the area values of a measured region in a dictionary."""
     areadict = {}
-#    if roi.getTypeAsString() != "Traced": 
-#        raise Exception("Roi type error! A traced contour is required here.")
-    ip = imp.getProcessor()
-    ip.setRoi(roi)
-    istats = ip.getStatistics()
-    areadict["Area"] = istats.area
-    areadict["Centroid"] = (istats.xCentroid, istats.yCentroid)
-    areadict["CenterOfMass"] = (istats.xCenterOfMass, istats.yCenterOfMass)
+    areadict["Area"] = region["Area"]
+    areadict["Centroid"] = region["Centroid"]
+    areadict["CenterOfMass"] = region["CenterOfMass"]
     return areadict
 
-def distance(tuple1, tuple2): 
-    """Measure the distance between two points."""
-    dx = abs(float(tuple1[0] - tuple2[0]))
-    dy = abs(float(tuple1[1] - tuple2[1]))
-    distance = math.sqrt(dx*dx + dy*dy) * pixelsize
-    return distance
-
-def angle(ori, tuple1, tuple2): 
-    """Measure the angle of ori as the ventice in the triangle formed by ori, tuple1 and tuple2."""
-    a = distance(ori, tuple1)       # Side 1
-    b = distance(ori, tuple2)       # Side 2
-    c = distance(tuple1, tuple2)    # The side opposite to the angle
-    alpha = math.degrees(math.acos((a*a + b*b - c*c)/(2*a*b)))
-    return alpha
-
-def consecutivepair(iterable):
-    """Generate a iterator producing 2 consecutive items from iterable."""
-    from itertools import tee, izip
-    iterable.sort()
-    iterable.append(iterable[0])
-    v, w = tee(iterable)
-    next(w, None)
-    return izip(v, w)
-    
+def measureimage(imp, rois):
+    """Measure the point and contour Rois of an image in a dictionary."""
+    measure = {}
+    measure["Name"] = imp.getTitle()
+    measure["PixelSize"] = pixelsize
+
+    # Collect info from Roi instances
+    contours = []
+    for roi in rois: 
+        if roi.getTypeAsString() == "Point":    # Point Roi
+            points = roipoints(roi)
+        else:                                   # Contour Roi
+            contours.append(roi)
+    # All contours are measured in one pass over the image
+    regions = MeasureRois(imp.getProcessor(), contours)
+    ClearRunsCache(contours)
+    cal = imp.getCalibration()
+    ferets = RoiFerets(contours, cal.pixelWidth, cal.pixelHeight)
+    for feret, region in zip(ferets, regions):
+        measure.update(roiferets(feret))
+        measure.update(roiareas(region))
+
+    # Check if Center of Mass is there
+    if measure.has_key("CenterOfMass"):
+        ori = measure["CenterOfMass"]   # Center of Mass 
+    else: 
+        raise Exception("Error: No CenterOfMass in the Traced Roi.")
+
+    # Radial profile of the points around the CenterOfMass in one pass
+    pointslist = sorted(points.keys())
+    pointslist.remove('PointCount')
+    profile = RadialProfile([points[p][0] for p in pointslist], [points[p][1] for p in pointslist],
+                            ori[0], ori[1], pixelsize)
+    for point, radius, degree in zip(pointslist, profile["Radius"], profile["Angle"]):
+        measure["ori-"+point] = radius
+        measure["ori-angle-"+point] = degree
+
+    # The angle of PointA-Ori-PointB between angular neighbours
+    order = profile["Order"]
+    for k in range(len(order)):
+        pointA, pointB = pointslist[order[k]], pointslist[order[(k+1) % len(order)]]
+        angleName = "%s-Ori-%s" %(pointA, pointB)
+        measure[angleName] = profile["Gap"][k]
+    measure["PointCount"] = points["PointCount"]
+    return measure
+
+def measurerows(measure):
+    """Flatten a measurement into (Image, Feature, Value) rows; coordinate pairs become Feature.X and Feature.Y."""
+    rows = []
+    for label, value in measure.items():
+        if label == "Name":
+            continue
+        if isinstance(value, tuple):
+            rows.append({"Image": measure["Name"], "Feature": label + ".X", "Value": value[0]})
+            rows.append({"Image": measure["Name"], "Feature": label + ".Y", "Value": value[1]})
+        else:
+            rows.append({"Image": measure["Name"], "Feature": label, "Value": value})
+    return rows
+
+def writemeasure(measure):
+    """Write the measurement of an image to its key/value file."""
+    filename = measure["Name"].split(".")[0] + ".csv"   # The Name of output file
+    outputfile = open(os.path.join(imagepath, filename), 'w') 
+    outputfile.write('{}\t{}\n'.format('PointCount', measure['PointCount']))
+    for label, value in measure.items(): 
+        if label != 'PointCount':
+            outputfile.write('{}\t{}\n'.format(label, str(value)))
+    outputfile.close()
+    return os.path.join(imagepath, filename)
+
+def exportmeasures(storepath, names):
+    """Export the stored measurements of the given images to their key/value files."""
+    measures = {}
+    for row in IterRows(storepath):
+        if row["Image"] in names:
+            measures.setdefault(row["Image"], {"Name": row["Image"]})[row["Feature"]] = row["Value"]
+    for name, measure in measures.items():
+        for label in [label for label in measure.keys() if label.endswith(".X")]:
+            pair = label[:-2]
+            measure[pair] = (measure.pop(label), measure.pop(pair + ".Y"))
+        measure["PointCount"] = int(measure["PointCount"])
+        writemeasure(measure)
+
+def inputfiles(image, roizip):
+    """Return the files an image measurement depends on."""
+    if os.path.isfile(roizip):
+        return [image, roizip]
+    return [image]
+
+def openinput(image):
+    """Open an image, unless it cannot be measured without drawing."""
+    roizip = os.path.join(imagepath, os.path.basename(image).split(".")[0] + ".zip")
+    if headless and not os.path.isfile(roizip):
+        return None
+    imp = IJ.openImage(image)
+    if imp is None:     # Unreadable or unsupported file
+        raise Exception("ImageJ cannot open %s" % image)
+    return imp
+
 def main():
 
-    images = imageloader(imagepath, imageprefix, imagesuffix)
-    for image in images: 
+    journal = LoadJournal(JournalPath(imagepath))
+    params = {"pixelsize": pixelsize, "version": version}
+    todo = []
+    for image in imageloader(imagepath, imageprefix, imagesuffix):
+        name = os.path.basename(image)
+        key = os.path.abspath(image)
+        csvfile = name.split(".")[0] + ".csv"
+        roizip = os.path.join(imagepath, name.split(".")[0] + ".zip")
+        # Only new, changed or failed images, or those measured with other parameters
+        if ("measure", key) not in journal["Entries"] and \
+           os.path.isfile(os.path.join(imagepath, csvfile)) and not headless:
+            continue    # Measured before the journal existed
+        if NeedsProcessing(journal, "measure", key, inputfiles(image, roizip), params):
+            todo.append(image)
+
+    # Rows of the images measured again are replaced
+    storepath = os.path.join(imagepath, measurestore)
+    if os.path.isdir(storepath):
+        DropRows(storepath, "Image", set(os.path.basename(image) for image in todo))
+    store = OpenResults(storepath, measurecolumns)
+    pending = []    # Journal entries waiting for their rows to be flushed
+    measured = set()
+
+    # The next images are opened in the background while the current one is measured
+    for image, imp, error in Prefetch(todo, openinput, prefetch, close=lambda imp: imp.close()): 
         # I/O
-        imp = IJ.openImage(image)
-        measure = {}
-        measure["Name"] = imp.getTitle()
-        measure["PixelSize"] = pixelsize
-
-        # Check if csv file exist
-        csvfile = measure["Name"].split(".")[0] + ".csv"
-        if not os.path.isfile(os.path.join(imagepath,csvfile)):
+        name = os.path.basename(image)
+        key = os.path.abspath(image)
+        zipname = name.split(".")[0] + ".zip"
+        roizip = os.path.join(imagepath, zipname)
+        if error is not None:
+            print "Image %s could not be opened: %s" % (name, error)
+            Record(journal, "measure", key, inputfiles(image, roizip), params, [], "failed")
+            continue
+
+        if headless:
+            # Re-measure from the saved Rois
+            if imp is None:
+                print "Skip %s: no saved Rois %s" % (name, zipname)
+                continue
+            try:
+                IJ.run(imp, "Set Scale...", "distance=1 known=%f unit=nm" % pixelsize)
+                rois = LoadRoiZip(roizip)
+                rows = measurerows(measureimage(imp, rois))
+                pending.append((key, inputfiles(image, roizip), roizip))
+                measured.add(name)
+                if AppendRows(store, rows):
+                    for k, files, z in pending:
+                        Record(journal, "measure", k, files, params, [storepath, z], "done")
+                    pending = []
+            except Exception, e:
+                print "Image %s failed: %s" % (name, e)
+                Record(journal, "measure", key, inputfiles(image, roizip), params, [], "failed")
+            imp.close()
+
+        else:
             imp.show()
         
             # Set scale
@@ -115,49 +242,33 @@ def main():
 #                raise Exception("Error: point and traced rois are missing!")
     
             # Save the Rois created
-            zipname = measure["Name"].split(".")[0] + ".zip"
-            roizip = os.path.join(imagepath, zipname)
             ROIinstance.runCommand("Deselect")
             ROIinstance.runCommand("save", roizip)
     
-            # Collect info from Roi instances
-            for roi in rois: 
-                if roi.getTypeAsString() == "Point":    # Point Roi
-                    points = roipoints(roi)
-                else:                                   # Contour Roi
-                    measure.update(roiferets(roi))
-                    measure.update(roiareas(imp, roi))           
-
-            # Check if Center of Mass is there
-            if measure.has_key("CenterOfMass"):
-                ori = measure["CenterOfMass"]   # Center of Mass 
-            else: 
-                raise Exception("Error: No CenterOfMass in the Traced Roi.")
-    
-            # Measure the distance from the CenterOfMass to each point
-            pointslist = points.keys()
-            pointslist.remove('PointCount')
-            for point in pointslist:
-                pointDist = distance(ori, points[point])
-                measure["ori-"+point] = pointDist
-    
-            # Measure the angle of Point01-Ori-Point02
-            for pointA, pointB in consecutivepair(pointslist): 
-                angleName = "%s-Ori-%s" %(pointA, pointB)
-                degree = angle(ori, points[pointA], points[pointB])
-                measure[angleName] = degree
-    
-            # Write out
-            filename = measure["Name"].split(".")[0] + ".csv"   # The Name of output file
-            outputfile = open(os.path.join(imagepath, filename), 'a') 
-            outputfile.write('{}\t{}\n'.format('PointCount', points['PointCount']))
-            for label, value in measure.items(): 
-                outputfile.write('{}\t{}\n'.format(label, str(value)))
-            outputfile.close()
+            # Measure and write out
+            try:
+                rows = measurerows(measureimage(imp, rois))
+            except Exception:
+                Record(journal, "measure", key, inputfiles(image, roizip), params, [], "failed")
+                raise
+            AppendRows(store, rows)
+            FlushResults(store)     # One image per manual drawing, nothing to batch
+            measured.add(name)
+            Record(journal, "measure", key, inputfiles(image, roizip), params, [storepath, roizip], "done")
     
             # Close the image and the Rois
             ROIinstance.runCommand('reset')
             imp.close()
 
-main()
+    CloseResults(store)
+    for k, files, z in pending:
+        Record(journal, "measure", k, files, params, [storepath, z], "done")
+    csvpath = os.path.join(imagepath, measurecsv)
+    ExportCsv(storepath, csvpath)
+    if keyvaluefiles:
+        exportmeasures(storepath, measured)
+    return [storepath, csvpath]
+
+if __name__ in ('__main__', '__builtin__'):    # '__builtin__' when run from Fiji's Plugins menu
+    main()
 #----EOF----